@@ -0,0 +1,146 @@
+import asyncio
+import math
+import time
+from typing import Any, Dict, Optional, Set, Tuple, cast
+
+from aio_pika import IncomingMessage
+from prometheus_client import Histogram
+from sanic.log import logger
+
+from vxwhatsapp import config
+
+ACK_BATCH = Histogram(
+    "whatsapp_amqp_ack_batch_size",
+    "Number of outbound messages acknowledged per AMQP ack",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200),
+)
+
+
+class _ChannelAcks:
+    def __init__(self):
+        # Delivery tags that we've received, but not yet finished processing
+        self.in_flight: Set[int] = set()
+        # Delivery tags that we've finished processing, but not yet acked, with the
+        # time that they finished
+        self.completed: Dict[int, Tuple[float, IncomingMessage]] = {}
+
+
+class AckBatcher:
+    """
+    Batches up acknowledgements of successfully processed messages, so that instead
+    of an ack per message, we send a single ack with `multiple` set for a run of
+    messages.
+
+    An ack with `multiple` set acknowledges every unacknowledged delivery up to its
+    delivery tag on that channel, so we only ever ack up to the oldest message that is
+    still being processed. Messages that finish out of order behind that are acked
+    individually if they've been waiting for longer than the batch window. Rejects
+    are sent immediately.
+    """
+
+    def __init__(self):
+        # Delivery tags are per channel, so we track them separately for each channel
+        self._channels: Dict[Any, _ChannelAcks] = {}
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    def _state(self, message: IncomingMessage) -> _ChannelAcks:
+        state = self._channels.get(message.channel)
+        if state is None:
+            state = self._channels[message.channel] = _ChannelAcks()
+        return state
+
+    def track(self, message: IncomingMessage) -> None:
+        """
+        Starts tracking a delivered message. Every delivered message must be tracked
+        before any later message on the same channel is acked.
+        """
+        self._state(message).in_flight.add(cast(int, message.delivery_tag))
+
+    def ack(self, message: IncomingMessage) -> None:
+        """
+        Marks the message as successfully processed. The ack is sent in the next batch.
+        """
+        state = self._state(message)
+        tag = cast(int, message.delivery_tag)
+        state.in_flight.discard(tag)
+        state.completed[tag] = (time.monotonic(), message)
+        if len(state.completed) >= config.ACK_BATCH_SIZE:
+            self._ack_batch(state)
+        self._schedule_flush()
+
+    async def reject(self, message: IncomingMessage, requeue: bool = False) -> None:
+        """
+        Rejects the message immediately
+        """
+        state = self._state(message)
+        try:
+            # Keep the message in flight until the reject is sent, so that a batched
+            # ack can't include it
+            await message.reject(requeue=requeue)
+        finally:
+            state.in_flight.discard(message.delivery_tag)
+        self._schedule_flush()
+
+    def _schedule_flush(self) -> None:
+        if self._flush_handle is None and any(
+            state.completed for state in self._channels.values()
+        ):
+            self._flush_handle = asyncio.get_running_loop().call_later(
+                config.ACK_BATCH_WINDOW, self.flush
+            )
+
+    def flush(self, force: bool = False) -> None:
+        """
+        Sends acks for processed messages. Messages that finished out of order behind
+        a message that is still being processed are acked individually once they've
+        waited for the batch window, or immediately if `force` is set.
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        expiry = math.inf if force else time.monotonic() - config.ACK_BATCH_WINDOW
+        for channel, state in list(self._channels.items()):
+            self._ack_batch(state)
+            self._ack_expired(state, expiry)
+            if not state.in_flight and not state.completed:
+                del self._channels[channel]
+        self._schedule_flush()
+
+    def _ack_batch(self, state: _ChannelAcks) -> None:
+        """
+        Acks all the processed messages up to the oldest message still in flight
+        """
+        barrier = min(state.in_flight, default=math.inf)
+        batch = [tag for tag in state.completed if tag < barrier]
+        if not batch:
+            return
+        _, message = state.completed[max(batch)]
+        for tag in batch:
+            del state.completed[tag]
+        self._send(message.ack(multiple=True))
+        ACK_BATCH.observe(len(batch))
+
+    def _ack_expired(self, state: _ChannelAcks, expiry: float) -> None:
+        for tag, (completed_at, message) in list(state.completed.items()):
+            if completed_at <= expiry:
+                del state.completed[tag]
+                self._send(message.ack())
+                ACK_BATCH.observe(1)
+
+    def _send(self, task: asyncio.Task) -> None:
+        self._tasks.add(task)
+        task.add_done_callback(self._sent)
+
+    def _sent(self, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning("Unable to ack outbound messages", exc_info=task.exception())
+
+    async def teardown(self) -> None:
+        """
+        Sends all outstanding acks
+        """
+        self.flush(force=True)
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
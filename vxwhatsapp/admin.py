@@ -0,0 +1,139 @@
+import asyncio
+import pstats
+import threading
+import tracemalloc
+
+from sanic import Blueprint
+from sanic.exceptions import InvalidUsage, SanicException
+from sanic.request import Request
+from sanic.response import HTTPResponse, json, text
+
+from vxwhatsapp import config
+from vxwhatsapp.auth import validate_token
+from vxwhatsapp.profiling import (
+    allocation_diff,
+    collapsed_stacks,
+    profile_stats,
+    sample_stacks,
+    task_counts,
+)
+
+bp = Blueprint("admin", url_prefix="/admin")
+
+MAX_PROFILE_DURATION = 60
+MIN_SAMPLE_INTERVAL = 0.001
+TRACEMALLOC_GROUPS = ("lineno", "filename", "traceback")
+
+_baseline = None
+
+
+@bp.before_server_start
+async def setup_admin(app, loop):
+    # Only one profile at a time, as they'd slow each other down
+    app.ctx.profiling = asyncio.Lock()
+
+
+def _float_arg(request: Request, name: str, default: float) -> float:
+    try:
+        return float(request.args.get(name, default))
+    except ValueError:
+        raise InvalidUsage(f"{name} must be a number")
+
+
+def _int_arg(request: Request, name: str, default: int) -> int:
+    try:
+        return int(request.args.get(name, default))
+    except ValueError:
+        raise InvalidUsage(f"{name} must be an integer")
+
+
+@bp.route("/profile", methods=["POST"])
+@validate_token(lambda: config.ADMIN_TOKEN)
+async def profile(request: Request) -> HTTPResponse:
+    """
+    Profiles this worker for `seconds` seconds. The default `collapsed` format samples
+    the event loop's stack every `interval` seconds, which has little overhead, and
+    can be turned into a flame graph. The `pstats` format uses the deterministic
+    profiler, which is more detailed, but slows the worker down while it runs.
+    """
+    seconds = _float_arg(request, "seconds", 10)
+    if not 0 < seconds <= MAX_PROFILE_DURATION:
+        raise InvalidUsage(f"seconds must be between 0 and {MAX_PROFILE_DURATION}")
+    interval = max(_float_arg(request, "interval", 0.005), MIN_SAMPLE_INTERVAL)
+    output_format = request.args.get("format", "collapsed")
+    if output_format not in ("collapsed", "pstats"):
+        raise InvalidUsage("format must be collapsed or pstats")
+    sort = request.args.get("sort", "cumulative")
+    if sort not in pstats.Stats.sort_arg_dict_default:
+        raise InvalidUsage(f"Invalid sort {sort}")
+
+    profiling = request.app.ctx.profiling
+    if profiling.locked():
+        raise SanicException("A profile is already running", status_code=409)
+    async with profiling:
+        if output_format == "pstats":
+            return text(await profile_stats(seconds, sort))
+        loop = asyncio.get_running_loop()
+        samples = await loop.run_in_executor(
+            None, sample_stacks, threading.get_ident(), seconds, interval
+        )
+        return text(collapsed_stacks(samples))
+
+
+@bp.route("/tracemalloc/start", methods=["POST"])
+@validate_token(lambda: config.ADMIN_TOKEN)
+async def tracemalloc_start(request: Request) -> HTTPResponse:
+    """
+    Starts tracing allocations on this worker, storing `frames` frames of traceback
+    for each allocation, and takes the baseline snapshot to compare to. Snapshots of a
+    large heap are slow, so they're taken in a thread, to keep the loop responsive.
+    """
+    global _baseline
+    frames = _int_arg(request, "frames", 1)
+    if frames < 1:
+        raise InvalidUsage("frames must be at least 1")
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+    tracemalloc.start(frames)
+    loop = asyncio.get_running_loop()
+    _baseline = await loop.run_in_executor(None, tracemalloc.take_snapshot)
+    return json({"tracing": True, "frames": frames})
+
+
+@bp.route("/tracemalloc/snapshot", methods=["GET"])
+@validate_token(lambda: config.ADMIN_TOKEN)
+async def tracemalloc_snapshot(request: Request) -> HTTPResponse:
+    """
+    Returns the `limit` allocation sites that have grown the most since tracing
+    started, grouped by `group`
+    """
+    if _baseline is None or not tracemalloc.is_tracing():
+        raise InvalidUsage("tracemalloc is not running")
+    group = request.args.get("group", "lineno")
+    if group not in TRACEMALLOC_GROUPS:
+        raise InvalidUsage(f"group must be one of {', '.join(TRACEMALLOC_GROUPS)}")
+    limit = _int_arg(request, "limit", 25)
+    if limit < 1:
+        raise InvalidUsage("limit must be at least 1")
+    loop = asyncio.get_running_loop()
+    return text(
+        await loop.run_in_executor(None, allocation_diff, _baseline, group, limit)
+    )
+
+
+@bp.route("/tracemalloc/stop", methods=["POST"])
+@validate_token(lambda: config.ADMIN_TOKEN)
+async def tracemalloc_stop(request: Request) -> HTTPResponse:
+    global _baseline
+    tracemalloc.stop()
+    _baseline = None
+    return json({"tracing": False})
+
+
+@bp.route("/tasks", methods=["GET"])
+@validate_token(lambda: config.ADMIN_TOKEN)
+async def tasks(request: Request) -> HTTPResponse:
+    """
+    Returns the number of pending tasks on this worker, by coroutine
+    """
+    return json(dict(task_counts().most_common()))
@@ -7,6 +7,10 @@ from typing import Callable
 from sanic.exceptions import Forbidden, Unauthorized
 from sanic.request import Request
 
+from vxwhatsapp.metrics import WEBHOOK_STAGE_LATENCY
+
+webhook_hmac = WEBHOOK_STAGE_LATENCY.labels("hmac")
+
 
 def validate_hmac(header: str, secret: Callable):
     """
@@ -21,12 +25,36 @@ def validate_hmac(header: str, secret: Callable):
             if s is None:
                 # If no secret is configured, then don't validate
                 return f(request, *args, **kwargs)
-            if header not in request.headers or not request.headers[header]:
-                raise Unauthorized(f"{header} not found in request headers")
-            signature = request.headers[header]
-            h = hmac.new(s.encode(), request.body, sha256)
-            if not hmac.compare_digest(b64encode(h.digest()).decode(), signature):
-                raise Forbidden("HMAC signature does not match")
+            with webhook_hmac.time():
+                if header not in request.headers or not request.headers[header]:
+                    raise Unauthorized(f"{header} not found in request headers")
+                signature = request.headers[header]
+                h = hmac.new(s.encode(), request.body, sha256)
+                if not hmac.compare_digest(b64encode(h.digest()).decode(), signature):
+                    raise Forbidden("HMAC signature does not match")
+            return f(request, *args, **kwargs)
+
+        return decorated_function
+
+    return decorator
+
+
+def validate_token(secret: Callable):
+    """
+    Validates that the request has a bearer token matching the secret. If no secret is
+    configured, then all requests are forbidden.
+    """
+
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(request: Request, *args, **kwargs):
+            s = secret()
+            if not s:
+                raise Forbidden("No token configured")
+            if request.token is None:
+                raise Unauthorized("Token not found in request headers")
+            if not hmac.compare_digest(request.token.encode(), s.encode()):
+                raise Forbidden("Invalid token")
             return f(request, *args, **kwargs)
 
         return decorated_function
@@ -0,0 +1,186 @@
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Deque, Dict, List, Optional
+
+import aiohttp
+from prometheus_client import Gauge
+
+SEND_CONCURRENCY_LIMIT = Gauge(
+    "whatsapp_send_concurrency_limit",
+    "Current limit of parallel message sends to the WhatsApp API",
+    multiprocess_mode="liveall",
+)
+SEND_IN_FLIGHT = Gauge(
+    "whatsapp_send_in_flight",
+    "Current number of message sends to the WhatsApp API in progress",
+    multiprocess_mode="livesum",
+)
+
+
+def is_overload_error(e: BaseException) -> bool:
+    """
+    Whether the exception is a sign that the upstream is overloaded, as opposed to a
+    problem with the message
+    """
+    if isinstance(e, aiohttp.ClientResponseError):
+        return e.status > 499 or e.status == 429
+    return isinstance(e, (asyncio.TimeoutError, aiohttp.ClientConnectionError))
+
+
+class AdaptiveLimiter:
+    """
+    Limits the number of parallel sends, adjusting the limit between `minimum` and
+    `maximum` using additive increase, multiplicative decrease (AIMD).
+
+    Sends are in lanes, and when sends have to wait for a slot, free slots are shared
+    between the lanes in proportion to their `weights`, using stride scheduling.
+
+    Every send that completes within the latency target while the limit is in use
+    increases the limit by 1/limit, so about 1 per round trip. A send that fails with
+    an overload error, or is slower than the target, multiplies the limit by
+    `backoff`, at most once per latency target window, so that a burst of failures
+    from the same window only counts once.
+    """
+
+    def __init__(
+        self,
+        initial: int,
+        minimum: int,
+        maximum: int,
+        latency_target: float,
+        backoff: float = 0.7,
+        weights: Optional[Dict[str, int]] = None,
+    ):
+        self.minimum = max(minimum, 1)
+        self.maximum = max(maximum, self.minimum)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self.in_flight = 0
+        self.weights = weights or {"default": 1}
+        self._waiters: Dict[str, Deque[asyncio.Future]] = {
+            lane: deque() for lane in self.weights
+        }
+        # Stride scheduling: each lane has a pass value that advances by 1/weight every
+        # time it gets a slot, and the waiting lane with the lowest pass goes next
+        self._pass: Dict[str, float] = {lane: 0.0 for lane in self.weights}
+        self._virtual_time = 0.0
+        self._listeners: List[Callable[[int], None]] = []
+        self._last_decrease = 0.0
+        SEND_CONCURRENCY_LIMIT.set(self.current)
+
+    @property
+    def current(self) -> int:
+        return int(self.limit)
+
+    def add_listener(self, listener: Callable[[int], None]) -> None:
+        """
+        Calls `listener` with the new limit whenever the limit changes
+        """
+        self._listeners.append(listener)
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(waiters) for waiters in self._waiters.values())
+
+    async def acquire(self, lane: str = "default") -> None:
+        if self.in_flight < self.current and not self.waiting:
+            self._start()
+            return
+        waiters = self._waiters[lane]
+        if not waiters:
+            # Lanes can't build up credit while they're idle
+            self._pass[lane] = max(self._pass[lane], self._virtual_time)
+        waiter = asyncio.get_running_loop().create_future()
+        waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # We were given a slot just as we were cancelled, so pass it on
+                self._abandon()
+            elif waiter in waiters:
+                waiters.remove(waiter)
+            raise
+
+    def release(self, latency: float, overloaded: bool) -> None:
+        saturated = self.in_flight * 2 >= self.current
+        self.in_flight -= 1
+        SEND_IN_FLIGHT.dec()
+        previous = self.current
+        if overloaded or latency > self.latency_target:
+            now = time.monotonic()
+            if now - self._last_decrease >= self.latency_target:
+                self._last_decrease = now
+                self.limit = max(self.limit * self.backoff, self.minimum)
+        elif saturated:
+            self.limit = min(self.limit + 1 / self.limit, self.maximum)
+        if self.current != previous:
+            SEND_CONCURRENCY_LIMIT.set(self.current)
+            for listener in self._listeners:
+                listener(self.current)
+        self._wake()
+
+    def _abandon(self) -> None:
+        """
+        Gives up a slot that wasn't used for a send, without adjusting the limit
+        """
+        self.in_flight -= 1
+        SEND_IN_FLIGHT.dec()
+        self._wake()
+
+    def _start(self) -> None:
+        self.in_flight += 1
+        SEND_IN_FLIGHT.inc()
+
+    def _next_lane(self) -> Optional[str]:
+        lanes = [lane for lane, waiters in self._waiters.items() if waiters]
+        if not lanes:
+            return None
+        return min(lanes, key=lambda lane: self._pass[lane])
+
+    def _wake(self) -> None:
+        while self.in_flight < self.current:
+            lane = self._next_lane()
+            if lane is None:
+                return
+            waiter = self._waiters[lane].popleft()
+            if waiter.done():
+                continue
+            self._virtual_time = self._pass[lane]
+            self._pass[lane] += 1 / self.weights[lane]
+            self._start()
+            waiter.set_result(None)
+
+    @asynccontextmanager
+    async def slot(
+        self,
+        lane: str = "default",
+        ready: Optional[Callable[[], Awaitable[None]]] = None,
+    ):
+        """
+        Holds a send slot for the duration of the context, using its latency and any
+        overload error to adjust the limit.
+
+        If given, `ready` is awaited once the slot is granted, before the send starts,
+        eg. to take a rate limit token, so that the lane weights also decide which
+        sends get the tokens. Its wait isn't counted in the send's latency.
+        """
+        await self.acquire(lane)
+        if ready is not None:
+            try:
+                await ready()
+            except BaseException:
+                self._abandon()
+                raise
+        start = time.perf_counter()
+        overloaded = False
+        try:
+            yield
+        except BaseException as e:
+            overloaded = is_overload_error(e)
+            raise
+        finally:
+            self.release(time.perf_counter() - start, overloaded)
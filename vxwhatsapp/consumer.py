@@ -1,54 +1,122 @@
+import asyncio
 import os
-from asyncio import sleep
+import time
+from functools import partial
 from json.decoder import JSONDecodeError
-from typing import Any, Dict
+from typing import Any, Dict, Optional, Set, cast
 from urllib.parse import ParseResult, unquote_plus, urlparse, urlunparse
 
 import aiohttp
+import sentry_sdk
 import ujson
 from aio_pika import Connection, ExchangeType, IncomingMessage
-from prometheus_client import Histogram
+from prometheus_client import Counter, Histogram
 from redis.asyncio import Redis
 from sanic.log import logger
 
 from vxwhatsapp import config
+from vxwhatsapp.acks import AckBatcher
 from vxwhatsapp.claims import delete_conversation_claim, store_conversation_claim
+from vxwhatsapp.concurrency import AdaptiveLimiter
+from vxwhatsapp.contacts import VALID, ContactChecker
+from vxwhatsapp.dispatch import KeyedDispatcher
+from vxwhatsapp.errors import ErrorReporter
+from vxwhatsapp.lag import QueueDepthMonitor, observe_outbound_lag
+from vxwhatsapp.lanes import BULK, INTERACTIVE, lane_weights, message_lane
+from vxwhatsapp.ledger import SendLedger
+from vxwhatsapp.media import MediaPipeline
+from vxwhatsapp.metrics import (
+    OUTBOUND_MESSAGES,
+    OUTBOUND_STAGE_LATENCY,
+    PAYLOAD_SIZE,
+    UPSTREAM_ERRORS,
+    WHATSAPP_RQS_LATENCY,
+    outbound_stage,
+)
 from vxwhatsapp.models import Message
+from vxwhatsapp.ratelimit import RateLimiter
+from vxwhatsapp.retry import RetryQueues
+from vxwhatsapp.sharding import (
+    ShardCoordinator,
+    ShardRouter,
+    declare_shard_queues,
+    router_queue_name,
+)
+from vxwhatsapp.shedding import LoadShedder
+from vxwhatsapp.throttle import THROTTLE_DEFERRED, Throttle, parse_retry_after
+from vxwhatsapp.tracing import continue_trace
 from vxwhatsapp.utils import valid_url
 
-WHATSAPP_RQS_LATENCY = Histogram(
-    "whatsapp_api_request_latency_sec",
-    "WhatsApp API Request Latency Histogram",
-    ["endpoint"],
-)
 whatsapp_message_send = WHATSAPP_RQS_LATENCY.labels("/v1/messages")
-whatsapp_media_upload = WHATSAPP_RQS_LATENCY.labels("/v1/media")
-whatsapp_contact_check = WHATSAPP_RQS_LATENCY.labels("/v1/contacts")
+
+# Outbound message kinds, for metrics
+TEXT = "text"
+BUTTONS = "buttons"
+LIST = "list"
+DOCUMENT = "document"
+IMAGE = "image"
+
+DRAIN_DURATION = Histogram(
+    "whatsapp_outbound_drain_duration_sec",
+    "Time taken to finish in flight outbound messages on shutdown",
+)
+DRAIN_ABANDONED = Counter(
+    "whatsapp_outbound_drain_abandoned_total",
+    "In flight outbound messages abandoned because the shutdown drain timed out",
+)
+
+
+def message_kind(message: Message) -> str:
+    """
+    Returns the kind of WhatsApp message that the Vumi message will be sent as
+    """
+    if "buttons" in message.helper_metadata:
+        return BUTTONS
+    elif "sections" in message.helper_metadata:
+        return LIST
+    elif "document" in message.helper_metadata:
+        return DOCUMENT
+    elif "image" in message.helper_metadata:
+        return IMAGE
+    return TEXT
 
 
 class Consumer:
     def __init__(self, connection: Connection, redis: Redis):
         self.redis = redis
         self.connection = connection
+        self.limiter = AdaptiveLimiter(
+            initial=config.CONCURRENCY,
+            minimum=config.CONCURRENCY_MIN,
+            maximum=config.CONCURRENCY_MAX,
+            latency_target=config.CONCURRENCY_LATENCY_TARGET,
+            weights=lane_weights(),
+        )
+        self.limiter.add_listener(self._update_prefetch)
+        self.throttle = Throttle()
+        self.dispatcher = KeyedDispatcher()
+        self.rate_limiter = RateLimiter(redis, f"ratelimit:{config.WHATSAPP_NUMBER}")
+        self.prefetch_count = self.limiter.current
+        self._prefetch_task: Optional[asyncio.Task] = None
         self.session = aiohttp.ClientSession(
             json_serialize=ujson.dumps,
             raise_for_status=True,
             timeout=aiohttp.ClientTimeout(total=config.CONSUME_TIMEOUT),
-            connector=aiohttp.TCPConnector(limit=config.CONCURRENCY),
+            connector=aiohttp.TCPConnector(limit=self.limiter.maximum),
             headers={"Authorization": f"Bearer {config.API_TOKEN}"},
         )
-        self.media_session = aiohttp.ClientSession(
-            json_serialize=ujson.dumps,
-            raise_for_status=True,
-            timeout=aiohttp.ClientTimeout(total=config.CONSUME_TIMEOUT),
-            connector=aiohttp.TCPConnector(limit=config.CONCURRENCY),
-        )
         self.api_host = config.API_HOST
         self.message_url = self._make_url("/v1/messages")
         self.message_automation_url = self._make_url("/v1/messages/{}/automation")
-        self.media_url = self._make_url("/v1/media")
-        self.media_cache: Dict[str, str] = {}
-        self.contact_url = self._make_url("/v1/contacts")
+        self.media = MediaPipeline(self._make_url("/v1/media"))
+        self.contacts = ContactChecker(
+            self.session, self._make_url("/v1/contacts"), redis
+        )
+        self.ledger = SendLedger(redis)
+        self.errors = ErrorReporter()
+        self.queue_depth: Optional[QueueDepthMonitor] = None
+        self.acks = AckBatcher()
+        self._in_flight: Set[asyncio.Task] = set()
 
     def _make_url(self, path):
         return urlunparse(
@@ -65,21 +133,183 @@ class Consumer:
     async def setup(self):
         queue_name = f"{config.TRANSPORT_NAME}.outbound"
         self.channel = await self.connection.channel()
-        await self.channel.set_qos(prefetch_count=config.CONCURRENCY)
+        # The prefetch is for the whole channel, so that it's shared by all of the
+        # channel's consumers, and changes apply to consumers that are already running
+        await self.channel.set_qos(prefetch_count=self.prefetch_count, global_=True)
         self.exchange = await self.channel.declare_exchange(
             "vumi", type=ExchangeType.DIRECT, durable=True, auto_delete=False
         )
         self.queue = await self.channel.declare_queue(
             queue_name, durable=True, auto_delete=False
         )
-        await self.queue.bind(self.exchange, queue_name)
-        await self.queue.consume(self.process_message)
+        self.shedder = LoadShedder(self.channel, queue_name)
+        await self.shedder.setup()
+        self.retries: Dict[str, RetryQueues] = {}
+        if config.OUTBOUND_SHARDS:
+            await self._setup_shards(queue_name)
+        else:
+            await self.queue.bind(self.exchange, queue_name)
+            self.retries[INTERACTIVE] = RetryQueues(self.channel, queue_name)
+            await self.retries[INTERACTIVE].setup()
+        self.consumer_tag = await self.queue.consume(self.process_message)
+        await self._setup_bulk_lane(f"{queue_name}.bulk")
+
+        if config.QUEUE_DEPTH_INTERVAL:
+            queue_names = [queue_name, f"{queue_name}.bulk"]
+            if config.OUTBOUND_SHARDS:
+                queue_names.append(router_queue_name(queue_name))
+                queue_names.extend(q.name for q in self.shard_queues.values())
+            self.queue_depth = QueueDepthMonitor(self.connection, queue_names)
+            await self.queue_depth.setup()
+
+    async def _setup_bulk_lane(self, queue_name: str):
+        """
+        Bulk messages, like broadcasts, have their own queue and channel, so that a
+        bulk backlog doesn't use up the prefetch, and they get a smaller share of the
+        sends than interactive messages.
+        """
+        self.bulk_channel = await self.connection.channel()
+        await self.bulk_channel.set_qos(
+            prefetch_count=self.prefetch_count, global_=True
+        )
+        self.bulk_queue = await self.bulk_channel.declare_queue(
+            queue_name, durable=True, auto_delete=False
+        )
+        await self.bulk_queue.bind(self.exchange, queue_name)
+        self.retries[BULK] = RetryQueues(self.bulk_channel, queue_name)
+        await self.retries[BULK].setup()
+        self.bulk_consumer_tag = await self.bulk_queue.consume(
+            partial(self.process_message, queue_lane=BULK)
+        )
+
+    async def _setup_shards(self, queue_name: str):
+        """
+        Sets up sharded outbound queues. Outbound messages are routed to a shard queue
+        by recipient, and each process consumes a subset of the shards, so that
+        messages to a recipient stay in order across processes.
+
+        The unsharded queue is unbound, but we still consume it to drain any messages
+        left over from before sharding was enabled.
+        """
+        await self.queue.unbind(self.exchange, queue_name)
+        # The shard queues must exist before the router can route to them
+        self.shard_queues = await declare_shard_queues(
+            self.channel, queue_name, config.OUTBOUND_SHARDS
+        )
+        self.router_channel = await self.connection.channel()
+        await self.router_channel.set_qos(prefetch_count=self.limiter.maximum)
+        self.router = ShardRouter(self.router_channel, self.exchange, queue_name)
+        await self.router.setup()
+        # Retries go back through the router, which sends them to the same shard
+        self.retries[INTERACTIVE] = RetryQueues(
+            self.channel, router_queue_name(queue_name)
+        )
+        await self.retries[INTERACTIVE].setup()
+
+        self.shard_consumer_tags: Dict[int, str] = {}
+        self.shard_coordinator = ShardCoordinator(
+            self.redis,
+            f"shards:{queue_name}",
+            config.OUTBOUND_SHARDS,
+            self._update_shards,
+        )
+        await self.shard_coordinator.setup()
+
+    async def _update_shards(self, owned: Set[int]):
+        for shard in set(self.shard_consumer_tags) - owned:
+            tag = self.shard_consumer_tags.pop(shard)
+            await self.shard_queues[shard].cancel(tag)
+        for shard in owned - set(self.shard_consumer_tags):
+            self.shard_consumer_tags[shard] = await self.shard_queues[shard].consume(
+                self.process_message
+            )
+
+    def _update_prefetch(self, limit: int):
+        """
+        Keeps the channel prefetch in line with the send concurrency limit, so that we
+        don't hold on to more messages than we can send
+        """
+        if self._prefetch_task is None or self._prefetch_task.done():
+            self._prefetch_task = asyncio.create_task(self._set_prefetch())
+
+    async def _set_prefetch(self):
+        while self.prefetch_count != self.limiter.current:
+            self.prefetch_count = self.limiter.current
+            try:
+                await self.channel.set_qos(
+                    prefetch_count=self.prefetch_count, global_=True
+                )
+                await self.bulk_channel.set_qos(
+                    prefetch_count=self.prefetch_count, global_=True
+                )
+            except Exception:
+                logger.warning("Unable to update channel prefetch", exc_info=True)
+                return
+
+    async def drain(self):
+        """
+        Stops consuming, and waits up to DRAIN_TIMEOUT for in flight messages, including
+        any that are being routed to shards, to finish, so that they aren't cut off and
+        redelivered. Messages that don't finish in time are abandoned, and will be
+        redelivered.
+        """
+        start = time.monotonic()
+        if self._prefetch_task is not None:
+            self._prefetch_task.cancel()
+        if config.OUTBOUND_SHARDS:
+            await self.shard_coordinator.teardown()
+            await self.router.teardown()
+            await self._update_shards(set())
+        await self.queue.cancel(self.consumer_tag)
+        await self.bulk_queue.cancel(self.bulk_consumer_tag)
+
+        in_flight = set(self._in_flight)
+        if config.OUTBOUND_SHARDS:
+            in_flight |= self.router.in_flight
+        if in_flight:
+            _, pending = await asyncio.wait(in_flight, timeout=config.DRAIN_TIMEOUT)
+            if pending:
+                logger.warning(
+                    "Abandoning %d in flight outbound messages after %s seconds",
+                    len(pending),
+                    config.DRAIN_TIMEOUT,
+                )
+                DRAIN_ABANDONED.inc(len(pending))
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+        await self.acks.teardown()
+        DRAIN_DURATION.observe(time.monotonic() - start)
 
     async def teardown(self):
+        if self.queue_depth is not None:
+            await self.queue_depth.teardown()
+        await self.contacts.teardown()
         await self.session.close()
-        await self.media_session.close()
+        await self.media.teardown()
+
+    async def process_message(
+        self, message: IncomingMessage, queue_lane: str = INTERACTIVE
+    ):
+        self.acks.track(message)
+        task = cast(asyncio.Task, asyncio.current_task())
+        self._in_flight.add(task)
+        try:
+            # Continue the trace from whoever published the message, in a scope of
+            # its own, so that concurrent messages don't share trace context
+            with sentry_sdk.isolation_scope():
+                transaction = continue_trace(
+                    message.headers,
+                    name=f"{config.TRANSPORT_NAME}.outbound",
+                    op="queue.process",
+                )
+                with sentry_sdk.start_transaction(transaction):
+                    await self._handle_message(message, queue_lane)
+        finally:
+            self._in_flight.discard(task)
 
-    async def process_message(self, message: IncomingMessage):
+    async def _handle_message(self, message: IncomingMessage, queue_lane: str):
+        start = time.perf_counter()
         try:
             msg = Message.from_json(message.body.decode("utf-8"))
         except (
@@ -88,82 +318,180 @@ class Consumer:
             TypeError,
             KeyError,
             ValueError,
-        ):
+        ) as e:
             # Invalid Vumi message, log and throw away, retrying won't help
-            logger.exception(f"Invalid message body {message.body!r}")
-            await message.reject(requeue=False)
+            self.errors.report("Invalid message body %r", message.body, exc=e)
+            await self.acks.reject(message, requeue=False)
             return
 
-        logger.debug(f"Processing outbound message {msg}")
+        kind = message_kind(msg)
+        OUTBOUND_STAGE_LATENCY.labels("decode", kind).observe(
+            time.perf_counter() - start
+        )
+        PAYLOAD_SIZE.labels("consumed", kind).observe(len(message.body))
+
+        logger.debug("Processing outbound message %s", msg)
+        lane = message_lane(msg, queue_lane)
+        if self.shedder.is_stale(msg, lane):
+            await self.shed_message(message, msg, lane)
+            return
+
+        # Messages to the same recipient are sent in the order that we receive them.
+        # There must be no awaits before this, so that the order is preserved.
+        with outbound_stage("dispatch", kind):
+            await self.dispatcher.acquire(msg.to_addr)
         try:
-            await self.submit_message(msg)
+            await self._process_message(message, msg, queue_lane, lane, kind)
+        finally:
+            self.dispatcher.release(msg.to_addr)
+        OUTBOUND_STAGE_LATENCY.labels("total", kind).observe(
+            time.perf_counter() - start
+        )
+
+    async def _process_message(
+        self,
+        message: IncomingMessage,
+        msg: Message,
+        queue_lane: str,
+        lane: str,
+        kind: str,
+    ):
+        if await self.ledger.get(msg.message_id) is not None:
+            # We've already sent this message, but it was redelivered, eg. because we
+            # were stopped before we could ack it
+            logger.debug("Skipping already sent outbound message %s", msg)
+            OUTBOUND_MESSAGES.labels(kind, "duplicate").inc()
+            self.acks.ack(message)
+            return
+        try:
+            await self.submit_message(msg, lane=lane)
         except aiohttp.ClientResponseError as e:
-            # If it's a retryable upstream error, requeue the message
-            if e.status > 499:
-                await message.reject(requeue=True)
-                # If we've retried this before, wait before retrying again
-                if message.redelivered:
-                    await sleep(0.5)
+            # If it's a retryable upstream error, retry the message later
+            if e.status > 499 or e.status == 429:
+                OUTBOUND_MESSAGES.labels(kind, "retry").inc()
+                with outbound_stage("ack", kind):
+                    await self.retry_message(message, msg, queue_lane)
             else:
                 # Otherwise log the error and reject
-                logger.exception(f"Upstream HTTP error processing {msg}")
-                await message.reject(requeue=False)
-        except Exception:
+                self.errors.report("Upstream HTTP error processing %s", msg, exc=e)
+                OUTBOUND_MESSAGES.labels(kind, "rejected").inc()
+                with outbound_stage("ack", kind):
+                    await self.acks.reject(message, requeue=False)
+        except Exception as e:
             # Any other errors aren't recoverable, so log and reject
-            logger.exception(f"Error processing {msg}")
-            await message.reject(requeue=False)
+            self.errors.report("Error processing %s", msg, exc=e)
+            OUTBOUND_MESSAGES.labels(kind, "error").inc()
+            with outbound_stage("ack", kind):
+                await self.acks.reject(message, requeue=False)
         else:
-            await message.ack()
+            with outbound_stage("ack", kind):
+                self.acks.ack(message)
 
-    async def get_media_id(self, media_url):
-        if media_url in self.media_cache:
-            return self.media_cache[media_url]
-
-        async with self.media_session.get(media_url) as media_response:
-            media_response.raise_for_status()
-            with whatsapp_media_upload.time():
-                turn_response = await self.session.post(
-                    self.media_url,
-                    headers={
-                        "Content-Type": media_response.headers["Content-Type"],
-                    },
-                    data=media_response.content,
-                )
-            response_data: Any = await turn_response.json()
-            media_id = response_data["media"][0]["id"]
-            self.media_cache[media_url] = (
-                media_id,
-                media_response.headers["Content-Type"],
+    async def retry_message(
+        self, message: IncomingMessage, msg: Message, queue_lane: str
+    ):
+        """
+        Moves the message off the outbound queue into a delayed retry queue, dropping
+        it if it has been retried too many times already
+        """
+        try:
+            retrying = await self.retries[queue_lane].retry(message)
+        except Exception as e:
+            # If we can't schedule a delayed retry, fall back to requeueing
+            self.errors.report("Error scheduling retry for %s", msg, exc=e)
+            await self.acks.reject(message, requeue=True)
+            return
+        if retrying:
+            self.acks.ack(message)
+        else:
+            self.errors.report(
+                "Giving up on %s after %d retries", msg, config.RETRY_MAX_ATTEMPTS
             )
-            return self.media_cache[media_url]
+            await self.acks.reject(message, requeue=False)
+
+    async def shed_message(self, message: IncomingMessage, msg: Message, lane: str):
+        """
+        Drops a message that is too old to send, moving it to the stale queue if
+        that's enabled
+        """
+        logger.debug("Shedding stale outbound message %s", msg)
+        try:
+            await self.shedder.shed(message, lane)
+        except Exception as e:
+            self.errors.report("Error moving %s to the stale queue", msg, exc=e)
+            await self.acks.reject(message, requeue=False)
+            return
+        self.acks.ack(message)
+
+    async def get_media_id(self, media_url):
+        return await self.media.get_media_id(media_url)
 
     @staticmethod
     def _extract_filename(url: str):
         path = urlparse(url).path
         return os.path.basename(unquote_plus(path))
 
-    async def submit_message(self, message: Message):
-        # TODO: support more message types
+    @staticmethod
+    def _upstream_result(body: bytes) -> str:
+        """
+        Returns the WhatsApp message ID from the send response, if there is one
+        """
+        try:
+            return str(ujson.loads(body)["messages"][0]["id"])
+        except (ValueError, TypeError, KeyError, IndexError):
+            return "sent"
 
-        headers: Dict[str, str] = {}
-        url = self.message_url
-        if claim := message.transport_metadata.get("claim"):
-            if (
-                message.session_event == Message.SESSION_EVENT.RESUME
-                or message.session_event == Message.SESSION_EVENT.NONE
-            ):
-                headers["X-Turn-Claim-Extend"] = claim
-                await store_conversation_claim(self.redis, claim, message.to_addr)
-            elif message.session_event == Message.SESSION_EVENT.CLOSE:
-                headers["X-Turn-Claim-Release"] = claim
-                if (
-                    message.helper_metadata.get("automation_handle")
-                    and message.in_reply_to
-                ):
-                    url = self.message_automation_url.format(message.in_reply_to)
-                    headers["Accept"] = "application/vnd.v1+json"
-                await delete_conversation_claim(self.redis, claim, message.to_addr)
+    async def send(
+        self,
+        url: str,
+        headers: Dict[str, str],
+        data: Dict[str, Any],
+        lane: str = INTERACTIVE,
+        kind: str = TEXT,
+    ):
+        """
+        Sends the message to the WhatsApp API, within the rate limit. If the API
+        throttles us, pauses all sends for the requested time, and then tries again.
+
+        Returns the response body.
+        """
+        for attempt in range(config.THROTTLE_MAX_RETRIES + 1):
+            try:
+                with outbound_stage("wait", kind) as waiting:
+                    await self.throttle.wait()
+                    async with self.limiter.slot(lane, self.rate_limiter.acquire):
+                        waiting.stop()
+                        with whatsapp_message_send.time(), outbound_stage("send", kind):
+                            with sentry_sdk.start_span(op="send", description=url):
+                                response = await self.session.post(
+                                    url, headers=headers, json=data
+                                )
+                                async with response:
+                                    return await response.read()
+            except aiohttp.ClientResponseError as e:
+                UPSTREAM_ERRORS.labels(kind, e.status).inc()
+                if e.status != 429 or attempt == config.THROTTLE_MAX_RETRIES:
+                    raise
+                THROTTLE_DEFERRED.inc()
+                response_headers: Any = e.headers or {}
+                self.throttle.pause(
+                    parse_retry_after(
+                        response_headers.get("Retry-After"),
+                        default=config.THROTTLE_DEFAULT_DELAY,
+                        maximum=config.THROTTLE_MAX_DELAY,
+                    )
+                )
 
+    def build_payload(
+        self,
+        message: Message,
+        media_id: Optional[str] = None,
+        content_type: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """
+        Builds the WhatsApp API request body for the message, using the already
+        uploaded media for any media in the message
+        """
         data: Dict[str, Any] = {"to": message.to_addr}
 
         if "buttons" in message.helper_metadata:
@@ -185,7 +513,6 @@ class Consumer:
             if "header" in message.helper_metadata:
                 header = message.helper_metadata["header"]
                 if valid_url(header):
-                    media_id, content_type = await self.get_media_id(header)
                     if content_type in ("image/jpeg", "image/png"):
                         data["interactive"]["header"] = {
                             "type": "image",
@@ -240,41 +567,100 @@ class Consumer:
                 }
         elif "document" in message.helper_metadata:
             document_url = message.helper_metadata["document"]
-            media_id, _ = await self.get_media_id(document_url)
             data["type"] = "document"
             data["document"] = {
                 "id": media_id,
                 "filename": self._extract_filename(document_url),
             }
         elif "image" in message.helper_metadata:
-            image_url = message.helper_metadata["image"]
-            media_id, _ = await self.get_media_id(image_url)
             data["type"] = "image"
             data["image"] = {"id": media_id}
             if message.content:
                 data["image"]["caption"] = message.content
         else:
             data["text"] = {"body": message.content or ""}
+        return data
+
+    @staticmethod
+    def _media_url(message: Message) -> Optional[str]:
+        """
+        Returns the URL of the media that needs to be uploaded for the message, if any
+        """
+        helper_metadata = message.helper_metadata
+        if "buttons" in helper_metadata:
+            header = helper_metadata.get("header", "")
+            return header if valid_url(header) else None
+        elif "sections" in helper_metadata:
+            return None
+        elif "document" in helper_metadata:
+            return helper_metadata["document"]
+        elif "image" in helper_metadata:
+            return helper_metadata["image"]
+        return None
+
+    async def submit_message(self, message: Message, lane: str = INTERACTIVE):
+        # TODO: support more message types
+        kind = message_kind(message)
+
+        contact_status = self.contacts.cached(message.to_addr)
+        if contact_status is None and config.CONTACT_PRECHECK:
+            with outbound_stage("contact", kind):
+                contact_status = await self.contacts.check(message.to_addr)
+        if contact_status is not None and contact_status != VALID:
+            self.errors.report("Contact %s not on whatsapp", message.to_addr)
+            OUTBOUND_MESSAGES.labels(kind, "invalid_contact").inc()
+            return
+
+        headers: Dict[str, str] = {}
+        url = self.message_url
+        if claim := message.transport_metadata.get("claim"):
+            if (
+                message.session_event == Message.SESSION_EVENT.RESUME
+                or message.session_event == Message.SESSION_EVENT.NONE
+            ):
+                headers["X-Turn-Claim-Extend"] = claim
+                with outbound_stage("claim", kind):
+                    await store_conversation_claim(self.redis, claim, message.to_addr)
+            elif message.session_event == Message.SESSION_EVENT.CLOSE:
+                headers["X-Turn-Claim-Release"] = claim
+                if (
+                    message.helper_metadata.get("automation_handle")
+                    and message.in_reply_to
+                ):
+                    url = self.message_automation_url.format(message.in_reply_to)
+                    headers["Accept"] = "application/vnd.v1+json"
+                with outbound_stage("claim", kind):
+                    await delete_conversation_claim(self.redis, claim, message.to_addr)
+
+        media_id: Optional[str] = None
+        content_type: Optional[str] = None
+        if media_url := self._media_url(message):
+            with outbound_stage("media", kind), sentry_sdk.start_span(
+                op="media", description=media_url
+            ):
+                media_id, content_type = await self.get_media_id(media_url)
+
+        with outbound_stage("build", kind):
+            data = self.build_payload(message, media_id, content_type)
 
         try:
-            with whatsapp_message_send.time():
-                await self.session.post(url, headers=headers, json=data)
+            body = await self.send(url, headers, data, lane, kind)
         except aiohttp.ClientResponseError as e:
             # If it fails with a 404, it could be that the contact has been forgotten.
             # So do a contact check, and then try sending the message again
             if e.status != 404:  # pragma: no cover
                 raise e
-            with whatsapp_contact_check.time():
-                c = await self.session.post(
-                    self.contact_url,
-                    json={
-                        "blocking": "wait",
-                        "contacts": [f"+{message.to_addr.lstrip('+')}"],
-                    },
+            with outbound_stage("contact", kind):
+                contact_status = await self.contacts.check(
+                    message.to_addr, refresh=True
                 )
-                contact_status = (await c.json())["contacts"][0]["status"]
-                if contact_status != "valid":
-                    # If the contact isn't on whatsapp, drop the message and log error
-                    logger.exception(f"Contact {message.to_addr} not on whatsapp")
-                    return
-                await self.session.post(url, headers=headers, json=data)
+            if contact_status != VALID:
+                # If the contact isn't on whatsapp, drop the message and log error
+                self.errors.report("Contact %s not on whatsapp", message.to_addr, exc=e)
+                OUTBOUND_MESSAGES.labels(kind, "invalid_contact").inc()
+                return
+            body = await self.send(url, headers, data, lane, kind)
+        observe_outbound_lag(lane, message.timestamp)
+        await self.ledger.record(message.message_id, self._upstream_result(body))
+        self.contacts.mark_valid(message.to_addr)
+        OUTBOUND_MESSAGES.labels(kind, "sent").inc()
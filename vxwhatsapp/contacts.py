@@ -0,0 +1,202 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+
+import aiohttp
+from prometheus_client import Counter, Histogram
+from redis.asyncio import Redis
+from sanic.log import logger
+
+from vxwhatsapp import config
+from vxwhatsapp.metrics import WHATSAPP_RQS_LATENCY
+
+whatsapp_contact_check = WHATSAPP_RQS_LATENCY.labels("/v1/contacts")
+
+CONTACT_CACHE = Counter(
+    "whatsapp_contact_cache_total",
+    "WhatsApp contact status cache lookups",
+    ["cache", "result"],
+)
+CONTACT_BATCH_SIZE = Histogram(
+    "whatsapp_contact_check_batch_size",
+    "Number of contacts checked per WhatsApp contacts API request",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500),
+)
+
+VALID = "valid"
+INVALID = "invalid"
+
+
+def _format_address(address: str) -> str:
+    return f"+{address.lstrip('+')}"
+
+
+class ContactChecker:
+    """
+    Checks whether addresses are on WhatsApp, caching the result in process and in
+    Redis, and merging concurrent checks into a single contacts API request.
+    """
+
+    def __init__(self, session: aiohttp.ClientSession, url: str, redis: Redis):
+        self.session = session
+        self.url = url
+        self.redis = redis
+        self._cache: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._pending: Dict[str, asyncio.Future] = {}
+        # Maps each address in the next batch to whether it needs a refresh
+        self._batch: Dict[str, bool] = {}
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def teardown(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def cached(self, address: str) -> Optional[str]:
+        """
+        Returns the in-process cached status for `address`, or None if we haven't seen
+        it recently
+        """
+        address = _format_address(address)
+        entry = self._cache.get(address)
+        if entry is None:
+            CONTACT_CACHE.labels("local", "miss").inc()
+            return None
+        status, expiry = entry
+        if expiry < time.monotonic():
+            del self._cache[address]
+            CONTACT_CACHE.labels("local", "miss").inc()
+            return None
+        CONTACT_CACHE.labels("local", status).inc()
+        return status
+
+    def mark_valid(self, address: str) -> None:
+        """
+        Records that `address` is valid, eg. because we've just sent it a message
+        """
+        self._store_local(_format_address(address), VALID)
+
+    def _store_local(self, address: str, status: str) -> None:
+        ttl = (
+            config.CONTACT_CACHE_TTL if status == VALID else config.CONTACT_INVALID_TTL
+        )
+        self._cache[address] = (status, time.monotonic() + ttl)
+        self._cache.move_to_end(address)
+        while len(self._cache) > config.CONTACT_CACHE_SIZE:
+            self._cache.popitem(last=False)
+
+    async def check(self, address: str, refresh: bool = False) -> str:
+        """
+        Returns the status of `address`. If `refresh` is set, the cached result is
+        skipped, and the contact is checked against the API, which also re-registers
+        contacts that WhatsApp has forgotten.
+        """
+        address = _format_address(address)
+        if not refresh:
+            status = self.cached(address)
+            if status is not None:
+                return status
+        if address in self._batch:
+            self._batch[address] = self._batch[address] or refresh
+            return await asyncio.shield(self._pending[address])
+        if address in self._pending and not refresh:
+            return await asyncio.shield(self._pending[address])
+        # A check that has already started might not be a refresh, so a refresh always
+        # goes in the next batch
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[address] = future
+        self._batch[address] = refresh
+        if len(self._batch) >= config.CONTACT_BATCH_SIZE:
+            if self._flush_handle is not None:
+                self._flush_handle.cancel()
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(
+                config.CONTACT_BATCH_WINDOW, self._flush
+            )
+        return await asyncio.shield(future)
+
+    def _flush(self) -> None:
+        self._flush_handle = None
+        batch, self._batch = self._batch, {}
+        if not batch:
+            return
+        futures = {address: self._pending[address] for address in batch}
+        task = asyncio.create_task(self._check_batch(batch, futures))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _check_batch(
+        self, batch: Dict[str, bool], futures: Dict[str, asyncio.Future]
+    ) -> None:
+        try:
+            # A refresh means that any cached result is stale, so only look up the
+            # addresses that don't need a refresh
+            results = await self._check_redis([a for a, r in batch.items() if not r])
+            remaining = [a for a in batch if a not in results]
+            if remaining:
+                results.update(await self._check_api(remaining))
+        except Exception as e:
+            for future in futures.values():
+                future.set_exception(e)
+                future.exception()
+        else:
+            for address, future in futures.items():
+                status = results.get(address, INVALID)
+                self._store_local(address, status)
+                future.set_result(status)
+        finally:
+            for address, future in futures.items():
+                # If the check was cancelled, cancel the checks waiting on it, so that
+                # they don't wait forever
+                future.cancel()
+                # A refresh might have replaced the future in the meantime
+                if self._pending.get(address) is future:
+                    del self._pending[address]
+
+    async def _check_redis(self, batch: List[str]) -> Dict[str, str]:
+        if not self.redis or not batch:
+            return {}
+        try:
+            statuses = await self.redis.mget([f"contact:{a}" for a in batch])
+        except Exception:
+            logger.warning("Unable to fetch cached contacts from redis", exc_info=True)
+            return {}
+        results = {}
+        for address, status in zip(batch, statuses):
+            if status is None:
+                CONTACT_CACHE.labels("redis", "miss").inc()
+            else:
+                CONTACT_CACHE.labels("redis", status).inc()
+                results[address] = status
+        return results
+
+    async def _check_api(self, batch: List[str]) -> Dict[str, str]:
+        CONTACT_BATCH_SIZE.observe(len(batch))
+        with whatsapp_contact_check.time():
+            response = await self.session.post(
+                self.url, json={"blocking": "wait", "contacts": batch}
+            )
+            async with response:
+                data = await response.json()
+        results = {c["input"]: c["status"] for c in data["contacts"]}
+
+        if self.redis:
+            try:
+                async with self.redis.pipeline(transaction=False) as pipe:
+                    for address, status in results.items():
+                        ttl = (
+                            config.CONTACT_CACHE_TTL
+                            if status == VALID
+                            else config.CONTACT_INVALID_TTL
+                        )
+                        pipe.setex(f"contact:{address}", int(ttl), status)
+                    await pipe.execute()
+            except Exception:
+                logger.warning("Unable to cache contacts in redis", exc_info=True)
+        return results
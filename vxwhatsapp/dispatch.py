@@ -0,0 +1,111 @@
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, Optional, Tuple
+
+from prometheus_client import Gauge, Histogram
+
+DISPATCH_KEY_WAIT = Histogram(
+    "whatsapp_dispatch_key_wait_sec",
+    "Time outbound messages waited behind earlier messages to the same recipient",
+)
+DISPATCH_MAX_KEY_WAIT = Gauge(
+    "whatsapp_dispatch_max_key_wait_sec",
+    "Longest time that a waiting outbound message has been queued behind earlier "
+    "messages to the same recipient",
+    multiprocess_mode="liveall",
+)
+DISPATCH_ACTIVE_KEYS = Gauge(
+    "whatsapp_dispatch_active_keys",
+    "Number of recipients with outbound messages in progress",
+    multiprocess_mode="livesum",
+)
+# How often to update the max key wait while messages are waiting, so that it keeps
+# growing when a message is stuck, and nothing else happens
+MAX_KEY_WAIT_REFRESH_INTERVAL = 1
+
+
+class KeyedDispatcher:
+    """
+    Serialises work for the same key in the order that it arrives, while work for
+    different keys runs in parallel.
+
+    Keys are only tracked while they have work in progress, and the number of waiting
+    items is bounded by the number of unacknowledged messages the broker will give us,
+    so memory use is bounded by the channel prefetch.
+    """
+
+    def __init__(self):
+        # For each key with work in progress, the work waiting behind it, as
+        # (enqueued time, waiter) pairs
+        self._queues: Dict[str, Deque[Tuple[float, asyncio.Future]]] = {}
+        self._refresh: Optional[asyncio.TimerHandle] = None
+
+    def __len__(self):
+        return len(self._queues)
+
+    async def acquire(self, key: str) -> None:
+        """
+        Waits until all earlier work for `key` is done. Order is determined when this
+        is called, not when it is awaited.
+        """
+        queue = self._queues.get(key)
+        if queue is None:
+            self._queues[key] = deque()
+            DISPATCH_ACTIVE_KEYS.inc()
+            DISPATCH_KEY_WAIT.observe(0)
+            return
+        start = time.monotonic()
+        waiter = asyncio.get_running_loop().create_future()
+        queue.append((start, waiter))
+        self._update_max_wait()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # It's our turn, but we were cancelled, so give the next one a turn
+                self.release(key)
+            raise
+        DISPATCH_KEY_WAIT.observe(time.monotonic() - start)
+
+    def release(self, key: str) -> None:
+        """
+        Finishes the current work for `key`, starting the next waiting work
+        """
+        queue = self._queues[key]
+        while queue:
+            _, waiter = queue.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+        else:
+            del self._queues[key]
+            DISPATCH_ACTIVE_KEYS.dec()
+        self._update_max_wait()
+
+    def _update_max_wait(self) -> None:
+        oldest = min(
+            (queue[0][0] for queue in self._queues.values() if queue),
+            default=None,
+        )
+        DISPATCH_MAX_KEY_WAIT.set(0 if oldest is None else time.monotonic() - oldest)
+        if oldest is None and self._refresh is not None:
+            self._refresh.cancel()
+            self._refresh = None
+        elif oldest is not None and self._refresh is None:
+            self._refresh = asyncio.get_running_loop().call_later(
+                MAX_KEY_WAIT_REFRESH_INTERVAL, self._refresh_max_wait
+            )
+
+    def _refresh_max_wait(self) -> None:
+        self._refresh = None
+        self._update_max_wait()
+
+    @asynccontextmanager
+    async def serialize(self, key: str):
+        await self.acquire(key)
+        try:
+            yield
+        finally:
+            self.release(key)
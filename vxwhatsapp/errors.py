@@ -0,0 +1,91 @@
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import aiohttp
+from prometheus_client import Counter
+from sanic.log import logger
+
+from vxwhatsapp import config
+
+ERRORS_SUPPRESSED = Counter(
+    "whatsapp_errors_suppressed_total",
+    "Error logs suppressed by the error reporter's rate limit, by error type",
+    ["error"],
+)
+
+
+def error_key(exc: Optional[BaseException]) -> str:
+    """
+    Identifies the type of error, including the status for upstream HTTP errors
+    """
+    if exc is None:
+        return ""
+    if isinstance(exc, aiohttp.ClientResponseError):
+        return f"{type(exc).__name__}:{exc.status}"
+    return type(exc).__name__
+
+
+@dataclass
+class _Window:
+    end: float
+    count: int = 0
+    suppressed: int = 0
+
+
+class ErrorReporter:
+    """
+    Rate limits error logs, and so the Sentry events that they create, so that an
+    upstream outage doesn't flood the loop with formatting and reporting.
+
+    Errors are grouped by log message and error type. For each group, only the first
+    ERROR_REPORT_BURST errors in each ERROR_REPORT_INTERVAL are logged. The rest are
+    counted, and a summary is logged at the end of the interval.
+
+    `clock` and `call_later` default to the monotonic clock and the running loop's
+    scheduler, and can be replaced in tests.
+    """
+
+    def __init__(
+        self,
+        clock: Callable[[], float] = time.monotonic,
+        call_later: Optional[Callable[..., Any]] = None,
+    ):
+        self.interval = config.ERROR_REPORT_INTERVAL
+        self.burst = config.ERROR_REPORT_BURST
+        self.clock = clock
+        self.call_later = call_later
+        self._windows: Dict[Tuple[str, str], _Window] = {}
+
+    def report(self, msg: str, *args: Any, exc: Optional[BaseException] = None):
+        """
+        Logs the error `msg % args`, with the traceback for `exc` if given. Formatting
+        is left to the logger, so suppressed errors are never formatted.
+        """
+        key = (msg, error_key(exc))
+        now = self.clock()
+        window = self._windows.get(key)
+        if window is None or now >= window.end:
+            window = self._windows[key] = _Window(end=now + self.interval)
+        window.count += 1
+        if window.count <= self.burst:
+            logger.error(msg, *args, exc_info=exc)
+            return
+        window.suppressed += 1
+        ERRORS_SUPPRESSED.labels(key[1]).inc()
+        if window.suppressed == 1:
+            call_later = self.call_later or asyncio.get_running_loop().call_later
+            call_later(window.end - now, self._summarise, key, window)
+
+    def _summarise(self, key: Tuple[str, str], window: _Window):
+        if self._windows.get(key) is window:
+            del self._windows[key]
+        msg, error = key
+        logger.warning(
+            "Suppressed %d more %r errors%s in the last %ss",
+            window.suppressed,
+            msg,
+            f" of type {error}" if error else "",
+            self.interval,
+        )
@@ -0,0 +1,105 @@
+import asyncio
+import time
+from typing import Any, Dict, List, Optional
+
+from aio_pika import Connection
+from redis.asyncio import Redis
+from sanic.log import logger
+
+from vxwhatsapp import config
+from vxwhatsapp.loopmonitor import LoopMonitor
+
+
+class HealthProber:
+    """
+    Checks the health of this process's dependencies in the background, so that
+    health check requests, however often they come, only read the last result, and
+    don't add load to Redis.
+
+    The process is ready for traffic if it's healthy, and isn't under backpressure,
+    ie. the event loop lag and number of tasks are within their limits. Only this
+    process's own state is used, as a shared signal would make every replica unready
+    at the same time.
+    """
+
+    def __init__(
+        self,
+        amqp_connection: Connection,
+        redis: Optional[Redis],
+        loop_monitor: Optional[LoopMonitor] = None,
+    ):
+        self.amqp_connection = amqp_connection
+        self.redis = redis
+        self.loop_monitor = loop_monitor
+        self.health: Dict[str, Any] = {"status": "down"}
+        self.not_ready: List[str] = ["Health not checked yet"]
+        self.last_probe = 0.0
+
+    async def setup(self):
+        await self.probe()
+        self.task = asyncio.create_task(self._probe_loop())
+
+    async def teardown(self):
+        self.task.cancel()
+
+    @property
+    def healthy(self) -> bool:
+        return self.health["status"] == "ok"
+
+    @property
+    def ready(self) -> bool:
+        return not self.not_ready
+
+    @property
+    def alive(self) -> bool:
+        """
+        If the prober has stopped probing, then the event loop is stuck
+        """
+        return time.monotonic() - self.last_probe < config.HEALTH_INTERVAL * 3
+
+    async def _probe_loop(self):
+        while True:
+            await asyncio.sleep(config.HEALTH_INTERVAL)
+            try:
+                await self.probe()
+            except Exception:
+                logger.exception("Error checking health")
+                # A failed probe doesn't mean that the loop is stuck
+                self.last_probe = time.monotonic()
+
+    async def probe(self):
+        health: Dict[str, Any] = {"status": "ok", "amqp": {}}
+        amqp_connection = self.amqp_connection
+        if amqp_connection.connection is None:  # pragma: no cover
+            health["amqp"]["connection"] = False
+            health["status"] = "down"
+        else:
+            health["amqp"]["time_since_last_heartbeat"] = (
+                amqp_connection.loop.time() - amqp_connection.heartbeat_last
+            )
+            health["amqp"]["connection"] = True
+
+        if self.redis:
+            health["redis"] = {}
+            try:
+                start = time.monotonic()
+                await asyncio.wait_for(self.redis.ping(), config.HEALTH_TIMEOUT)
+                health["redis"]["response_time"] = time.monotonic() - start
+                health["redis"]["connection"] = True
+            except Exception:
+                health["status"] = "down"
+                health["redis"]["connection"] = False
+
+        not_ready = []
+        if health["status"] != "ok":
+            not_ready.append("Unhealthy")
+        if self.loop_monitor is not None:
+            lag, tasks = self.loop_monitor.lag, self.loop_monitor.tasks
+            if config.READY_MAX_LOOP_LAG and lag > config.READY_MAX_LOOP_LAG:
+                not_ready.append(f"Event loop lag {lag:.3f}s")
+            if config.READY_MAX_TASKS and tasks > config.READY_MAX_TASKS:
+                not_ready.append(f"{tasks} tasks on the event loop")
+
+        self.health = health
+        self.not_ready = not_ready
+        self.last_probe = time.monotonic()
@@ -0,0 +1,95 @@
+import asyncio
+from datetime import datetime, timezone
+from typing import List, Optional
+
+from aio_pika import Channel, Connection
+from prometheus_client import Gauge, Histogram
+from sanic.log import logger
+
+from vxwhatsapp import config
+
+LAG_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+INBOUND_LAG = Histogram(
+    "whatsapp_inbound_lag_sec",
+    "Time from the WhatsApp timestamp to publishing the inbound message or event",
+    ["type"],
+    buckets=LAG_BUCKETS,
+)
+INBOUND_LAG_CURRENT = Gauge(
+    "whatsapp_inbound_lag_current_sec",
+    "Lag of the most recently published inbound message or event",
+    ["type"],
+    multiprocess_mode="liveall",
+)
+OUTBOUND_LAG = Histogram(
+    "whatsapp_outbound_lag_sec",
+    "Time from the Vumi message timestamp to the message being sent to WhatsApp",
+    ["lane"],
+    buckets=LAG_BUCKETS,
+)
+OUTBOUND_LAG_CURRENT = Gauge(
+    "whatsapp_outbound_lag_current_sec",
+    "Lag of the most recently sent outbound message",
+    ["lane"],
+    multiprocess_mode="liveall",
+)
+QUEUE_DEPTH = Gauge(
+    "whatsapp_outbound_queue_depth",
+    "Number of messages waiting in the outbound queues",
+    ["queue"],
+    multiprocess_mode="liveall",
+)
+
+
+def _lag(timestamp: datetime) -> float:
+    return max(0.0, (datetime.now(tz=timezone.utc) - timestamp).total_seconds())
+
+
+def observe_inbound_lag(type: str, timestamp: datetime) -> None:
+    lag = _lag(timestamp)
+    INBOUND_LAG.labels(type).observe(lag)
+    INBOUND_LAG_CURRENT.labels(type).set(lag)
+
+
+def observe_outbound_lag(lane: str, timestamp: datetime) -> None:
+    lag = _lag(timestamp)
+    OUTBOUND_LAG.labels(lane).observe(lag)
+    OUTBOUND_LAG_CURRENT.labels(lane).set(lag)
+
+
+class QueueDepthMonitor:
+    """
+    Periodically samples the number of messages waiting in the outbound queues, using
+    passive queue declares on a channel of its own. A failed declare closes the
+    channel, so it's reopened for the next sample.
+    """
+
+    def __init__(self, connection: Connection, queue_names: List[str]):
+        self.connection = connection
+        self.queue_names = queue_names
+        self.channel: Optional[Channel] = None
+
+    async def setup(self):
+        self.task = asyncio.create_task(self._sample_loop())
+
+    async def teardown(self):
+        self.task.cancel()
+        if self.channel is not None and not self.channel.is_closed:
+            await self.channel.close()
+
+    async def _sample_loop(self):
+        while True:
+            try:
+                await self.sample()
+            except Exception:
+                logger.warning("Unable to sample outbound queue depth", exc_info=True)
+            await asyncio.sleep(config.QUEUE_DEPTH_INTERVAL)
+
+    async def sample(self):
+        if self.channel is None or self.channel.is_closed:
+            self.channel = await self.connection.channel()
+        for queue_name in self.queue_names:
+            queue = await self.channel.declare_queue(queue_name, passive=True)
+            depth = queue.declaration_result.message_count
+            QUEUE_DEPTH.labels(queue_name).set(depth)
@@ -0,0 +1,26 @@
+from typing import Dict
+
+from vxwhatsapp import config
+from vxwhatsapp.models import Message
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+LANES = (INTERACTIVE, BULK)
+
+
+def lane_weights() -> Dict[str, int]:
+    return {
+        INTERACTIVE: config.INTERACTIVE_LANE_WEIGHT,
+        BULK: config.BULK_LANE_WEIGHT,
+    }
+
+
+def message_lane(message: Message, default: str) -> str:
+    """
+    Returns the lane for the message, which is the lane of the queue that it came from,
+    unless the message asks for a lane in its helper metadata
+    """
+    lane = message.helper_metadata.get("lane")
+    if lane in LANES:
+        return lane
+    return default
@@ -0,0 +1,78 @@
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from prometheus_client import Counter
+from redis.asyncio import Redis
+from sanic.log import logger
+
+from vxwhatsapp import config
+
+SEND_LEDGER = Counter(
+    "whatsapp_send_ledger_total",
+    "Outbound send ledger lookups",
+    ["cache", "result"],
+)
+
+
+class SendLedger:
+    """
+    Records which outbound messages have been sent, keyed by the Vumi message ID, so
+    that if a message is redelivered after it was sent, eg. because we died before
+    acking it, it isn't sent again.
+
+    Entries are kept in process, and in Redis so that they're shared with other
+    processes, and both expire after SEND_LEDGER_TTL.
+    """
+
+    def __init__(self, redis: Optional[Redis]):
+        self.redis = redis
+        self._cache: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+
+    async def get(self, message_id: str) -> Optional[str]:
+        """
+        Returns the upstream result of sending the message, or None if it hasn't been
+        sent
+        """
+        entry = self._cache.get(message_id)
+        if entry is not None:
+            result, expiry = entry
+            if expiry >= time.monotonic():
+                SEND_LEDGER.labels("local", "hit").inc()
+                return result
+            del self._cache[message_id]
+        SEND_LEDGER.labels("local", "miss").inc()
+
+        if not self.redis:
+            return None
+        try:
+            result = await self.redis.get(f"msgsent:{message_id}")
+        except Exception:
+            logger.warning("Unable to fetch send ledger from redis", exc_info=True)
+            return None
+        if result is None:
+            SEND_LEDGER.labels("redis", "miss").inc()
+            return None
+        SEND_LEDGER.labels("redis", "hit").inc()
+        self._store_local(message_id, result)
+        return result
+
+    async def record(self, message_id: str, result: str) -> None:
+        """
+        Records that the message has been sent, with the upstream result
+        """
+        self._store_local(message_id, result)
+        if not self.redis:
+            return
+        try:
+            await self.redis.setex(
+                f"msgsent:{message_id}", int(config.SEND_LEDGER_TTL), result
+            )
+        except Exception:
+            logger.warning("Unable to record send in redis", exc_info=True)
+
+    def _store_local(self, message_id: str, result: str) -> None:
+        self._cache[message_id] = (result, time.monotonic() + config.SEND_LEDGER_TTL)
+        self._cache.move_to_end(message_id)
+        while len(self._cache) > config.SEND_LEDGER_CACHE_SIZE:
+            self._cache.popitem(last=False)
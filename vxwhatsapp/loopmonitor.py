@@ -0,0 +1,124 @@
+import asyncio
+import inspect
+import sys
+import threading
+import time
+import traceback
+from types import FrameType
+from typing import List, Optional
+
+from prometheus_client import Counter, Gauge, Histogram
+from sanic.log import logger
+
+from vxwhatsapp import config
+
+LOOP_LAG = Histogram(
+    "whatsapp_event_loop_lag_sec",
+    "Time between scheduling a callback on the event loop and it running",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+LOOP_TASKS = Gauge(
+    "whatsapp_event_loop_tasks",
+    "Number of tasks on the event loop",
+    multiprocess_mode="liveall",
+)
+SLOW_CALLBACKS = Counter(
+    "whatsapp_event_loop_slow_callback_total",
+    "Times that a single callback blocked the event loop for longer than the "
+    "slow callback threshold",
+)
+
+_COROUTINE_FLAGS = (
+    inspect.CO_COROUTINE | inspect.CO_ITERABLE_COROUTINE | inspect.CO_ASYNC_GENERATOR
+)
+
+
+def _describe(frame: FrameType) -> str:
+    code = frame.f_code
+    name = getattr(code, "co_qualname", code.co_name)
+    return f"{name} ({code.co_filename}:{frame.f_lineno})"
+
+
+def blocking_callback(stack: List[FrameType]) -> str:
+    """
+    Identifies the callback that is blocking the loop, given the stack of the loop's
+    thread, outermost frame first. For tasks, this is the task's coroutine, otherwise
+    it's the innermost frame.
+    """
+    for frame in stack:
+        if frame.f_code.co_flags & _COROUTINE_FLAGS:
+            return _describe(frame)
+    return _describe(stack[-1])
+
+
+def _thread_stack(thread_id: int) -> List[FrameType]:
+    stack = []
+    frame: Optional[FrameType] = sys._current_frames().get(thread_id)
+    while frame is not None:
+        stack.append(frame)
+        frame = frame.f_back
+    return stack[::-1]
+
+
+class LoopMonitor:
+    """
+    Watches the event loop from a separate thread, so that it keeps working when the
+    loop is blocked, and adds nothing to the loop's callbacks except its own probe.
+
+    Every interval, a probe is scheduled on the loop, which records how long it waited
+    to run, and the number of tasks. If the probe doesn't run within the slow callback
+    threshold, the loop's thread stack is captured, and the blocking callback logged.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.interval = config.LOOP_MONITOR_INTERVAL
+        self.threshold = config.SLOW_CALLBACK_THRESHOLD
+        self._stopping = threading.Event()
+        # The most recent lag and task count measurements
+        self.lag = 0.0
+        self.tasks = 0
+
+    def start(self):
+        self.loop_thread_id = threading.get_ident()
+        self.thread = threading.Thread(
+            target=self._run, name="loop-monitor", daemon=True
+        )
+        self.thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        self.thread.join()
+
+    def _probe(self, scheduled: float, done: threading.Event):
+        self.lag = time.monotonic() - scheduled
+        LOOP_LAG.observe(self.lag)
+        self.tasks = len(asyncio.all_tasks(self.loop))
+        LOOP_TASKS.set(self.tasks)
+        done.set()
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            done = threading.Event()
+            start = time.monotonic()
+            try:
+                self.loop.call_soon_threadsafe(self._probe, start, done)
+            except RuntimeError:
+                # The loop is closed
+                return
+            if done.wait(self.threshold):
+                continue
+            stack = _thread_stack(self.loop_thread_id)
+            if not stack:  # pragma: no cover
+                continue
+            SLOW_CALLBACKS.inc()
+            logger.warning(
+                "Event loop blocked for more than %s seconds by %s\n%s",
+                self.threshold,
+                blocking_callback(stack),
+                "".join(traceback.format_stack(stack[-1])),
+            )
+            # Wait for the loop to unblock, so that a single slow callback is only
+            # reported once
+            while not done.wait(self.interval) and not self._stopping.is_set():
+                pass
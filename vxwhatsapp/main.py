@@ -1,25 +1,36 @@
-import time
+import errno
 
 import aio_pika
 import redis.asyncio as aioredis
 import sentry_sdk
 from prometheus_client import CONTENT_TYPE_LATEST
-from prometheus_client.exposition import generate_latest
 from sanic import Sanic
+from sanic.log import logger
 from sanic.request import Request
 from sanic.response import HTTPResponse, json, raw
 from sentry_sdk.integrations.sanic import SanicIntegration
 
 from vxwhatsapp import config
+from vxwhatsapp.admin import bp as admin_blueprint
 from vxwhatsapp.consumer import Consumer
-from vxwhatsapp.metrics import setup_metrics_middleware
+from vxwhatsapp.health import HealthProber
+from vxwhatsapp.loopmonitor import LoopMonitor
+from vxwhatsapp.metrics import (
+    process_stopped,
+    render_metrics,
+    setup_metrics_middleware,
+    start_metrics_server,
+)
 from vxwhatsapp.publisher import Publisher
+from vxwhatsapp.roles import CONSUMER, INGRESS, SCHEDULER, enabled
+from vxwhatsapp.tracing import traces_sampler
 from vxwhatsapp.whatsapp import bp as whatsapp_blueprint
 
 sentry_sdk.init(
     dsn=config.SENTRY_DSN,
     integrations=[SanicIntegration()],
     traces_sample_rate=config.SENTRY_TRACES_SAMPLE_RATE,
+    traces_sampler=traces_sampler,
 )
 
 app = Sanic("vxwhatsapp")
@@ -47,50 +58,108 @@ async def shutdown_redis(app, loop):
 async def setup_amqp(app, loop):
     app.ctx.amqp_connection = await aio_pika.connect_robust(config.AMQP_URL, loop=loop)
     app.ctx.publisher = Publisher(app.ctx.amqp_connection, app.ctx.redis)
-    await app.ctx.publisher.setup()
-    app.ctx.consumer = Consumer(app.ctx.amqp_connection, app.ctx.redis)
-    await app.ctx.consumer.setup()
+    await app.ctx.publisher.setup(periodic=enabled(SCHEDULER))
+    app.ctx.consumer = None
+    if enabled(CONSUMER):
+        app.ctx.consumer = Consumer(app.ctx.amqp_connection, app.ctx.redis)
+        await app.ctx.consumer.setup()
 
 
 @app.after_server_stop
 async def shutdown_amqp(app, loop):
-    await app.ctx.amqp_connection.close()
-    await app.ctx.consumer.teardown()
+    # Finish in flight work before closing the sessions and connection it uses
+    if app.ctx.consumer:
+        await app.ctx.consumer.drain()
     await app.ctx.publisher.teardown()
+    if app.ctx.consumer:
+        await app.ctx.consumer.teardown()
+    await app.ctx.amqp_connection.close()
+
+
+@app.before_server_start
+async def setup_metrics_server(app, loop):
+    app.ctx.metrics_server = None
+    if not config.METRICS_PORT:
+        return
+    try:
+        app.ctx.metrics_server = start_metrics_server(config.METRICS_PORT)
+    except OSError as e:
+        if e.errno != errno.EADDRINUSE:
+            raise
+        # With multiple workers, only the first one serves metrics
+        logger.info("Metrics port %s in use by another worker", config.METRICS_PORT)
+
+
+@app.after_server_stop
+async def shutdown_metrics(app, loop):
+    if app.ctx.metrics_server:
+        await loop.run_in_executor(None, app.ctx.metrics_server.shutdown)
+        app.ctx.metrics_server.server_close()
+    process_stopped()
+
+
+@app.before_server_start
+async def setup_loop_monitor(app, loop):
+    app.ctx.loop_monitor = None
+    if config.LOOP_MONITOR_INTERVAL:
+        app.ctx.loop_monitor = LoopMonitor(loop)
+        app.ctx.loop_monitor.start()
+
+
+@app.after_server_stop
+async def shutdown_loop_monitor(app, loop):
+    if app.ctx.loop_monitor:
+        await loop.run_in_executor(None, app.ctx.loop_monitor.stop)
+
+
+@app.before_server_start
+async def setup_health(app, loop):
+    app.ctx.health = HealthProber(
+        app.ctx.amqp_connection,
+        app.ctx.redis,
+        app.ctx.loop_monitor,
+    )
+    await app.ctx.health.setup()
+
+
+@app.after_server_stop
+async def shutdown_health(app, loop):
+    await app.ctx.health.teardown()
 
 
 @app.route("/")
 async def health(request: Request) -> HTTPResponse:
-    result: dict = {"status": "ok", "amqp": {}}
-
-    amqp_connection = app.ctx.amqp_connection  # type: ignore
-    if amqp_connection.connection is None:  # pragma: no cover
-        result["amqp"]["connection"] = False
-        result["status"] = "down"
-    else:
-        result["amqp"]["time_since_last_heartbeat"] = (
-            amqp_connection.loop.time() - amqp_connection.heartbeat_last
-        )
-        result["amqp"]["connection"] = True
-
-    redis = app.ctx.redis  # type: ignore
-    if redis:
-        result["redis"] = {}
-        try:
-            start = time.monotonic()
-            await redis.ping()
-            result["redis"]["response_time"] = time.monotonic() - start
-            result["redis"]["connection"] = True
-        except ConnectionError:  # pragma: no cover
-            result["status"] = "down"
-            result["redis"]["connection"] = False
-
-    return json(result, status=200 if result["status"] == "ok" else 500)
+    health = request.app.ctx.health
+    return json(health.health, status=200 if health.healthy else 500)
+
+
+@app.route("/live")
+async def live(request: Request) -> HTTPResponse:
+    """
+    Whether the process should be restarted. Doesn't depend on anything external,
+    so that an outage doesn't restart everything.
+    """
+    alive = request.app.ctx.health.alive
+    return json({"alive": alive}, status=200 if alive else 500)
+
+
+@app.route("/ready")
+async def ready(request: Request) -> HTTPResponse:
+    """
+    Whether the process should receive traffic
+    """
+    health = request.app.ctx.health
+    return json(
+        {"ready": health.ready, "reasons": health.not_ready},
+        status=200 if health.ready else 503,
+    )
 
 
 @app.route("/metrics")
 async def metrics(request: Request) -> HTTPResponse:
-    return raw(generate_latest(), content_type=CONTENT_TYPE_LATEST)
+    return raw(await render_metrics(), content_type=CONTENT_TYPE_LATEST)
 
 
-app.blueprint(whatsapp_blueprint)
+if enabled(INGRESS):
+    app.blueprint(whatsapp_blueprint)
+app.blueprint(admin_blueprint)
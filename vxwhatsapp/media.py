@@ -0,0 +1,171 @@
+import asyncio
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Dict, Tuple
+
+import aiohttp
+import ujson
+from prometheus_client import Histogram
+
+from vxwhatsapp import config
+
+MEDIA_LATENCY = Histogram(
+    "whatsapp_media_latency_sec",
+    "Outbound media pipeline latency histogram",
+    ["stage"],
+)
+media_queue_latency = MEDIA_LATENCY.labels("queue")
+# Until the media server responds with the headers. The body is streamed straight to
+# the upload, so there's no separate download time for it.
+media_response_latency = MEDIA_LATENCY.labels("download_response")
+# Streaming the body from the media server to the WhatsApp API, until it responds
+media_transfer_latency = MEDIA_LATENCY.labels("transfer")
+media_total_latency = MEDIA_LATENCY.labels("total")
+
+MEDIA_SIZE = Histogram(
+    "whatsapp_media_size_bytes",
+    "Size of outbound media uploaded to the WhatsApp API",
+    buckets=(1e4, 5e4, 1e5, 5e5, 1e6, 5e6, 1e7, 5e7, 1e8),
+)
+
+
+class MediaTooLarge(Exception):
+    pass
+
+
+class _UploadCancelled(Exception):
+    """
+    The task doing a shared upload was cancelled, so the upload should be retried
+    """
+
+
+class MediaPipeline:
+    """
+    Downloads outbound media and uploads it to the WhatsApp API, using its own
+    connection pools, timeouts and concurrency limit, so that slow or large media
+    transfers never hold up the connections used for sending messages.
+
+    Uploaded media IDs are cached for the most recent MEDIA_CACHE_SIZE URLs.
+    """
+
+    def __init__(self, upload_url: str):
+        self.upload_url = upload_url
+        self.cache: "OrderedDict[str, Tuple[str, str]]" = OrderedDict()
+        self.max_size = config.MEDIA_MAX_SIZE
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._semaphore = asyncio.Semaphore(config.MEDIA_CONCURRENCY)
+        timeout = aiohttp.ClientTimeout(
+            total=config.MEDIA_TIMEOUT,
+            sock_connect=config.MEDIA_CONNECT_TIMEOUT,
+            sock_read=config.MEDIA_READ_TIMEOUT,
+        )
+        self.download_session = aiohttp.ClientSession(
+            raise_for_status=True,
+            timeout=timeout,
+            connector=aiohttp.TCPConnector(
+                limit=config.MEDIA_CONCURRENCY,
+                limit_per_host=config.MEDIA_CONCURRENCY,
+            ),
+        )
+        self.upload_session = aiohttp.ClientSession(
+            json_serialize=ujson.dumps,
+            raise_for_status=True,
+            timeout=timeout,
+            connector=aiohttp.TCPConnector(
+                limit=config.MEDIA_CONCURRENCY,
+                limit_per_host=config.MEDIA_CONCURRENCY,
+            ),
+            headers={"Authorization": f"Bearer {config.API_TOKEN}"},
+        )
+
+    async def teardown(self):
+        await self.download_session.close()
+        await self.upload_session.close()
+
+    async def get_media_id(self, media_url: str) -> Tuple[str, str]:
+        """
+        Returns the WhatsApp media ID and content type for `media_url`, uploading the
+        media if we haven't seen it before. Concurrent requests for the same URL share
+        a single upload. If the upload is cancelled, the requests that were sharing it
+        try again.
+        """
+        while True:
+            if media_url in self.cache:
+                self.cache.move_to_end(media_url)
+                return self.cache[media_url]
+            if media_url not in self._pending:
+                break
+            try:
+                return await asyncio.shield(self._pending[media_url])
+            except _UploadCancelled:
+                continue
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[media_url] = future
+        try:
+            with media_total_latency.time():
+                result = await self._upload(media_url)
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                future.set_exception(_UploadCancelled())
+            else:
+                future.set_exception(e)
+            # Mark the exception as retrieved, in case nobody else was waiting
+            future.exception()
+            raise
+        else:
+            self.cache[media_url] = result
+            while len(self.cache) > config.MEDIA_CACHE_SIZE:
+                self.cache.popitem(last=False)
+            future.set_result(result)
+            return result
+        finally:
+            del self._pending[media_url]
+
+    async def _upload(self, media_url: str) -> Tuple[str, str]:
+        with media_queue_latency.time():
+            await self._semaphore.acquire()
+        try:
+            with media_response_latency.time():
+                media_response = await self.download_session.get(media_url)
+            async with media_response:
+                content_length = media_response.content_length
+                if content_length is not None and content_length > self.max_size:
+                    raise MediaTooLarge(
+                        f"{media_url} is {content_length} bytes, larger than the "
+                        f"maximum of {self.max_size}"
+                    )
+                content_type = media_response.headers["Content-Type"]
+                with media_transfer_latency.time():
+                    try:
+                        turn_response = await self.upload_session.post(
+                            self.upload_url,
+                            headers={"Content-Type": content_type},
+                            data=self._limit_size(media_url, media_response.content),
+                        )
+                    except aiohttp.ClientConnectionError as e:
+                        # aiohttp wraps errors raised while streaming the body
+                        if isinstance(e.__cause__, MediaTooLarge):
+                            raise e.__cause__
+                        raise
+                    async with turn_response:
+                        response_data: Any = await turn_response.json()
+            return response_data["media"][0]["id"], content_type
+        finally:
+            self._semaphore.release()
+
+    async def _limit_size(
+        self, media_url: str, content: aiohttp.StreamReader
+    ) -> AsyncIterator[bytes]:
+        """
+        Streams the media content, aborting if it is larger than the maximum size.
+        Servers don't always send a Content-Length, so we can't rely on that alone.
+        """
+        size = 0
+        async for chunk in content.iter_any():
+            size += len(chunk)
+            if size > self.max_size:
+                raise MediaTooLarge(
+                    f"{media_url} is larger than the maximum of {self.max_size} bytes"
+                )
+            yield chunk
+        MEDIA_SIZE.observe(size)
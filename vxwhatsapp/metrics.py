@@ -1,8 +1,30 @@
+import asyncio
+import glob
+import os
+import re
+import threading
 import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
 
-from prometheus_client import Counter, Histogram
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+)
+from prometheus_client.exposition import generate_latest
+from prometheus_client.multiprocess import MultiProcessCollector, mark_process_dead
 from sanic import Sanic
 
+from vxwhatsapp import config
+
+# When set, each process writes its metrics to files in this directory, and they're
+# aggregated across all processes when scraped
+MULTIPROC_DIR_ENV = "prometheus_multiproc_dir"
+
 RQS_COUNT = Counter(
     "sanic_request_count", "Sanic Request Count", ["method", "endpoint", "http_status"]
 )
@@ -13,18 +35,228 @@ RQS_LATENCY = Histogram(
     ["method", "endpoint", "http_status"],
 )
 
+WEBHOOK_STAGE_LATENCY = Histogram(
+    "whatsapp_webhook_stage_latency_sec",
+    "Time spent in each stage of handling a webhook",
+    ["stage"],
+)
+
+OUTBOUND_STAGE_LATENCY = Histogram(
+    "whatsapp_outbound_stage_latency_sec",
+    "Time spent in each stage of processing an outbound message",
+    ["stage", "kind"],
+)
+OUTBOUND_STAGE_IN_FLIGHT = Gauge(
+    "whatsapp_outbound_stage_in_flight",
+    "Number of outbound messages currently in each stage of processing",
+    ["stage"],
+    multiprocess_mode="livesum",
+)
+
+INBOUND_MESSAGES = Counter(
+    "whatsapp_inbound_messages_total",
+    "Inbound messages received from WhatsApp, by WhatsApp message type",
+    ["type"],
+)
+INBOUND_STATUSES = Counter(
+    "whatsapp_inbound_statuses_total",
+    "Message statuses received from WhatsApp, by status",
+    ["status"],
+)
+OUTBOUND_MESSAGES = Counter(
+    "whatsapp_outbound_messages_total",
+    "Outbound messages processed, by kind and result",
+    ["kind", "result"],
+)
+UPSTREAM_ERRORS = Counter(
+    "whatsapp_upstream_errors_total",
+    "Error responses from the WhatsApp API when sending, by HTTP status",
+    ["kind", "status"],
+)
+PAYLOAD_SIZE = Histogram(
+    "whatsapp_payload_size_bytes",
+    "Size of the message payloads published to, and consumed from, AMQP",
+    ["direction", "type"],
+    buckets=(256, 512, 1024, 2048, 4096, 8192, 16384, 65536, 262144, 1048576),
+)
+
+WHATSAPP_RQS_LATENCY = Histogram(
+    "whatsapp_api_request_latency_sec",
+    "WhatsApp API Request Latency Histogram",
+    ["endpoint"],
+)
+
+
+class outbound_stage:
+    """
+    Times a stage of processing an outbound message, of message kind `kind`, and
+    tracks how many messages are in the stage. Use as a context manager, and call
+    `stop` to end the stage early.
+    """
+
+    def __init__(self, stage: str, kind: str):
+        self.stage = stage
+        self.kind = kind
+        self._start: Optional[float] = None
+
+    def __enter__(self) -> "outbound_stage":
+        OUTBOUND_STAGE_IN_FLIGHT.labels(self.stage).inc()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    def stop(self) -> None:
+        if self._start is None:
+            return
+        OUTBOUND_STAGE_LATENCY.labels(self.stage, self.kind).observe(
+            time.perf_counter() - self._start
+        )
+        OUTBOUND_STAGE_IN_FLIGHT.labels(self.stage).dec()
+        self._start = None
+
+
+# The endpoint label for requests that don't match a route
+UNKNOWN_ENDPOINT = "unknown"
+
+
+def request_endpoint(request) -> str:
+    """
+    Returns the route template for the request, so that the number of label values is
+    bounded by the number of routes, not the number of paths that get requested
+    """
+    if request.route is None:
+        return UNKNOWN_ENDPOINT
+    return request.uri_template
+
 
 def setup_metrics_middleware(app: Sanic) -> None:
     @app.middleware("request")
     async def before_request(request):
         if request.path != "/metrics" and request.method != "OPTIONS":
-            request.ctx.start_time = time.time()
+            request.ctx.start_time = time.perf_counter()
 
     @app.middleware("response")
     async def before_response(request, response):
         start_time = getattr(request.ctx, "start_time", None)
         if start_time:
-            RQS_LATENCY.labels(request.method, request.path, response.status).observe(
-                time.time() - request.ctx.start_time
+            endpoint = request_endpoint(request)
+            RQS_LATENCY.labels(request.method, endpoint, response.status).observe(
+                time.perf_counter() - start_time
             )
-            RQS_COUNT.labels(request.method, request.path, response.status).inc()
+            RQS_COUNT.labels(request.method, endpoint, response.status).inc()
+
+
+def multiprocess_enabled() -> bool:
+    return MULTIPROC_DIR_ENV in os.environ
+
+
+def cleanup_dead_processes() -> None:
+    """
+    Removes the live gauge values of processes that have died without cleaning up after
+    themselves
+    """
+    path = os.environ[MULTIPROC_DIR_ENV]
+    pids = set()
+    for filename in glob.glob(os.path.join(path, "gauge_live*_*.db")):
+        match = re.search(r"_(\d+)\.db$", filename)
+        if match:
+            pids.add(int(match.group(1)))
+    for pid in pids:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            mark_process_dead(pid)
+        except PermissionError:  # pragma: no cover
+            # The process exists, but belongs to someone else
+            continue
+
+
+def _render_metrics() -> bytes:
+    if not multiprocess_enabled():
+        return generate_latest(REGISTRY)
+    cleanup_dead_processes()
+    registry = CollectorRegistry()
+    MultiProcessCollector(registry)
+    return generate_latest(registry)
+
+
+class MetricsCache:
+    """
+    Caches rendered metrics for `ttl` seconds, so that frequent or concurrent scrapes
+    don't each pay the cost of rendering
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._rendered = b""
+        self._expires_at = 0.0
+
+    def get(self) -> bytes:
+        with self._lock:
+            if time.monotonic() >= self._expires_at:
+                self._rendered = _render_metrics()
+                self._expires_at = time.monotonic() + self.ttl
+            return self._rendered
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._expires_at = 0.0
+
+
+METRICS_CACHE = MetricsCache(config.METRICS_CACHE_TTL)
+
+
+async def render_metrics() -> bytes:
+    """
+    Renders the metrics, aggregated across all processes in multiprocess mode. This
+    reads and merges files for every process, so it's done in a thread to avoid blocking
+    the event loop.
+    """
+    return await asyncio.get_running_loop().run_in_executor(None, METRICS_CACHE.get)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        output = METRICS_CACHE.get()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE_LATEST)
+        self.send_header("Content-Length", str(len(output)))
+        self.end_headers()
+        self.wfile.write(output)
+
+    def log_message(self, format, *args):
+        # Don't log every scrape
+        pass
+
+
+def start_metrics_server(port: int, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+    """
+    Serves metrics on `port` from a separate thread, so that scrapes don't compete with
+    webhooks for the event loop
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="metrics", daemon=True)
+    thread.start()
+    return server
+
+
+def reset_multiprocess_dir() -> None:
+    """
+    Removes metrics files left over from previous runs. Must be called before any of
+    the processes that write to the directory are started.
+    """
+    if multiprocess_enabled():
+        for filename in glob.glob(os.path.join(os.environ[MULTIPROC_DIR_ENV], "*.db")):
+            os.remove(filename)
+
+
+def process_stopped() -> None:
+    """
+    Removes this process's live gauge values when it stops
+    """
+    if multiprocess_enabled():
+        mark_process_dead(os.getpid())
@@ -0,0 +1,92 @@
+import asyncio
+import cProfile
+import io
+import os
+import pstats
+import sys
+import time
+import tracemalloc
+from collections import Counter
+from types import FrameType
+from typing import Optional
+
+# Frames from the profilers themselves aren't interesting
+_IGNORED_FILES = (tracemalloc.__file__, __file__)
+
+
+def _frame_name(frame: FrameType) -> str:
+    code = frame.f_code
+    name = getattr(code, "co_qualname", code.co_name)
+    return f"{code.co_filename}:{name}"
+
+
+def sample_stacks(thread_id: int, duration: float, interval: float) -> Counter:
+    """
+    Samples the stack of the thread `thread_id` every `interval` seconds, for
+    `duration` seconds, returning the number of times each stack was seen. Stacks are
+    collapsed into a string of semicolon separated frames, outermost first.
+    """
+    samples: Counter = Counter()
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        frame: Optional[FrameType] = sys._current_frames().get(thread_id)
+        names = []
+        while frame is not None:
+            names.append(_frame_name(frame))
+            frame = frame.f_back
+        if names:
+            samples[";".join(reversed(names))] += 1
+        time.sleep(interval)
+    return samples
+
+
+def collapsed_stacks(samples: Counter) -> str:
+    """
+    Formats stack samples in the collapsed stack format used by flame graph tools
+    """
+    return "".join(f"{stack} {count}\n" for stack, count in samples.most_common())
+
+
+async def profile_stats(duration: float, sort: str = "cumulative") -> str:
+    """
+    Runs the deterministic profiler on the event loop's thread for `duration`
+    seconds, and returns the pstats report
+    """
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        await asyncio.sleep(duration)
+    finally:
+        profile.disable()
+    output = io.StringIO()
+    pstats.Stats(profile, stream=output).sort_stats(sort).print_stats(100)
+    return output.getvalue()
+
+
+def allocation_diff(
+    baseline: tracemalloc.Snapshot, group: str = "lineno", limit: int = 25
+) -> str:
+    """
+    Takes a new snapshot, and returns the allocations that grew the most since
+    `baseline`
+    """
+    filters = [tracemalloc.Filter(False, f) for f in _IGNORED_FILES]
+    snapshot = tracemalloc.take_snapshot().filter_traces(filters)
+    stats = snapshot.compare_to(baseline.filter_traces(filters), group)
+    current, peak = tracemalloc.get_traced_memory()
+    lines = [f"pid {os.getpid()}, traced memory {current} bytes, peak {peak} bytes"]
+    for stat in stats[:limit]:
+        lines.append(str(stat))
+        if group == "traceback":
+            lines.extend(f"    {line}" for line in stat.traceback.format())
+    return "\n".join(lines) + "\n"
+
+
+def task_counts() -> Counter:
+    """
+    Returns the number of pending tasks on the running loop, by coroutine
+    """
+    return Counter(
+        getattr(task.get_coro(), "__qualname__", repr(task.get_coro()))
+        for task in asyncio.all_tasks()
+    )
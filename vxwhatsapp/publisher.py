@@ -1,13 +1,18 @@
 import asyncio
 import time
+from contextlib import suppress
+from typing import Optional
 
+import sentry_sdk
 from aio_pika import Connection, DeliveryMode, ExchangeType
 from aio_pika import Message as AMQPMessage
 from redis.asyncio import Redis
 from sanic.log import logger
 
 from vxwhatsapp import config
+from vxwhatsapp.metrics import PAYLOAD_SIZE
 from vxwhatsapp.models import Event, Message
+from vxwhatsapp.tracing import trace_headers
 
 
 class Publisher:
@@ -15,46 +20,71 @@ class Publisher:
         self.connection = connection
         self.redis = redis
 
-    async def setup(self):
+    async def setup(self, periodic: bool = True):
         self.channel = await self.connection.channel()
         self.exchange = await self.channel.declare_exchange(
             "vumi", type=ExchangeType.DIRECT, durable=True, auto_delete=False
         )
-        self.periodic_task = asyncio.create_task(self._periodic_loop())
+        self._stopping = asyncio.Event()
+        self.periodic_task: Optional[asyncio.Task] = None
+        if periodic:
+            self.periodic_task = asyncio.create_task(self._periodic_loop())
 
     async def teardown(self):
-        self.periodic_task.cancel()
+        # Let any session timeout check in progress finish publishing
+        self._stopping.set()
+        if self.periodic_task is None:
+            return
+        _, pending = await asyncio.wait(
+            [self.periodic_task], timeout=config.DRAIN_TIMEOUT
+        )
+        for task in pending:
+            task.cancel()
 
     async def publish_message(self, message: Message):
-        logger.debug(f"Publishing inbound message {message}")
-        await self.exchange.publish(
-            AMQPMessage(
-                message.to_json().encode("utf-8"),
-                delivery_mode=DeliveryMode.PERSISTENT,
-                content_type="application/json",
-                content_encoding="UTF-8",
-            ),
-            routing_key=f"{config.TRANSPORT_NAME}.inbound",
-            timeout=config.PUBLISH_TIMEOUT,
-        )
+        logger.debug("Publishing inbound message %s", message)
+        routing_key = f"{config.TRANSPORT_NAME}.inbound"
+        body = message.to_json().encode("utf-8")
+        PAYLOAD_SIZE.labels(
+            "published",
+            message.transport_metadata.get("message", {}).get("type", "session"),
+        ).observe(len(body))
+        with sentry_sdk.start_span(op="queue.publish", description=routing_key):
+            await self.exchange.publish(
+                AMQPMessage(
+                    body,
+                    delivery_mode=DeliveryMode.PERSISTENT,
+                    content_type="application/json",
+                    content_encoding="UTF-8",
+                    headers=trace_headers(),
+                ),
+                routing_key=routing_key,
+                timeout=config.PUBLISH_TIMEOUT,
+            )
 
     async def publish_event(self, event: Event):
-        logger.debug(f"Publishing inbound event {event}")
-        await self.exchange.publish(
-            AMQPMessage(
-                event.to_json().encode("utf-8"),
-                delivery_mode=DeliveryMode.PERSISTENT,
-                content_type="application/json",
-                content_encoding="UTF-8",
-            ),
-            routing_key=f"{config.TRANSPORT_NAME}.event",
-            timeout=config.PUBLISH_TIMEOUT,
-        )
+        logger.debug("Publishing inbound event %s", event)
+        routing_key = f"{config.TRANSPORT_NAME}.event"
+        body = event.to_json().encode("utf-8")
+        PAYLOAD_SIZE.labels("published", "event").observe(len(body))
+        with sentry_sdk.start_span(op="queue.publish", description=routing_key):
+            await self.exchange.publish(
+                AMQPMessage(
+                    body,
+                    delivery_mode=DeliveryMode.PERSISTENT,
+                    content_type="application/json",
+                    content_encoding="UTF-8",
+                    headers=trace_headers(),
+                ),
+                routing_key=routing_key,
+                timeout=config.PUBLISH_TIMEOUT,
+            )
 
     async def _periodic_loop(self):
-        while True:
+        while not self._stopping.is_set():
             await self._check_for_session_timeouts()
-            await asyncio.sleep(1)
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._stopping.wait(), timeout=1)
 
     async def _check_for_session_timeouts(self):
         if not self.redis:
@@ -0,0 +1,188 @@
+import asyncio
+import os
+import socket
+import time
+from typing import Optional, Tuple
+
+from prometheus_client import Counter, Histogram
+from redis.asyncio import Redis
+from sanic.log import logger
+
+from vxwhatsapp import config
+
+RATE_LIMIT_WAIT = Histogram(
+    "whatsapp_rate_limit_wait_sec",
+    "Time spent waiting for the outbound rate limit",
+)
+RATE_LIMIT_LEASES = Counter(
+    "whatsapp_rate_limit_lease_total",
+    "Token leases requested from the cluster wide rate limiter",
+    ["result"],
+)
+
+# Refills the bucket for the time since it was last used, and then takes as many of
+# the requested tokens as are available. Returns the number of tokens granted, and if
+# none were granted, the number of seconds until a token will be available.
+#
+# Also records the calling process as a member, and returns the number of members
+# that have leased tokens recently, so that each process knows its share of the limit
+# for when Redis is unavailable.
+TOKEN_BUCKET_SCRIPT = """
+redis.replicate_commands()
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+local time = redis.call("TIME")
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "timestamp")
+local tokens = tonumber(bucket[1]) or burst
+local timestamp = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - timestamp) * rate)
+local granted = math.min(requested, math.floor(tokens))
+tokens = tokens - granted
+redis.call("HSET", KEYS[1], "tokens", tostring(tokens), "timestamp", tostring(now))
+redis.call("EXPIRE", KEYS[1], math.ceil(burst / rate) + 1)
+local wait = 0
+if granted == 0 then
+    wait = (1 - tokens) / rate
+end
+local member_timeout = tonumber(ARGV[5])
+redis.call("ZADD", KEYS[2], now, ARGV[4])
+redis.call("ZREMRANGEBYSCORE", KEYS[2], 0, now - member_timeout)
+redis.call("EXPIRE", KEYS[2], math.ceil(member_timeout))
+local members = redis.call("ZCARD", KEYS[2])
+return {granted, tostring(wait), members}
+"""
+
+
+class TokenBucket:
+    """
+    An in process token bucket, used when there's no Redis to share the limit with
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.timestamp = time.monotonic()
+
+    def take(self) -> float:
+        """
+        Takes a token, returning 0 if successful, or else the number of seconds until a
+        token will be available
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.timestamp) * self.rate)
+        self.timestamp = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """
+    A token bucket rate limit on outbound sends, shared across all processes sending
+    for the same WhatsApp number using Redis.
+
+    To keep Redis round trips down, tokens are leased from Redis in batches, and held
+    locally for a short time. If Redis is unavailable, we fall back to a local token
+    bucket until Redis is back. Unless RATE_LIMIT_FALLBACK is set, the local bucket
+    gets this process's share of the limit, divided between the processes that Redis
+    last saw leasing tokens, or RATE_LIMIT_PROCESSES if Redis hasn't been reachable,
+    so that all the processes together stay within the limit.
+    """
+
+    def __init__(self, redis: Optional[Redis], key: str):
+        self.redis = redis
+        self.key = key
+        self.rate = config.RATE_LIMIT
+        self.burst = max(config.RATE_LIMIT_BURST or self.rate, 1)
+        self.lease_size = max(1, min(config.RATE_LIMIT_LEASE, int(self.burst)))
+        self.lease_expiry = config.RATE_LIMIT_LEASE_EXPIRY
+        self.leased = 0
+        self._lease_expires_at = 0.0
+        self._lease_lock = asyncio.Lock()
+        self.member_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._fallback = TokenBucket(self.rate, self.burst)
+        self._set_processes(config.RATE_LIMIT_PROCESSES)
+        self._redis_retry_at = 0.0
+        if self.redis and self.rate > 0:
+            self._script = self.redis.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def _set_processes(self, processes: int) -> None:
+        """
+        Sets the fallback limit to this process's share of the limit
+        """
+        processes = max(processes, 1)
+        if config.RATE_LIMIT_FALLBACK:
+            self._fallback.rate = config.RATE_LIMIT_FALLBACK
+        else:
+            self._fallback.rate = self.rate / processes
+        self._fallback.burst = max(self.burst / processes, 1)
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    async def acquire(self) -> None:
+        """
+        Waits until we're allowed to send another message
+        """
+        if not self.enabled:
+            return
+        with RATE_LIMIT_WAIT.time():
+            while True:
+                wait = await self._take()
+                if wait <= 0:
+                    return
+                await asyncio.sleep(wait)
+
+    async def _take(self) -> float:
+        if not self.redis or time.monotonic() < self._redis_retry_at:
+            return self._fallback.take()
+
+        if self._lease_expires_at < time.monotonic():
+            # Unused tokens from an old lease would allow a burst above the limit
+            self.leased = 0
+        if self.leased > 0:
+            self.leased -= 1
+            return 0
+
+        async with self._lease_lock:
+            # Another task might have leased more tokens while we waited for the lock
+            if self.leased > 0:
+                self.leased -= 1
+                return 0
+            try:
+                granted, wait = await self._lease()
+            except Exception:
+                logger.warning(
+                    "Unable to lease rate limit tokens from redis, falling back to "
+                    "local rate limit",
+                    exc_info=True,
+                )
+                RATE_LIMIT_LEASES.labels("error").inc()
+                self._redis_retry_at = time.monotonic() + config.RATE_LIMIT_REDIS_RETRY
+                return self._fallback.take()
+            if granted == 0:
+                RATE_LIMIT_LEASES.labels("empty").inc()
+                return wait
+            RATE_LIMIT_LEASES.labels("granted").inc()
+            self.leased = granted - 1
+            self._lease_expires_at = time.monotonic() + self.lease_expiry
+            return 0
+
+    async def _lease(self) -> Tuple[int, float]:
+        granted, wait, members = await self._script(
+            keys=[self.key, f"{self.key}:members"],
+            args=[
+                self.rate,
+                self.burst,
+                self.lease_size,
+                self.member_id,
+                config.RATE_LIMIT_MEMBER_TIMEOUT,
+            ],
+        )
+        self._set_processes(int(members))
+        return int(granted), float(wait)
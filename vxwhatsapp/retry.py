@@ -0,0 +1,141 @@
+import random
+from typing import List
+
+from aio_pika import Channel, DeliveryMode, IncomingMessage
+from aio_pika import Message as AMQPMessage
+from prometheus_client import Counter
+
+from vxwhatsapp import config
+from vxwhatsapp.utils import default_exchange
+
+RETRY_COUNT_HEADER = "x-retry-count"
+# Headers that the broker adds when it dead letters a message. They're for the broker's
+# own bookkeeping, and x-death grows with every hop, so they aren't copied.
+DEATH_HEADERS = ("x-death", "x-first-death-", "x-last-death-")
+# The number of delay queues in each tier, spread between half and all of the tier's
+# delay, for jitter
+JITTER_STEPS = 4
+
+RETRY_COUNT = Counter(
+    "whatsapp_outbound_retry_total",
+    "Outbound messages scheduled for a delayed retry",
+    ["tier"],
+)
+RETRY_EXHAUSTED = Counter(
+    "whatsapp_outbound_retry_exhausted_total",
+    "Outbound messages dropped after reaching the maximum retry attempts",
+)
+
+
+def retry_tiers() -> List[float]:
+    """
+    Returns the delays, in seconds, of each of the retry queues
+    """
+    if config.RETRY_BASE_DELAY <= 0:
+        raise ValueError(
+            f"RETRY_BASE_DELAY must be greater than 0, not {config.RETRY_BASE_DELAY}"
+        )
+    tiers = []
+    delay = config.RETRY_BASE_DELAY
+    while delay < config.RETRY_MAX_DELAY:
+        tiers.append(delay)
+        delay *= 2
+    tiers.append(config.RETRY_MAX_DELAY)
+    return tiers
+
+
+def retry_queue_name(queue_name: str, delay: float) -> str:
+    return f"{queue_name}.retry.{int(delay * 1000)}"
+
+
+def retry_delays(tier_delay: float) -> List[float]:
+    """
+    Returns the delays of the queues in the tier with delay `tier_delay`
+    """
+    return [
+        tier_delay * (1 + step / (JITTER_STEPS - 1)) / 2 for step in range(JITTER_STEPS)
+    ]
+
+
+def retry_queue_names(queue_name: str) -> List[str]:
+    names = (
+        retry_queue_name(queue_name, delay)
+        for tier_delay in retry_tiers()
+        for delay in retry_delays(tier_delay)
+    )
+    return list(dict.fromkeys(names))
+
+
+def retry_delay(tier_delay: float) -> float:
+    """
+    Returns a jittered delay for a retry in the tier with delay `tier_delay`, so that
+    messages that failed together don't all come back at the same time
+    """
+    return random.choice(retry_delays(tier_delay))
+
+
+class RetryQueues:
+    """
+    Delayed retries for messages consumed from `queue_name`.
+
+    Each retry tier is a set of queues with message TTLs between half and all of the
+    tier's delay, that dead letter expired messages back onto the original queue. Each
+    retry goes into a random queue in the tier, for jitter. RabbitMQ only expires
+    messages at the head of a queue, so each queue has a single TTL, rather than
+    jittering the TTL per message.
+
+    The number of attempts is tracked in the message headers, and each attempt goes
+    into the next tier up, giving an exponential backoff.
+    """
+
+    def __init__(self, channel: Channel, queue_name: str):
+        self.channel = channel
+        self.queue_name = queue_name
+        self.tiers = retry_tiers()
+
+    async def setup(self):
+        delays = {delay for tier in self.tiers for delay in retry_delays(tier)}
+        for delay in sorted(delays):
+            await self.channel.declare_queue(
+                retry_queue_name(self.queue_name, delay),
+                durable=True,
+                auto_delete=False,
+                arguments={
+                    "x-message-ttl": int(delay * 1000),
+                    "x-dead-letter-exchange": "",
+                    "x-dead-letter-routing-key": self.queue_name,
+                },
+            )
+
+    async def retry(self, message: IncomingMessage) -> bool:
+        """
+        Schedules a delayed retry of `message`. Returns False if the message has
+        reached the maximum number of attempts, and shouldn't be retried.
+
+        The caller is responsible for acknowledging the original message.
+        """
+        headers = {
+            key: value
+            for key, value in (message.headers or {}).items()
+            if not key.startswith(DEATH_HEADERS)
+        }
+        attempt = int(headers.get(RETRY_COUNT_HEADER, 0)) + 1
+        if attempt > config.RETRY_MAX_ATTEMPTS:
+            RETRY_EXHAUSTED.inc()
+            return False
+        headers[RETRY_COUNT_HEADER] = attempt
+
+        tier_delay = self.tiers[min(attempt, len(self.tiers)) - 1]
+        await default_exchange(self.channel).publish(
+            AMQPMessage(
+                message.body,
+                headers=headers,
+                delivery_mode=DeliveryMode.PERSISTENT,
+                content_type=message.content_type,
+                content_encoding=message.content_encoding,
+            ),
+            routing_key=retry_queue_name(self.queue_name, retry_delay(tier_delay)),
+            timeout=config.PUBLISH_TIMEOUT,
+        )
+        RETRY_COUNT.labels(retry_queue_name(self.queue_name, tier_delay)).inc()
+        return True
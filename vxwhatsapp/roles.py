@@ -0,0 +1,13 @@
+from vxwhatsapp import config
+
+# Receives webhooks from the WhatsApp API, and publishes them to AMQP
+INGRESS = "ingress"
+# Consumes outbound messages from AMQP, and sends them to the WhatsApp API
+CONSUMER = "consumer"
+# Runs periodic tasks, like closing timed out sessions
+SCHEDULER = "scheduler"
+ROLES = (INGRESS, CONSUMER, SCHEDULER)
+
+
+def enabled(role: str) -> bool:
+    return role in config.ROLES
@@ -4,6 +4,10 @@ from jsonschema.validators import validator_for
 from sanic.request import Request
 from sanic.response import json
 
+from vxwhatsapp.metrics import WEBHOOK_STAGE_LATENCY
+
+webhook_schema = WEBHOOK_STAGE_LATENCY.labels("schema")
+
 whatsapp_webhook_schema = {
     "$schema": "http://json-schema.org/draft-07/schema#",
     "definitions": {
@@ -254,18 +258,19 @@ def validate_schema(schema: dict):
         @wraps(f)
         def decorated_function(request: Request, *args, **kwargs):
             errors: dict = {}
-            for e in validator.iter_errors(request.json):
-                element = errors
-                path = list(e.path)
-                if not path:
-                    path = ["_root"]
-                for p in path[:-1]:
-                    if p not in element:
-                        element[p] = {}
-                    element = element[p]
-                if path[-1] not in element:
-                    element[path[-1]] = []
-                element[path[-1]].append(e.message)
+            with webhook_schema.time():
+                for e in validator.iter_errors(request.json):
+                    element = errors
+                    path = list(e.path)
+                    if not path:
+                        path = ["_root"]
+                    for p in path[:-1]:
+                        if p not in element:
+                            element[p] = {}
+                        element = element[p]
+                    if path[-1] not in element:
+                        element[path[-1]] = []
+                    element[path[-1]].append(e.message)
             if errors:
                 return json(errors, status=400)
             return f(request, *args, **kwargs)
@@ -0,0 +1,227 @@
+import asyncio
+import hashlib
+import os
+import socket
+import time
+from json.decoder import JSONDecodeError
+from typing import Awaitable, Callable, Dict, List, Optional, Set, cast
+
+import ujson
+from aio_pika import Channel, DeliveryMode, Exchange, IncomingMessage
+from aio_pika import Message as AMQPMessage
+from aio_pika import Queue
+from prometheus_client import Counter, Gauge
+from redis.asyncio import Redis
+from sanic.log import logger
+
+from vxwhatsapp import config
+from vxwhatsapp.dispatch import KeyedDispatcher
+from vxwhatsapp.utils import default_exchange
+
+SHARD_ROUTED = Counter(
+    "whatsapp_outbound_shard_routed_total",
+    "Outbound messages routed to shard queues",
+)
+SHARDS_OWNED = Gauge(
+    "whatsapp_outbound_shards_owned",
+    "Number of outbound shard queues that this process is consuming",
+    multiprocess_mode="livesum",
+)
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+
+def jump_hash(key: str, buckets: int) -> int:
+    """
+    Jump consistent hash (Lamping & Veach), which maps `key` to one of `buckets`
+    buckets, moving as few keys as possible when the number of buckets changes
+    """
+    k = _hash(key)
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        k = (k * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * (float(1 << 31) / float((k >> 33) + 1)))
+    return b
+
+
+def shard_owner(shard: int, members: List[str]) -> str:
+    """
+    Rendezvous hashing of shards to members, so that when a member joins or leaves,
+    only its shards move
+    """
+    return max(members, key=lambda member: _hash(f"{member}:{shard}"))
+
+
+def shard_queue_name(queue_name: str, shard: int) -> str:
+    return f"{queue_name}.shard.{shard}"
+
+
+def router_queue_name(queue_name: str) -> str:
+    return f"{queue_name}.router"
+
+
+async def declare_shard_queues(
+    channel: Channel, queue_name: str, shards: int
+) -> Dict[int, Queue]:
+    """
+    Declares the shard queues. Each has a single active consumer, which keeps the
+    messages to a recipient in order.
+    """
+    return {
+        shard: await channel.declare_queue(
+            shard_queue_name(queue_name, shard),
+            durable=True,
+            auto_delete=False,
+            arguments={"x-single-active-consumer": True},
+        )
+        for shard in range(shards)
+    }
+
+
+class ShardRouter:
+    """
+    Routes messages published to the outbound routing key onto the shard queue for
+    the message's recipient, so that Vumi applications don't need to know about
+    shards.
+
+    The router queue has a single active consumer, so only one process routes
+    messages at a time, which keeps messages to a recipient in order.
+
+    The shard queues must already be declared, with `declare_shard_queues`.
+    """
+
+    def __init__(self, channel: Channel, exchange: Exchange, queue_name: str):
+        self.channel = channel
+        self.exchange = exchange
+        self.queue_name = queue_name
+        self.shards = config.OUTBOUND_SHARDS
+        self.dispatcher = KeyedDispatcher()
+        # Messages that are being routed, for the consumer to wait for when draining
+        self.in_flight: Set[asyncio.Task] = set()
+
+    async def setup(self):
+        self.queue = await self.channel.declare_queue(
+            router_queue_name(self.queue_name),
+            durable=True,
+            auto_delete=False,
+            arguments={"x-single-active-consumer": True},
+        )
+        await self.queue.bind(self.exchange, self.queue_name)
+        self.consumer_tag = await self.queue.consume(self.route_message)
+
+    async def teardown(self):
+        await self.queue.cancel(self.consumer_tag)
+
+    @staticmethod
+    def recipient(body: bytes) -> str:
+        try:
+            return str(ujson.loads(body)["to_addr"])
+        except (JSONDecodeError, ValueError, TypeError, KeyError):
+            # The consumer will reject invalid messages, it doesn't matter which shard
+            # they go to
+            return ""
+
+    async def route_message(self, message: IncomingMessage):
+        task = cast(asyncio.Task, asyncio.current_task())
+        self.in_flight.add(task)
+        try:
+            await self._route_message(message)
+        finally:
+            self.in_flight.discard(task)
+
+    async def _route_message(self, message: IncomingMessage):
+        to_addr = self.recipient(message.body)
+        shard = jump_hash(to_addr, self.shards)
+        # Publish messages for the same recipient in order. There must be no awaits
+        # before this, so that the order is preserved.
+        async with self.dispatcher.serialize(to_addr):
+            try:
+                await default_exchange(self.channel).publish(
+                    AMQPMessage(
+                        message.body,
+                        headers=message.headers,
+                        delivery_mode=DeliveryMode.PERSISTENT,
+                        content_type=message.content_type,
+                        content_encoding=message.content_encoding,
+                        message_id=message.message_id,
+                    ),
+                    routing_key=shard_queue_name(self.queue_name, shard),
+                    timeout=config.PUBLISH_TIMEOUT,
+                )
+            except Exception:
+                logger.exception("Error routing outbound message to shard")
+                await message.reject(requeue=True)
+                return
+            SHARD_ROUTED.inc()
+            await message.ack()
+
+
+class ShardCoordinator:
+    """
+    Decides which shards this process should consume.
+
+    Each process heartbeats its membership into a Redis sorted set, and the shards are
+    divided between the live members using rendezvous hashing. Without Redis, this
+    process claims all the shards, and the single active consumer on each shard queue
+    keeps the ordering.
+    """
+
+    def __init__(
+        self,
+        redis: Optional[Redis],
+        key: str,
+        shards: int,
+        on_change: Callable[[Set[int]], Awaitable[None]],
+    ):
+        self.redis = redis
+        self.key = key
+        self.shards = shards
+        self.on_change = on_change
+        self.member_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.owned: Set[int] = set()
+
+    async def setup(self):
+        await self._rebalance()
+        self.task = asyncio.create_task(self._heartbeat_loop())
+
+    async def teardown(self):
+        self.task.cancel()
+        if self.redis:
+            await self.redis.zrem(self.key, self.member_id)
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(config.SHARD_HEARTBEAT_INTERVAL)
+            try:
+                await self._rebalance()
+            except Exception:
+                logger.exception("Error rebalancing outbound shards")
+
+    async def _members(self) -> List[str]:
+        if not self.redis:
+            return [self.member_id]
+        now = time.time()
+        async with self.redis.pipeline() as pipe:
+            _, _, members = await (
+                pipe.zadd(self.key, {self.member_id: now})
+                .zremrangebyscore(self.key, 0, now - config.SHARD_MEMBER_TIMEOUT)
+                .zrange(self.key, 0, -1)
+                .execute()
+            )
+        return members
+
+    async def _rebalance(self):
+        members = await self._members()
+        owned = {
+            shard
+            for shard in range(self.shards)
+            if shard_owner(shard, members) == self.member_id
+        }
+        if owned != self.owned:
+            logger.info("Consuming outbound shards %s", sorted(owned))
+            await self.on_change(owned)
+            self.owned = owned
+            SHARDS_OWNED.set(len(owned))
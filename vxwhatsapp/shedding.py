@@ -0,0 +1,86 @@
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+from aio_pika import Channel, DeliveryMode, IncomingMessage
+from aio_pika import Message as AMQPMessage
+from prometheus_client import Counter
+
+from vxwhatsapp import config
+from vxwhatsapp.lanes import BULK, INTERACTIVE
+from vxwhatsapp.models import Message
+from vxwhatsapp.utils import default_exchange
+
+SHED_COUNT = Counter(
+    "whatsapp_outbound_shed_total",
+    "Outbound messages not sent because they were older than the lane's maximum age",
+    ["lane"],
+)
+SHED_LANE_HEADER = "x-shed-lane"
+
+
+def lane_max_ages() -> Dict[str, float]:
+    return {
+        INTERACTIVE: config.INTERACTIVE_MAX_AGE,
+        BULK: config.BULK_MAX_AGE,
+    }
+
+
+def message_age(message: Message, now: Optional[datetime] = None) -> float:
+    """
+    Returns how long ago, in seconds, the message was created
+    """
+    now = now or datetime.now(tz=timezone.utc)
+    return (now - message.timestamp).total_seconds()
+
+
+def stale_queue_name(queue_name: str) -> str:
+    return f"{queue_name}.stale"
+
+
+class LoadShedder:
+    """
+    Sheds outbound messages that are too old to be worth sending, so that after an
+    outage we catch up on the backlog quickly, instead of sending replies to users
+    who have long since left.
+
+    Shed messages are dropped, or if configured, moved to a side queue so that they
+    can be inspected or replayed.
+    """
+
+    def __init__(self, channel: Channel, queue_name: str):
+        self.channel = channel
+        self.queue_name = stale_queue_name(queue_name)
+        self.max_ages = lane_max_ages()
+
+    async def setup(self):
+        if config.STALE_QUEUE:
+            await self.channel.declare_queue(
+                self.queue_name, durable=True, auto_delete=False
+            )
+
+    def is_stale(self, message: Message, lane: str) -> bool:
+        max_age = self.max_ages.get(lane, 0)
+        return max_age > 0 and message_age(message) > max_age
+
+    async def shed(self, message: IncomingMessage, lane: str) -> None:
+        """
+        Moves the message to the stale queue, if enabled.
+
+        The caller is responsible for acknowledging the original message.
+        """
+        SHED_COUNT.labels(lane).inc()
+        if not config.STALE_QUEUE:
+            return
+        headers = dict(message.headers or {})
+        headers[SHED_LANE_HEADER] = lane
+        await default_exchange(self.channel).publish(
+            AMQPMessage(
+                message.body,
+                headers=headers,
+                delivery_mode=DeliveryMode.PERSISTENT,
+                content_type=message.content_type,
+                content_encoding=message.content_encoding,
+            ),
+            routing_key=self.queue_name,
+            timeout=config.PUBLISH_TIMEOUT,
+        )
@@ -0,0 +1,119 @@
+"""
+Runs each role in its own set of processes, so that inbound and outbound throughput
+can be scaled independently on the same host.
+
+    python -m vxwhatsapp.supervisor --ingress 4 --consumer 2 --scheduler 1
+
+Each role is a Sanic server with the requested number of worker processes, listening
+on its own port for webhooks, health checks and metrics.
+"""
+
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+from sanic.log import logger
+
+from vxwhatsapp.metrics import reset_multiprocess_dir
+from vxwhatsapp.roles import CONSUMER, INGRESS, ROLES, SCHEDULER
+
+DEFAULT_PORTS = {INGRESS: 8000, CONSUMER: 8001, SCHEDULER: 8002}
+POLL_INTERVAL = 0.5
+
+
+def default_workers() -> Dict[str, int]:
+    cpus = os.cpu_count() or 1
+    # Only one scheduler is needed, the periodic tasks are safe to run concurrently,
+    # but only do duplicate work
+    return {INGRESS: cpus, CONSUMER: cpus, SCHEDULER: 1}
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="0.0.0.0")
+    workers = default_workers()
+    for role in ROLES:
+        parser.add_argument(
+            f"--{role}",
+            type=int,
+            default=workers[role],
+            help=f"Number of {role} processes, defaults to {workers[role]}",
+        )
+        parser.add_argument(
+            f"--{role}-port",
+            type=int,
+            default=DEFAULT_PORTS[role],
+            help=f"Port for the {role} processes, defaults to {DEFAULT_PORTS[role]}",
+        )
+    return parser.parse_args(argv)
+
+
+def role_command(
+    role: str, workers: int, host: str, port: int
+) -> Tuple[List[str], Dict[str, str]]:
+    """
+    Returns the command and environment to run `workers` processes for `role`
+    """
+    command = [
+        sys.executable,
+        "-m",
+        "sanic",
+        "vxwhatsapp.main.app",
+        "--host",
+        host,
+        "--port",
+        str(port),
+        "--workers",
+        str(workers),
+    ]
+    return command, {**os.environ, "ROLES": role}
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    reset_multiprocess_dir()
+    processes: Dict[str, subprocess.Popen] = {}
+    for role in ROLES:
+        workers = getattr(args, role)
+        if workers <= 0:
+            continue
+        command, env = role_command(
+            role, workers, args.host, getattr(args, f"{role}_port")
+        )
+        logger.info("Starting %d %s processes", workers, role)
+        processes[role] = subprocess.Popen(command, env=env)
+
+    def stop(signum, frame):
+        for process in processes.values():
+            if process.poll() is None:
+                process.send_signal(signum)
+
+    handlers = {
+        signum: signal.signal(signum, stop)
+        for signum in (signal.SIGTERM, signal.SIGINT)
+    }
+    try:
+        # If any role exits, stop the others, so that whatever is supervising us can
+        # restart everything
+        exit_code = 0
+        while processes:
+            time.sleep(POLL_INTERVAL)
+            for role, process in list(processes.items()):
+                if process.poll() is None:
+                    continue
+                logger.info("The %s processes exited with %s", role, process.returncode)
+                exit_code = exit_code or process.returncode
+                del processes[role]
+                stop(signal.SIGTERM, None)
+        return exit_code
+    finally:
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    sys.exit(main())
@@ -0,0 +1,135 @@
+import asyncio
+from unittest.mock import MagicMock
+
+import pytest
+
+from vxwhatsapp import config
+from vxwhatsapp.acks import AckBatcher
+
+
+async def _done():
+    pass
+
+
+class FakeMessage:
+    def __init__(self, channel, delivery_tag, log):
+        self.channel = channel
+        self.delivery_tag = delivery_tag
+        self.log = log
+
+    def ack(self, multiple=False):
+        self.log.append(("ack", self.delivery_tag, multiple))
+        return asyncio.create_task(_done())
+
+    def reject(self, requeue=False):
+        self.log.append(("reject", self.delivery_tag, requeue))
+        return asyncio.create_task(_done())
+
+
+def deliver(batcher, channel, tags, log):
+    messages = {tag: FakeMessage(channel, tag, log) for tag in tags}
+    for message in messages.values():
+        batcher.track(message)
+    return messages
+
+
+@pytest.mark.asyncio
+async def test_batched_ack():
+    """
+    A run of processed messages should be acked with a single multiple ack
+    """
+    log: list = []
+    batcher = AckBatcher()
+    messages = deliver(batcher, MagicMock(), [1, 2, 3], log)
+    for message in messages.values():
+        batcher.ack(message)
+    assert log == []
+    batcher.flush()
+    assert log == [("ack", 3, True)]
+    await batcher.teardown()
+
+
+@pytest.mark.asyncio
+async def test_out_of_order():
+    """
+    Processed messages shouldn't be acked while an earlier message is in flight,
+    until they've waited for the batch window
+    """
+    log: list = []
+    batcher = AckBatcher()
+    messages = deliver(batcher, MagicMock(), [1, 2, 3, 4], log)
+    batcher.ack(messages[1])
+    batcher.ack(messages[3])
+    batcher.flush()
+    assert log == [("ack", 1, True)]
+
+    await batcher.reject(messages[2])
+    batcher.ack(messages[4])
+    batcher.flush()
+    assert log == [
+        ("ack", 1, True),
+        ("reject", 2, False),
+        ("ack", 4, True),
+    ]
+    await batcher.teardown()
+
+
+@pytest.mark.asyncio
+async def test_out_of_order_expired():
+    """
+    Processed messages stuck behind a slow message should be acked individually
+    after the batch window
+    """
+    log: list = []
+    batcher = AckBatcher()
+    messages = deliver(batcher, MagicMock(), [1, 2], log)
+    batcher.ack(messages[2])
+    await asyncio.sleep(config.ACK_BATCH_WINDOW * 2)
+    assert log == [("ack", 2, False)]
+    batcher.ack(messages[1])
+    await batcher.teardown()
+    assert log == [("ack", 2, False), ("ack", 1, True)]
+
+
+@pytest.mark.asyncio
+async def test_batch_size():
+    """
+    Reaching the batch size should ack immediately
+    """
+    log: list = []
+    batcher = AckBatcher()
+    messages = deliver(batcher, MagicMock(), range(1, config.ACK_BATCH_SIZE + 1), log)
+    for message in messages.values():
+        batcher.ack(message)
+    assert log == [("ack", config.ACK_BATCH_SIZE, True)]
+    await batcher.teardown()
+
+
+@pytest.mark.asyncio
+async def test_channels():
+    """
+    Delivery tags for different channels should be tracked separately
+    """
+    log: list = []
+    batcher = AckBatcher()
+    channel1 = deliver(batcher, MagicMock(), [1, 2], log)
+    channel2 = deliver(batcher, MagicMock(), [3], log)
+    batcher.ack(channel2[3])
+    batcher.ack(channel1[2])
+    batcher.flush()
+    assert log == [("ack", 3, True)]
+    await batcher.teardown()
+
+
+@pytest.mark.asyncio
+async def test_teardown():
+    """
+    Teardown should ack all processed messages
+    """
+    log: list = []
+    batcher = AckBatcher()
+    messages = deliver(batcher, MagicMock(), [1, 2, 3], log)
+    batcher.ack(messages[1])
+    batcher.ack(messages[3])
+    await batcher.teardown()
+    assert log == [("ack", 1, True), ("ack", 3, False)]
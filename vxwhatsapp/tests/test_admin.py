@@ -0,0 +1,153 @@
+import threading
+import tracemalloc
+
+import pytest
+import pytest_asyncio
+from sanic import Sanic
+
+from vxwhatsapp import config
+from vxwhatsapp.admin import bp
+from vxwhatsapp.tests.utils import run_sanic
+
+HEADERS = {"Authorization": "Bearer secret"}
+
+
+@pytest_asyncio.fixture
+async def admin_server(monkeypatch):
+    monkeypatch.setattr(config, "ADMIN_TOKEN", "secret")
+    Sanic.test_mode = True
+    app = Sanic("admin")
+    app.blueprint(bp)
+    async with run_sanic(app) as server:
+        yield server
+
+
+@pytest.mark.asyncio
+async def test_auth(admin_server, monkeypatch):
+    """
+    Admin routes require the admin token, and are disabled if it isn't configured
+    """
+    response = await admin_server.get("/admin/tasks")
+    assert response.status_code == 401
+    response = await admin_server.get(
+        "/admin/tasks", headers={"Authorization": "Bearer wrong"}
+    )
+    assert response.status_code == 403
+    monkeypatch.setattr(config, "ADMIN_TOKEN", None)
+    response = await admin_server.get("/admin/tasks", headers=HEADERS)
+    assert response.status_code == 403
+
+
+@pytest.mark.asyncio
+async def test_profile_collapsed(admin_server):
+    """
+    Should return sampled stacks in the collapsed format
+    """
+    response = await admin_server.post(
+        "/admin/profile?seconds=0.2&interval=0.01", headers=HEADERS
+    )
+    assert response.status_code == 200
+    stack, count = response.text.splitlines()[0].rsplit(" ", 1)
+    assert int(count) > 0
+    assert ";" in stack
+
+
+@pytest.mark.asyncio
+async def test_profile_pstats(admin_server):
+    """
+    Should return the pstats report
+    """
+    response = await admin_server.post(
+        "/admin/profile?seconds=0.1&format=pstats", headers=HEADERS
+    )
+    assert response.status_code == 200
+    assert "function calls" in response.text
+
+
+@pytest.mark.asyncio
+async def test_profile_invalid(admin_server):
+    response = await admin_server.post("/admin/profile?seconds=600", headers=HEADERS)
+    assert response.status_code == 400
+    response = await admin_server.post("/admin/profile?format=svg", headers=HEADERS)
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_tracemalloc(admin_server):
+    """
+    Should return allocation growth since tracing started
+    """
+    response = await admin_server.get("/admin/tracemalloc/snapshot", headers=HEADERS)
+    assert response.status_code == 400
+
+    response = await admin_server.post("/admin/tracemalloc/start", headers=HEADERS)
+    assert response.json() == {"tracing": True, "frames": 1}
+    try:
+        response = await admin_server.get(
+            "/admin/tracemalloc/snapshot?limit=5", headers=HEADERS
+        )
+        assert response.status_code == 200
+        assert response.text.startswith("pid ")
+
+        response = await admin_server.get(
+            "/admin/tracemalloc/snapshot?limit=0", headers=HEADERS
+        )
+        assert response.status_code == 400
+
+        # An invalid restart shouldn't stop the running trace
+        response = await admin_server.post(
+            "/admin/tracemalloc/start?frames=0", headers=HEADERS
+        )
+        assert response.status_code == 400
+        response = await admin_server.get(
+            "/admin/tracemalloc/snapshot", headers=HEADERS
+        )
+        assert response.status_code == 200
+    finally:
+        response = await admin_server.post("/admin/tracemalloc/stop", headers=HEADERS)
+    assert response.json() == {"tracing": False}
+
+
+@pytest.mark.asyncio
+async def test_tasks(admin_server):
+    response = await admin_server.get("/admin/tasks", headers=HEADERS)
+    assert response.status_code == 200
+    assert all(isinstance(count, int) for count in response.json().values())
+
+
+@pytest.mark.asyncio
+async def test_tracemalloc_off_loop(admin_server, monkeypatch):
+    """
+    Snapshots should be taken in a thread, so that they don't block the loop
+    """
+    threads = []
+    take_snapshot = tracemalloc.take_snapshot
+
+    def record_thread():
+        threads.append(threading.get_ident())
+        return take_snapshot()
+
+    monkeypatch.setattr(tracemalloc, "take_snapshot", record_thread)
+    try:
+        response = await admin_server.post("/admin/tracemalloc/start", headers=HEADERS)
+        assert response.status_code == 200
+        response = await admin_server.get(
+            "/admin/tracemalloc/snapshot", headers=HEADERS
+        )
+        assert response.status_code == 200
+    finally:
+        await admin_server.post("/admin/tracemalloc/stop", headers=HEADERS)
+    assert len(threads) == 2
+    assert threading.get_ident() not in threads
+
+
+@pytest.mark.asyncio
+async def test_profile_already_running(admin_server):
+    """
+    Only one profile should run at a time
+    """
+    async with admin_server.app.ctx.profiling:
+        response = await admin_server.post(
+            "/admin/profile?seconds=0.1", headers=HEADERS
+        )
+    assert response.status_code == 409
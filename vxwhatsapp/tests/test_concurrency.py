@@ -0,0 +1,138 @@
+import asyncio
+
+import aiohttp
+import pytest
+
+from vxwhatsapp.concurrency import AdaptiveLimiter, is_overload_error
+
+
+def test_is_overload_error():
+    """
+    Server errors, throttling, and timeouts are overload errors, client errors aren't
+    """
+
+    def response_error(status):
+        return aiohttp.ClientResponseError(None, (), status=status)
+
+    assert is_overload_error(response_error(500)) is True
+    assert is_overload_error(response_error(429)) is True
+    assert is_overload_error(response_error(404)) is False
+    assert is_overload_error(asyncio.TimeoutError()) is True
+    assert is_overload_error(ValueError()) is False
+
+
+@pytest.mark.asyncio
+async def test_limit():
+    """
+    Should only allow `limit` slots to be held at once, handing out slots in order
+    """
+    limiter = AdaptiveLimiter(initial=2, minimum=1, maximum=2, latency_target=1)
+    await limiter.acquire()
+    await limiter.acquire()
+    waiter1 = asyncio.create_task(limiter.acquire())
+    waiter2 = asyncio.create_task(limiter.acquire())
+    await asyncio.sleep(0)
+    assert not waiter1.done()
+
+    limiter.release(0, False)
+    await asyncio.sleep(0)
+    assert waiter1.done()
+    assert not waiter2.done()
+    waiter2.cancel()
+
+
+@pytest.mark.asyncio
+async def test_additive_increase():
+    """
+    Successful sends while the limit is in use should increase the limit
+    """
+    limiter = AdaptiveLimiter(initial=2, minimum=1, maximum=10, latency_target=1)
+    limits = []
+    limiter.add_listener(limits.append)
+    for _ in range(10):
+        async with limiter.slot():
+            async with limiter.slot():
+                pass
+    assert limiter.current > 2
+    assert limits == list(range(3, limiter.current + 1))
+
+
+@pytest.mark.asyncio
+async def test_multiplicative_decrease():
+    """
+    Overload errors should decrease the limit, once per latency window
+    """
+    limiter = AdaptiveLimiter(initial=10, minimum=1, maximum=10, latency_target=60)
+    for _ in range(2):
+        with pytest.raises(asyncio.TimeoutError):
+            async with limiter.slot():
+                raise asyncio.TimeoutError()
+    assert limiter.current == 7
+    assert limiter.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_weighted_lanes():
+    """
+    When sends are waiting, slots should be shared between lanes by weight
+    """
+    limiter = AdaptiveLimiter(
+        initial=1,
+        minimum=1,
+        maximum=1,
+        latency_target=1,
+        weights={"interactive": 3, "bulk": 1},
+    )
+    order = []
+
+    async def send(lane):
+        async with limiter.slot(lane):
+            order.append(lane)
+            await asyncio.sleep(0)
+
+    await asyncio.gather(
+        *(send("bulk") for _ in range(4)), *(send("interactive") for _ in range(6))
+    )
+    # The first bulk send gets the free slot, then interactive gets 3 slots for every
+    # bulk slot
+    assert order == [
+        "bulk",
+        "interactive",
+        "bulk",
+        "interactive",
+        "interactive",
+        "interactive",
+        "bulk",
+        "interactive",
+        "interactive",
+        "bulk",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_slot_ready():
+    """
+    The ready hook should run once the slot is granted, without counting towards the
+    send latency, and a failure should give the slot back without adjusting the limit
+    """
+    limiter = AdaptiveLimiter(initial=2, minimum=1, maximum=10, latency_target=0.01)
+    in_flight = []
+
+    async def slow_token():
+        in_flight.append(limiter.in_flight)
+        await asyncio.sleep(0.05)
+
+    async with limiter.slot(ready=slow_token):
+        async with limiter.slot():
+            pass
+    assert in_flight == [1]
+    assert limiter.current == 2
+
+    async def no_token():
+        raise asyncio.CancelledError()
+
+    with pytest.raises(asyncio.CancelledError):
+        async with limiter.slot(ready=no_token):
+            pass  # pragma: no cover
+    assert limiter.in_flight == 0
+    assert limiter.current == 2
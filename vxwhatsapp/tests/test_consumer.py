@@ -1,9 +1,10 @@
 import logging
 import time
-from asyncio import Future
+from asyncio import Event, Future, create_task, current_task, sleep, wait_for
 from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
 from io import StringIO
-from unittest.mock import MagicMock
+from unittest.mock import AsyncMock, MagicMock
 
 import pytest
 import pytest_asyncio
@@ -14,8 +15,10 @@ from sanic.log import logger
 from sanic.response import json, text
 
 from vxwhatsapp import config
+from vxwhatsapp.consumer import Consumer, message_kind
 from vxwhatsapp.main import app
 from vxwhatsapp.models import Message
+from vxwhatsapp.sharding import ShardRouter
 from vxwhatsapp.tests.utils import cleanup_amqp, cleanup_redis, run_sanic
 
 
@@ -35,6 +38,7 @@ class TState:
     message_status_code: int = 200
     message_client_error_code: int = 400
     request_count: int = 0
+    throttle_count: int = 0
 
 
 @pytest_asyncio.fixture
@@ -45,8 +49,11 @@ async def whatsapp_mock_server():
 
     @app.route("/v1/messages", methods=["POST"])
     async def messages(request):
-        tstate.future.set_result(request)
         tstate.request_count += 1
+        if tstate.throttle_count > 0:
+            tstate.throttle_count -= 1
+            return json({}, status=429, headers={"Retry-After": "0"})
+        tstate.future.set_result(request)
 
         status_code = tstate.message_status_code
         if request.json["to"] == "27820001003":
@@ -102,7 +109,9 @@ async def media_mock_server():
         yield server
 
 
-async def send_outbound_amqp_message(connection: Connection, message: bytes):
+async def send_outbound_amqp_message(
+    connection: Connection, message: bytes, routing_key="whatsapp.outbound"
+):
     channel = await connection.channel()
     exchange = await channel.declare_exchange(
         "vumi", type=ExchangeType.DIRECT, durable=True, auto_delete=False
@@ -114,12 +123,16 @@ async def send_outbound_amqp_message(connection: Connection, message: bytes):
             content_type="application/json",
             content_encoding="UTF-8",
         ),
-        routing_key="whatsapp.outbound",
+        routing_key=routing_key,
     )
 
 
-async def send_outbound_message(connection: Connection, message: Message):
-    await send_outbound_amqp_message(connection, message.to_json().encode("utf-8"))
+async def send_outbound_message(
+    connection: Connection, message: Message, routing_key="whatsapp.outbound"
+):
+    await send_outbound_amqp_message(
+        connection, message.to_json().encode("utf-8"), routing_key
+    )
 
 
 @pytest.mark.asyncio
@@ -202,6 +215,107 @@ async def test_outbound_text_message_server_error(whatsapp_mock_server, app_serv
     assert whatsapp_mock_server.tstate.request_count == 3
 
 
+@pytest.mark.asyncio
+async def test_outbound_text_message_throttled(whatsapp_mock_server, app_server):
+    """
+    If the whatsapp API throttles us, we should pause, and then retry the message
+    """
+    app_server.app.ctx.consumer.message_url = (
+        f"http://{whatsapp_mock_server.host}:{whatsapp_mock_server.port}/v1/messages"
+    )
+    whatsapp_mock_server.tstate.throttle_count = 1
+    await send_outbound_message(
+        app_server.app.ctx.amqp_connection,
+        Message(
+            to_addr="27820001001",
+            from_addr="27820001002",
+            transport_name="whatsapp",
+            transport_type=Message.TRANSPORT_TYPE.HTTP_API,
+            content="test message",
+        ),
+    )
+    request = await whatsapp_mock_server.tstate.future
+    assert request.json == {"text": {"body": "test message"}, "to": "27820001001"}
+    assert whatsapp_mock_server.tstate.request_count == 2
+
+
+@pytest.mark.asyncio
+async def test_outbound_bulk_lane(whatsapp_mock_server, app_server):
+    """
+    Messages published to the bulk routing key should also be sent
+    """
+    app_server.app.ctx.consumer.message_url = (
+        f"http://{whatsapp_mock_server.host}:{whatsapp_mock_server.port}/v1/messages"
+    )
+    await send_outbound_message(
+        app_server.app.ctx.amqp_connection,
+        Message(
+            to_addr="27820001001",
+            from_addr="27820001002",
+            transport_name="whatsapp",
+            transport_type=Message.TRANSPORT_TYPE.HTTP_API,
+            content="test broadcast",
+        ),
+        routing_key="whatsapp.outbound.bulk",
+    )
+    request = await whatsapp_mock_server.tstate.future
+    assert request.json == {"text": {"body": "test broadcast"}, "to": "27820001001"}
+
+
+@pytest.mark.asyncio
+async def test_outbound_stale_message(whatsapp_mock_server, app_server):
+    """
+    Messages older than the lane's maximum age should be dropped without sending
+    """
+    app_server.app.ctx.consumer.message_url = (
+        f"http://{whatsapp_mock_server.host}:{whatsapp_mock_server.port}/v1/messages"
+    )
+    app_server.app.ctx.consumer.shedder.max_ages["interactive"] = 60
+    for content, age in (("stale message", 120), ("fresh message", 0)):
+        await send_outbound_message(
+            app_server.app.ctx.amqp_connection,
+            Message(
+                to_addr="27820001001",
+                from_addr="27820001002",
+                transport_name="whatsapp",
+                transport_type=Message.TRANSPORT_TYPE.HTTP_API,
+                content=content,
+                timestamp=datetime.now(tz=timezone.utc) - timedelta(seconds=age),
+            ),
+        )
+    request = await whatsapp_mock_server.tstate.future
+    assert request.json == {"text": {"body": "fresh message"}, "to": "27820001001"}
+    assert whatsapp_mock_server.tstate.request_count == 1
+
+
+@pytest.mark.asyncio
+async def test_outbound_redelivered_message(whatsapp_mock_server, app_server):
+    """
+    If a message that has already been sent is redelivered, it shouldn't be sent again
+    """
+    app_server.app.ctx.consumer.message_url = (
+        f"http://{whatsapp_mock_server.host}:{whatsapp_mock_server.port}/v1/messages"
+    )
+    message = Message(
+        to_addr="27820001001",
+        from_addr="27820001002",
+        transport_name="whatsapp",
+        transport_type=Message.TRANSPORT_TYPE.HTTP_API,
+        content="test message",
+    )
+    await send_outbound_message(app_server.app.ctx.amqp_connection, message)
+    await whatsapp_mock_server.tstate.future
+    whatsapp_mock_server.tstate.future = Future()
+
+    await send_outbound_message(app_server.app.ctx.amqp_connection, message)
+    message.message_id = "new-message-id"
+    message.content = "second message"
+    await send_outbound_message(app_server.app.ctx.amqp_connection, message)
+    request = await whatsapp_mock_server.tstate.future
+    assert request.json == {"text": {"body": "second message"}, "to": "27820001001"}
+    assert whatsapp_mock_server.tstate.request_count == 2
+
+
 @pytest.mark.asyncio
 async def test_outbound_text_end_session(whatsapp_mock_server, app_server):
     """
@@ -284,7 +398,7 @@ async def test_outbound_document(whatsapp_mock_server, media_mock_server, app_se
         f"http://{whatsapp_mock_server.host}:{whatsapp_mock_server.port}"
         "/v1/messages/"
     )
-    app_server.app.ctx.consumer.media_url = (
+    app_server.app.ctx.consumer.media.upload_url = (
         f"http://{whatsapp_mock_server.host}:{whatsapp_mock_server.port}/v1/media"
     )
     document_url = (
@@ -318,7 +432,7 @@ async def test_outbound_document_cached(whatsapp_mock_server, app_server):
         "/v1/messages/"
     )
     doc_url = "http://example/org/cached+%26.pdf"
-    app_server.app.ctx.consumer.media_cache[doc_url] = (
+    app_server.app.ctx.consumer.media.cache[doc_url] = (
         "test-media-id",
         "application/pdf",
     )
@@ -349,7 +463,7 @@ async def test_outbound_image(whatsapp_mock_server, media_mock_server, app_serve
         f"http://{whatsapp_mock_server.host}:{whatsapp_mock_server.port}"
         "/v1/messages/"
     )
-    app_server.app.ctx.consumer.media_url = (
+    app_server.app.ctx.consumer.media.upload_url = (
         f"http://{whatsapp_mock_server.host}:{whatsapp_mock_server.port}/v1/media"
     )
     image_url = (
@@ -382,7 +496,7 @@ async def test_outbound_missing_contact(whatsapp_mock_server, app_server):
     app_server.app.ctx.consumer.message_url = (
         f"http://{whatsapp_mock_server.host}:{whatsapp_mock_server.port}/v1/messages"
     )
-    app_server.app.ctx.consumer.contact_url = (
+    app_server.app.ctx.consumer.contacts.url = (
         f"http://{whatsapp_mock_server.host}:{whatsapp_mock_server.port}/v1/contacts"
     )
     whatsapp_mock_server.tstate.message_status_code = 404
@@ -404,7 +518,7 @@ async def test_outbound_missing_contact(whatsapp_mock_server, app_server):
     assert msg1.url == app_server.app.ctx.consumer.message_url
     assert msg1.json == {"text": {"body": "test message"}, "to": "27820001001"}
 
-    assert contact.url == app_server.app.ctx.consumer.contact_url
+    assert contact.url == app_server.app.ctx.consumer.contacts.url
     assert contact.json == {"blocking": "wait", "contacts": ["+27820001001"]}
 
     assert msg2.url == app_server.app.ctx.consumer.message_url
@@ -419,7 +533,7 @@ async def test_outbound_missing_contact_permanent(whatsapp_mock_server, app_serv
     app_server.app.ctx.consumer.message_url = (
         f"http://{whatsapp_mock_server.host}:{whatsapp_mock_server.port}/v1/messages"
     )
-    app_server.app.ctx.consumer.contact_url = (
+    app_server.app.ctx.consumer.contacts.url = (
         f"http://{whatsapp_mock_server.host}:{whatsapp_mock_server.port}/v1/contacts"
     )
     whatsapp_mock_server.tstate.message_status_code = 404
@@ -495,7 +609,7 @@ async def test_buttons_image_header(whatsapp_mock_server, app_server):
         "/v1/messages/"
     )
     image_url = "http://example.org/image.png"
-    app_server.app.ctx.consumer.media_cache[image_url] = ("test-media-id", "image/png")
+    app_server.app.ctx.consumer.media.cache[image_url] = ("test-media-id", "image/png")
     await send_outbound_message(
         app_server.app.ctx.amqp_connection,
         Message(
@@ -537,7 +651,7 @@ async def test_buttons_video_header(whatsapp_mock_server, app_server):
         "/v1/messages/"
     )
     video_url = "http://example.org/video.mp4"
-    app_server.app.ctx.consumer.media_cache[video_url] = ("test-media-id", "video/mp4")
+    app_server.app.ctx.consumer.media.cache[video_url] = ("test-media-id", "video/mp4")
     await send_outbound_message(
         app_server.app.ctx.amqp_connection,
         Message(
@@ -579,7 +693,7 @@ async def test_buttons_document_header(whatsapp_mock_server, app_server):
         "/v1/messages/"
     )
     document_url = "http://example.org/document.pdf"
-    app_server.app.ctx.consumer.media_cache[document_url] = (
+    app_server.app.ctx.consumer.media.cache[document_url] = (
         "test-media-id",
         "application/pdf",
     )
@@ -740,3 +854,241 @@ async def test_outbound_exception(app_server):
     )
 
     assert "Error processing" in log_stream.getvalue()
+
+
+@pytest.mark.asyncio
+async def test_outbound_media_too_large(
+    whatsapp_mock_server, media_mock_server, app_server
+):
+    """
+    If the media is larger than the maximum size, the message should be dropped
+    """
+    log_stream = StringIO()
+    handler = logging.StreamHandler(log_stream)
+    logger.addHandler(handler)
+    app_server.app.ctx.consumer.media.upload_url = (
+        f"http://{whatsapp_mock_server.host}:{whatsapp_mock_server.port}/v1/media"
+    )
+    app_server.app.ctx.consumer.media.max_size = 5
+    document_url = (
+        f"http://{media_mock_server.host}:{media_mock_server.port}/test_document.pdf"
+    )
+
+    async def wait_for_error():
+        while "Error processing" not in log_stream.getvalue():
+            await sleep(0.01)
+
+    try:
+        await send_outbound_message(
+            app_server.app.ctx.amqp_connection,
+            Message(
+                to_addr="27820001001",
+                from_addr="27820001002",
+                transport_name="whatsapp",
+                transport_type=Message.TRANSPORT_TYPE.HTTP_API,
+                helper_metadata={"document": document_url},
+            ),
+        )
+        await wait_for(wait_for_error(), timeout=5)
+    finally:
+        logger.removeHandler(handler)
+    assert "larger than the maximum" in log_stream.getvalue()
+    assert whatsapp_mock_server.tstate.request_count == 0
+    assert document_url not in app_server.app.ctx.consumer.media.cache
+
+
+@pytest.mark.asyncio
+async def test_prefetch_follows_limit(app_server):
+    """
+    When the concurrency limit changes, the broker should change how many messages it
+    delivers to the consumers that are already running
+    """
+    consumer = app_server.app.ctx.consumer
+    delivered = []
+    release = Event()
+
+    async def handle_message(message, queue_lane):
+        delivered.append(message)
+        await release.wait()
+
+    consumer._handle_message = handle_message
+    initial = consumer.limiter.current
+    try:
+        for i in range(initial + 2):
+            await send_outbound_message(
+                app_server.app.ctx.amqp_connection,
+                Message(
+                    to_addr=f"2782000{i:04}",
+                    from_addr="27820001002",
+                    transport_name="whatsapp",
+                    transport_type=Message.TRANSPORT_TYPE.HTTP_API,
+                    content="test message",
+                ),
+            )
+        await sleep(0.5)
+        assert len(delivered) == initial
+
+        consumer.limiter.limit = initial + 2
+        consumer._update_prefetch(consumer.limiter.current)
+        await wait_for(consumer._prefetch_task, 5)
+        await sleep(0.5)
+        assert len(delivered) == initial + 2
+    finally:
+        release.set()
+
+
+@pytest.mark.asyncio
+async def test_drain():
+    """
+    Draining should stop consuming, wait for in flight messages, and abandon any that
+    take longer than the drain timeout
+    """
+    consumer = Consumer(MagicMock(), None)
+    consumer.queue = MagicMock(cancel=AsyncMock())
+    consumer.bulk_queue = MagicMock(cancel=AsyncMock())
+    consumer.consumer_tag = "outbound"
+    consumer.bulk_consumer_tag = "bulk"
+    finished = []
+
+    async def process(delay):
+        consumer._in_flight.add(current_task())
+        await sleep(delay)
+        finished.append(delay)
+
+    fast, slow = create_task(process(0)), create_task(process(10))
+    await sleep(0)
+    drain_timeout = config.DRAIN_TIMEOUT
+    config.DRAIN_TIMEOUT = 0.1
+    try:
+        await consumer.drain()
+    finally:
+        config.DRAIN_TIMEOUT = drain_timeout
+        await consumer.teardown()
+
+    consumer.queue.cancel.assert_awaited_once_with("outbound")
+    consumer.bulk_queue.cancel.assert_awaited_once_with("bulk")
+    assert fast.done() and slow.cancelled()
+    assert finished == [0]
+
+
+@pytest.mark.asyncio
+async def test_drain_shard_router(monkeypatch):
+    """
+    Draining should wait for messages that are being routed to shards
+    """
+    monkeypatch.setattr(config, "OUTBOUND_SHARDS", 2)
+    consumer = Consumer(MagicMock(), None)
+    consumer.queue = MagicMock(cancel=AsyncMock())
+    consumer.bulk_queue = MagicMock(cancel=AsyncMock())
+    consumer.consumer_tag = "outbound"
+    consumer.bulk_consumer_tag = "bulk"
+    consumer.shard_coordinator = MagicMock(teardown=AsyncMock())
+    consumer.shard_consumer_tags = {}
+
+    async def publish(*args, **kwargs):
+        await sleep(0.05)
+
+    channel = MagicMock()
+    channel.default_exchange.publish = publish
+    consumer.router = ShardRouter(channel, MagicMock(), "whatsapp.outbound")
+    consumer.router.queue = MagicMock(cancel=AsyncMock())
+    consumer.router.consumer_tag = "router"
+    message = MagicMock(body=b'{"to_addr": "27820001001"}', ack=AsyncMock())
+    routing = create_task(consumer.router.route_message(message))
+    await sleep(0)
+    try:
+        await consumer.drain()
+    finally:
+        await consumer.teardown()
+
+    assert routing.done()
+    message.ack.assert_awaited_once()
+    assert consumer.router.in_flight == set()
+
+
+@pytest.mark.asyncio
+async def test_invalid_contact_rate_limited():
+    """
+    Messages to invalid contacts should be reported through the error reporter, so
+    that they're rate limited
+    """
+    consumer = Consumer(MagicMock(), None)
+    consumer.contacts.cached = MagicMock(return_value="invalid")
+    consumer.errors.report = MagicMock()
+    try:
+        await consumer.submit_message(
+            Message(
+                to_addr="27820001001",
+                from_addr="27820001002",
+                transport_name="whatsapp",
+                transport_type=Message.TRANSPORT_TYPE.HTTP_API,
+                content="test message",
+            )
+        )
+    finally:
+        await consumer.teardown()
+    consumer.errors.report.assert_called_once_with(
+        "Contact %s not on whatsapp", "27820001001"
+    )
+
+
+def test_message_kind():
+    """
+    The kind should match the type of WhatsApp message that will be sent
+    """
+
+    def kind(**helper_metadata):
+        return message_kind(
+            Message(
+                to_addr="27820001001",
+                from_addr="27820001002",
+                transport_name="whatsapp",
+                transport_type=Message.TRANSPORT_TYPE.HTTP_API,
+                helper_metadata=helper_metadata,
+            )
+        )
+
+    assert kind() == "text"
+    assert kind(buttons=["a"]) == "buttons"
+    assert kind(sections=[], button="a") == "list"
+    assert kind(document="http://example.org/a.pdf") == "document"
+    assert kind(image="http://example.org/a.png") == "image"
+
+
+@pytest.mark.asyncio
+async def test_build_payload_media():
+    """
+    Media that has already been uploaded should be used in the payload
+    """
+    consumer = Consumer(MagicMock(), None)
+    try:
+        message = Message(
+            to_addr="27820001001",
+            from_addr="27820001002",
+            transport_name="whatsapp",
+            transport_type=Message.TRANSPORT_TYPE.HTTP_API,
+            content="body",
+            helper_metadata={
+                "buttons": ["a"],
+                "header": "http://example.org/header.mp4",
+            },
+        )
+        assert consumer._media_url(message) == "http://example.org/header.mp4"
+        data = consumer.build_payload(message, "media-id", "video/mp4")
+        assert data["interactive"]["header"] == {
+            "type": "video",
+            "video": {"id": "media-id"},
+        }
+
+        message.helper_metadata = {"image": "http://example.org/image.png"}
+        assert consumer._media_url(message) == "http://example.org/image.png"
+        assert consumer.build_payload(message, "media-id", "image/png") == {
+            "to": "27820001001",
+            "type": "image",
+            "image": {"id": "media-id", "caption": "body"},
+        }
+
+        message.helper_metadata = {"buttons": ["a"], "header": "text header"}
+        assert consumer._media_url(message) is None
+    finally:
+        await consumer.teardown()
@@ -0,0 +1,135 @@
+import asyncio
+from asyncio import gather
+
+import aiohttp
+import pytest
+import pytest_asyncio
+from sanic import Sanic
+from sanic.response import json
+
+from vxwhatsapp.contacts import ContactChecker
+from vxwhatsapp.tests.utils import run_sanic
+
+
+@pytest_asyncio.fixture
+async def contacts_mock_server():
+    Sanic.test_mode = True
+    app = Sanic("mock_contacts")
+    app.ctx.requests = []
+
+    @app.route("/v1/contacts", methods=["POST"])
+    async def contact_check(request):
+        app.ctx.requests.append(request.json)
+        return json(
+            {
+                "contacts": [
+                    {
+                        "wa_id": msisdn.lstrip("+"),
+                        "input": msisdn,
+                        "status": "invalid" if msisdn == "+27820001111" else "valid",
+                    }
+                    for msisdn in request.json["contacts"]
+                ]
+            }
+        )
+
+    async with run_sanic(app) as server:
+        yield server
+
+
+@pytest_asyncio.fixture
+async def checker(contacts_mock_server):
+    session = aiohttp.ClientSession(raise_for_status=True)
+    url = f"http://{contacts_mock_server.host}:{contacts_mock_server.port}/v1/contacts"
+    checker = ContactChecker(session, url, None)
+    yield checker
+    await checker.teardown()
+    await session.close()
+
+
+@pytest.mark.asyncio
+async def test_check_batches_concurrent_checks(checker, contacts_mock_server):
+    """
+    Concurrent checks should be merged into a single API request
+    """
+    results = await gather(
+        checker.check("27820001001"),
+        checker.check("+27820001111"),
+        checker.check("27820001001"),
+    )
+    assert results == ["valid", "invalid", "valid"]
+    assert contacts_mock_server.app.ctx.requests == [
+        {"blocking": "wait", "contacts": ["+27820001001", "+27820001111"]}
+    ]
+
+
+@pytest.mark.asyncio
+async def test_check_cached(checker, contacts_mock_server):
+    """
+    Checks should be cached, unless a refresh is requested
+    """
+    assert checker.cached("27820001001") is None
+    assert await checker.check("27820001001") == "valid"
+    assert checker.cached("27820001001") == "valid"
+    assert await checker.check("27820001001") == "valid"
+    assert len(contacts_mock_server.app.ctx.requests) == 1
+
+    assert await checker.check("27820001001", refresh=True) == "valid"
+    assert len(contacts_mock_server.app.ctx.requests) == 2
+
+
+@pytest.mark.asyncio
+async def test_mark_valid(checker, contacts_mock_server):
+    """
+    Contacts that are marked as valid shouldn't need to be checked
+    """
+    checker.mark_valid("27820001002")
+    assert await checker.check("+27820001002") == "valid"
+    assert contacts_mock_server.app.ctx.requests == []
+
+
+@pytest.mark.asyncio
+async def test_refresh_while_check_in_flight(checker, monkeypatch):
+    """
+    A refresh shouldn't share a check that has already started without one
+    """
+    batches = []
+    release = asyncio.Event()
+
+    async def check_api(batch):
+        batches.append(batch)
+        await release.wait()
+        return {address: "valid" for address in batch}
+
+    monkeypatch.setattr(checker, "_check_api", check_api)
+    check = asyncio.create_task(checker.check("27820001001"))
+    while not batches:
+        await asyncio.sleep(0.01)
+    refresh = asyncio.create_task(checker.check("27820001001", refresh=True))
+    while len(batches) < 2:
+        await asyncio.sleep(0.01)
+    release.set()
+    assert await gather(check, refresh) == ["valid", "valid"]
+    assert batches == [["+27820001001"], ["+27820001001"]]
+    assert checker._pending == {}
+
+
+@pytest.mark.asyncio
+async def test_cancelled_check(checker, monkeypatch):
+    """
+    If a batch check is cancelled, the checks waiting on it shouldn't wait forever
+    """
+    started = asyncio.Event()
+
+    async def check_api(batch):
+        started.set()
+        await asyncio.sleep(10)
+
+    monkeypatch.setattr(checker, "_check_api", check_api)
+    check = asyncio.create_task(checker.check("27820001001"))
+    await started.wait()
+    for task in checker._tasks:
+        task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await asyncio.wait_for(check, 1)
+    assert checker._pending == {}
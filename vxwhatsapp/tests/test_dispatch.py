@@ -0,0 +1,78 @@
+import asyncio
+
+import pytest
+from prometheus_client import REGISTRY
+
+from vxwhatsapp import dispatch
+from vxwhatsapp.dispatch import KeyedDispatcher
+
+
+@pytest.mark.asyncio
+async def test_serialize_same_key():
+    """
+    Work for the same key should run one at a time, in the order it arrived
+    """
+    dispatcher = KeyedDispatcher()
+    events = []
+
+    async def work(key, name, delay):
+        async with dispatcher.serialize(key):
+            events.append(f"start {name}")
+            await asyncio.sleep(delay)
+            events.append(f"end {name}")
+
+    await asyncio.gather(
+        work("a", "a1", 0.02), work("a", "a2", 0), work("b", "b1", 0.01)
+    )
+    assert events == [
+        "start a1",
+        "start b1",
+        "end b1",
+        "end a1",
+        "start a2",
+        "end a2",
+    ]
+    assert len(dispatcher) == 0
+
+
+@pytest.mark.asyncio
+async def test_cancelled_waiter():
+    """
+    If waiting work is cancelled, the work after it should still run
+    """
+    dispatcher = KeyedDispatcher()
+    await dispatcher.acquire("a")
+    waiter1 = asyncio.create_task(dispatcher.acquire("a"))
+    waiter2 = asyncio.create_task(dispatcher.acquire("a"))
+    await asyncio.sleep(0)
+    waiter1.cancel()
+    dispatcher.release("a")
+    await waiter2
+    dispatcher.release("a")
+    assert len(dispatcher) == 0
+
+
+@pytest.mark.asyncio
+async def test_max_key_wait_refresh(monkeypatch):
+    """
+    The max key wait should keep growing while a message is stuck waiting, even if
+    nothing else happens
+    """
+    monkeypatch.setattr(dispatch, "MAX_KEY_WAIT_REFRESH_INTERVAL", 0.01)
+
+    def max_wait():
+        return REGISTRY.get_sample_value("whatsapp_dispatch_max_key_wait_sec")
+
+    dispatcher = KeyedDispatcher()
+    await dispatcher.acquire("27820001001")
+    waiter = asyncio.create_task(dispatcher.acquire("27820001001"))
+    await asyncio.sleep(0)
+    initial = max_wait()
+    await asyncio.sleep(0.05)
+    assert max_wait() > initial
+
+    dispatcher.release("27820001001")
+    await waiter
+    dispatcher.release("27820001001")
+    assert max_wait() == 0
+    assert dispatcher._refresh is None
@@ -0,0 +1,57 @@
+import logging
+
+import aiohttp
+
+from vxwhatsapp import config
+from vxwhatsapp.errors import ErrorReporter, error_key
+
+
+def test_error_key():
+    """
+    Upstream HTTP errors should include the status
+    """
+    assert error_key(None) == ""
+    assert error_key(ValueError()) == "ValueError"
+    error = aiohttp.ClientResponseError(None, (), status=503)
+    assert error_key(error) == "ClientResponseError:503"
+
+
+def test_report(monkeypatch, caplog):
+    """
+    Should only log the first errors of each type in each interval, and then
+    summarise the rest
+    """
+    monkeypatch.setattr(config, "ERROR_REPORT_INTERVAL", 0.5)
+    monkeypatch.setattr(config, "ERROR_REPORT_BURST", 2)
+    now = [100.0]
+    scheduled = []
+    reporter = ErrorReporter(
+        clock=lambda: now[0],
+        call_later=lambda delay, *callback: scheduled.append((delay, callback)),
+    )
+    with caplog.at_level(logging.WARNING):
+        for i in range(5):
+            reporter.report("Error processing %s", i, exc=ValueError("bad"))
+        reporter.report("Error processing %s", 5, exc=KeyError("bad"))
+
+        # The summary is only scheduled once, for the end of the interval
+        assert len(scheduled) == 1
+        delay, (summarise, *args) = scheduled[0]
+        assert delay == 0.5
+        now[0] += delay
+        summarise(*args)
+
+    messages = [r.getMessage() for r in caplog.records]
+    assert messages == [
+        "Error processing 0",
+        "Error processing 1",
+        "Error processing 5",
+        "Suppressed 3 more 'Error processing %s' errors of type ValueError in the "
+        "last 0.5s",
+    ]
+    assert "ValueError: bad" in caplog.text
+
+    # A new interval starts logging again
+    with caplog.at_level(logging.WARNING):
+        reporter.report("Error processing %s", 6, exc=ValueError("bad"))
+    assert caplog.records[-1].getMessage() == "Error processing 6"
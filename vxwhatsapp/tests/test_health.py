@@ -0,0 +1,87 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from vxwhatsapp import config
+from vxwhatsapp.health import HealthProber
+
+
+def amqp_connection():
+    connection = MagicMock()
+    connection.loop.time.return_value = 10.0
+    connection.heartbeat_last = 8.0
+    return connection
+
+
+@pytest.mark.asyncio
+async def test_probe():
+    """
+    Should cache the health of the dependencies
+    """
+    redis = AsyncMock()
+    prober = HealthProber(amqp_connection(), redis)
+    assert not prober.ready
+    await prober.probe()
+    redis.ping.assert_awaited_once()
+    assert prober.healthy
+    assert prober.ready
+    assert prober.alive
+    response_time = prober.health["redis"].pop("response_time")
+    assert isinstance(response_time, float)
+    assert prober.health == {
+        "status": "ok",
+        "amqp": {"connection": True, "time_since_last_heartbeat": 2.0},
+        "redis": {"connection": True},
+    }
+
+
+@pytest.mark.asyncio
+async def test_probe_redis_down():
+    """
+    If redis is down, the process is unhealthy and not ready
+    """
+    redis = AsyncMock()
+    redis.ping.side_effect = ConnectionError()
+    prober = HealthProber(amqp_connection(), redis)
+    await prober.probe()
+    assert not prober.healthy
+    assert prober.health["redis"] == {"connection": False}
+    assert prober.not_ready == ["Unhealthy"]
+
+
+@pytest.mark.asyncio
+async def test_backpressure(monkeypatch):
+    """
+    If the loop lag or number of tasks are over their limits, the process isn't ready
+    """
+    monkeypatch.setattr(config, "READY_MAX_LOOP_LAG", 1)
+    monkeypatch.setattr(config, "READY_MAX_TASKS", 100)
+    loop_monitor = MagicMock(lag=0.5, tasks=100)
+    prober = HealthProber(amqp_connection(), None, loop_monitor)
+    await prober.probe()
+    assert prober.ready
+
+    loop_monitor.lag = 1.5
+    loop_monitor.tasks = 101
+    await prober.probe()
+    assert prober.healthy
+    assert prober.not_ready == ["Event loop lag 1.500s", "101 tasks on the event loop"]
+
+
+@pytest.mark.asyncio
+async def test_alive_when_probe_fails(monkeypatch):
+    """
+    A probe that errors shouldn't make the process look stuck
+    """
+    monkeypatch.setattr(config, "HEALTH_INTERVAL", 0.01)
+    prober = HealthProber(amqp_connection(), None)
+    prober.probe = AsyncMock(side_effect=RuntimeError())
+    assert not prober.alive
+    task = asyncio.create_task(prober._probe_loop())
+    try:
+        await asyncio.sleep(0.05)
+    finally:
+        task.cancel()
+    assert prober.probe.await_count > 0
+    assert prober.alive
@@ -0,0 +1,66 @@
+from datetime import datetime, timedelta, timezone
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+from prometheus_client import REGISTRY
+
+from vxwhatsapp.lag import QueueDepthMonitor, observe_inbound_lag, observe_outbound_lag
+
+
+def test_observe_lag():
+    """
+    Should record the time since the timestamp, in the histogram and current gauge
+    """
+    now = datetime.now(tz=timezone.utc)
+    observe_inbound_lag("message", now - timedelta(seconds=30))
+    lag = REGISTRY.get_sample_value(
+        "whatsapp_inbound_lag_current_sec", {"type": "message"}
+    )
+    assert 30 <= lag < 40
+
+    observe_outbound_lag("bulk", now + timedelta(seconds=5))
+    assert (
+        REGISTRY.get_sample_value("whatsapp_outbound_lag_current_sec", {"lane": "bulk"})
+        == 0
+    )
+
+
+@pytest.mark.asyncio
+async def test_queue_depth():
+    """
+    Should passively declare each queue, and record its message count
+    """
+    queue = MagicMock()
+    queue.declaration_result.message_count = 7
+    channel = AsyncMock(is_closed=False)
+    channel.declare_queue.return_value = queue
+    connection = AsyncMock()
+    connection.channel.return_value = channel
+    monitor = QueueDepthMonitor(connection, ["test.outbound", "test.outbound.bulk"])
+
+    await monitor.sample()
+    channel.declare_queue.assert_any_await("test.outbound.bulk", passive=True)
+    assert (
+        REGISTRY.get_sample_value(
+            "whatsapp_outbound_queue_depth", {"queue": "test.outbound"}
+        )
+        == 7
+    )
+
+
+@pytest.mark.asyncio
+async def test_queue_depth_reopens_channel():
+    """
+    If a failed declare closed the channel, the next sample should open a new one
+    """
+    closed = AsyncMock(is_closed=True)
+    channel = AsyncMock(is_closed=False)
+    connection = AsyncMock()
+    connection.channel.return_value = channel
+    monitor = QueueDepthMonitor(connection, ["test.outbound"])
+    monitor.channel = closed
+
+    await monitor.sample()
+    closed.declare_queue.assert_not_awaited()
+    channel.declare_queue.assert_awaited_once_with("test.outbound", passive=True)
+    assert monitor.channel is channel
@@ -0,0 +1,22 @@
+from vxwhatsapp.lanes import BULK, INTERACTIVE, message_lane
+from vxwhatsapp.models import Message
+
+
+def test_message_lane():
+    """
+    The lane in the helper metadata should override the queue's lane, if it's valid
+    """
+
+    def message(**helper_metadata):
+        return Message(
+            to_addr="27820001001",
+            from_addr="27820001002",
+            transport_name="whatsapp",
+            transport_type=Message.TRANSPORT_TYPE.HTTP_API,
+            helper_metadata=helper_metadata,
+        )
+
+    assert message_lane(message(), INTERACTIVE) == INTERACTIVE
+    assert message_lane(message(), BULK) == BULK
+    assert message_lane(message(lane="bulk"), INTERACTIVE) == BULK
+    assert message_lane(message(lane="invalid"), INTERACTIVE) == INTERACTIVE
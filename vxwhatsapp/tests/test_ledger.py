@@ -0,0 +1,72 @@
+from typing import AsyncGenerator
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+import pytest_asyncio
+from redis.asyncio import Redis, from_url
+
+from vxwhatsapp import config
+from vxwhatsapp.ledger import SendLedger
+from vxwhatsapp.tests.utils import cleanup_redis
+
+
+@pytest_asyncio.fixture
+async def redis() -> AsyncGenerator[Redis, None]:
+    conn = from_url(
+        config.REDIS_URL or "redis://", encoding="utf8", decode_responses=True
+    )
+    yield conn
+    await conn.close()
+    await cleanup_redis()
+
+
+@pytest.mark.asyncio
+async def test_record_local():
+    """
+    Without redis, sends should be recorded in process
+    """
+    ledger = SendLedger(None)
+    assert await ledger.get("msg1") is None
+    await ledger.record("msg1", "wamid.1")
+    assert await ledger.get("msg1") == "wamid.1"
+
+
+@pytest.mark.asyncio
+async def test_record_shared(redis):
+    """
+    Sends recorded by one process should be seen by other processes, with an expiry
+    """
+    await SendLedger(redis).record("msg1", "wamid.1")
+    assert await SendLedger(redis).get("msg1") == "wamid.1"
+    assert 0 < await redis.ttl("msgsent:msg1") <= config.SEND_LEDGER_TTL
+
+
+@pytest.mark.asyncio
+async def test_cache_size():
+    """
+    The oldest entries should be evicted when the cache is full
+    """
+    size = config.SEND_LEDGER_CACHE_SIZE
+    config.SEND_LEDGER_CACHE_SIZE = 2
+    try:
+        ledger = SendLedger(None)
+        for message_id in ("msg1", "msg2", "msg3"):
+            await ledger.record(message_id, "sent")
+    finally:
+        config.SEND_LEDGER_CACHE_SIZE = size
+    assert await ledger.get("msg1") is None
+    assert await ledger.get("msg3") == "sent"
+
+
+@pytest.mark.asyncio
+async def test_redis_error():
+    """
+    If redis is unavailable, we should fall back to the local ledger
+    """
+    redis = MagicMock()
+    redis.get = AsyncMock(side_effect=ConnectionError())
+    redis.setex = AsyncMock(side_effect=ConnectionError())
+    ledger = SendLedger(redis)
+    assert await ledger.get("msg1") is None
+    await ledger.record("msg1", "sent")
+    assert await ledger.get("msg1") == "sent"
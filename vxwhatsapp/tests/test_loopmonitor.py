@@ -0,0 +1,43 @@
+import asyncio
+import logging
+import time
+
+import pytest
+from prometheus_client import REGISTRY
+
+from vxwhatsapp import config
+from vxwhatsapp.loopmonitor import LoopMonitor
+
+
+async def blocking_handler():
+    time.sleep(0.3)
+
+
+@pytest.mark.asyncio
+async def test_loop_monitor(monkeypatch, caplog):
+    """
+    Should measure the loop lag and tasks, and report callbacks that block the loop
+    """
+    monkeypatch.setattr(config, "LOOP_MONITOR_INTERVAL", 0.01)
+    monkeypatch.setattr(config, "SLOW_CALLBACK_THRESHOLD", 0.1)
+    slow_before = REGISTRY.get_sample_value("whatsapp_event_loop_slow_callback_total")
+    lag_before = REGISTRY.get_sample_value("whatsapp_event_loop_lag_sec_count")
+    monitor = LoopMonitor(asyncio.get_running_loop())
+    monitor.start()
+    try:
+        await asyncio.sleep(0.05)
+        with caplog.at_level(logging.WARNING):
+            await asyncio.create_task(blocking_handler())
+            await asyncio.sleep(0.05)
+    finally:
+        monitor.stop()
+
+    assert REGISTRY.get_sample_value("whatsapp_event_loop_lag_sec_count") > lag_before
+    assert REGISTRY.get_sample_value("whatsapp_event_loop_tasks") >= 1
+    assert monitor.tasks >= 1
+    assert (
+        REGISTRY.get_sample_value("whatsapp_event_loop_slow_callback_total")
+        == slow_before + 1
+    )
+    [record] = [r for r in caplog.records if "Event loop blocked" in r.getMessage()]
+    assert "blocking_handler" in record.getMessage()
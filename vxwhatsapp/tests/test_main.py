@@ -56,3 +56,17 @@ async def test_metrics(app_server):
     response = await app_server.get(app.url_for("metrics"))
     assert response.status_code == 200
     assert "sanic_request_latency_sec" in response.text
+
+
+@pytest.mark.asyncio
+async def test_live(app_server):
+    response = await app_server.get(app.url_for("live"))
+    assert response.status_code == 200
+    assert response.json() == {"alive": True}
+
+
+@pytest.mark.asyncio
+async def test_ready(app_server):
+    response = await app_server.get(app.url_for("ready"))
+    assert response.status_code == 200
+    assert response.json() == {"ready": True, "reasons": []}
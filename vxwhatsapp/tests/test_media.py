@@ -0,0 +1,64 @@
+import asyncio
+
+import pytest
+import pytest_asyncio
+
+from vxwhatsapp import config
+from vxwhatsapp.media import MediaPipeline
+
+
+@pytest_asyncio.fixture
+async def pipeline():
+    pipeline = MediaPipeline("http://localhost/v1/media")
+    yield pipeline
+    await pipeline.teardown()
+
+
+@pytest.mark.asyncio
+async def test_cache_size(pipeline, monkeypatch):
+    """
+    Should only cache the most recently used media IDs
+    """
+    monkeypatch.setattr(config, "MEDIA_CACHE_SIZE", 2)
+    uploads = []
+
+    async def upload(media_url):
+        uploads.append(media_url)
+        return f"id-{media_url}", "image/png"
+
+    monkeypatch.setattr(pipeline, "_upload", upload)
+    await pipeline.get_media_id("a")
+    await pipeline.get_media_id("b")
+    await pipeline.get_media_id("a")
+    await pipeline.get_media_id("c")
+    assert list(pipeline.cache) == ["a", "c"]
+    await pipeline.get_media_id("b")
+    assert uploads == ["a", "b", "c", "b"]
+
+
+@pytest.mark.asyncio
+async def test_shared_upload_cancelled(pipeline, monkeypatch):
+    """
+    If the task doing a shared upload is cancelled, the others should upload again
+    """
+    started = asyncio.Event()
+    attempts = []
+
+    async def upload(media_url):
+        attempts.append(media_url)
+        if len(attempts) == 1:
+            started.set()
+            await asyncio.sleep(10)
+        return "media-id", "image/png"
+
+    monkeypatch.setattr(pipeline, "_upload", upload)
+    owner = asyncio.create_task(pipeline.get_media_id("a"))
+    await started.wait()
+    waiter = asyncio.create_task(pipeline.get_media_id("a"))
+    await asyncio.sleep(0)
+    owner.cancel()
+
+    assert await asyncio.wait_for(waiter, 1) == ("media-id", "image/png")
+    with pytest.raises(asyncio.CancelledError):
+        await owner
+    assert attempts == ["a", "a"]
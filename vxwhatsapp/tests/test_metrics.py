@@ -0,0 +1,176 @@
+import asyncio
+import os
+import subprocess
+import sys
+from unittest.mock import MagicMock
+from urllib.request import urlopen
+
+import pytest
+from prometheus_client import REGISTRY
+from sanic import Sanic
+from sanic.response import json
+
+from vxwhatsapp import metrics
+from vxwhatsapp.metrics import (
+    METRICS_CACHE,
+    MetricsCache,
+    cleanup_dead_processes,
+    outbound_stage,
+    render_metrics,
+    reset_multiprocess_dir,
+    setup_metrics_middleware,
+    start_metrics_server,
+)
+from vxwhatsapp.tests.utils import run_sanic, unused_port
+
+
+@pytest.fixture(autouse=True)
+def invalidate_cache():
+    METRICS_CACHE.invalidate()
+    yield
+    METRICS_CACHE.invalidate()
+
+
+@pytest.fixture
+def multiproc_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("prometheus_multiproc_dir", str(tmp_path))
+    return tmp_path
+
+
+def dead_pid() -> int:
+    process = subprocess.Popen([sys.executable, "-c", ""])
+    process.wait()
+    return process.pid
+
+
+def test_cleanup_dead_processes(multiproc_dir):
+    """
+    Live gauge files for processes that no longer exist should be removed
+    """
+    pid = dead_pid()
+    for name in (
+        f"gauge_livesum_{pid}.db",
+        f"gauge_liveall_{pid}.db",
+        f"gauge_livesum_{os.getpid()}.db",
+        f"counter_{pid}.db",
+    ):
+        (multiproc_dir / name).touch()
+    cleanup_dead_processes()
+    assert sorted(p.name for p in multiproc_dir.iterdir()) == [
+        f"counter_{pid}.db",
+        f"gauge_livesum_{os.getpid()}.db",
+    ]
+
+
+def test_reset_multiprocess_dir(multiproc_dir):
+    """
+    All metrics files should be removed
+    """
+    (multiproc_dir / "counter_1.db").touch()
+    (multiproc_dir / "other.txt").touch()
+    reset_multiprocess_dir()
+    assert [p.name for p in multiproc_dir.iterdir()] == ["other.txt"]
+
+
+@pytest.mark.asyncio
+async def test_render_metrics_multiprocess(multiproc_dir):
+    """
+    In multiprocess mode, metrics should be aggregated from the metrics files
+    """
+    assert isinstance(await render_metrics(), bytes)
+
+
+@pytest.mark.asyncio
+async def test_render_metrics():
+    """
+    Without multiprocess mode, metrics should come from this process
+    """
+    assert b"whatsapp_api_request_latency_sec" in await render_metrics()
+
+
+def test_metrics_cache(monkeypatch):
+    """
+    Metrics should only be rendered once per cache TTL
+    """
+    render = MagicMock(side_effect=[b"first", b"second"])
+    monkeypatch.setattr(metrics, "_render_metrics", render)
+    cache = MetricsCache(ttl=60)
+    assert cache.get() == b"first"
+    assert cache.get() == b"first"
+    cache.invalidate()
+    assert cache.get() == b"second"
+    assert render.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_metrics_server():
+    """
+    The metrics server should serve metrics from its own thread
+    """
+    port = unused_port()
+    server = start_metrics_server(port, host="127.0.0.1")
+    try:
+        response = await asyncio.get_running_loop().run_in_executor(
+            None, urlopen, f"http://127.0.0.1:{port}/metrics"
+        )
+        with response:
+            assert response.status == 200
+            assert b"whatsapp_api_request_latency_sec" in response.read()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.mark.asyncio
+async def test_request_metrics_labels():
+    """
+    Request metrics should be labelled with the route template, and requests that don't
+    match a route should share a label
+    """
+    Sanic.test_mode = True
+    app = Sanic("metrics_labels")
+    setup_metrics_middleware(app)
+
+    @app.route("/things/<thing_id>")
+    async def thing(request, thing_id):
+        return json({})
+
+    def count(endpoint, status):
+        labels = {"method": "GET", "endpoint": endpoint, "http_status": str(status)}
+        return REGISTRY.get_sample_value("sanic_request_count_total", labels) or 0
+
+    things, unknown = count("/things/<thing_id:str>", 200), count("unknown", 404)
+    async with run_sanic(app) as server:
+        await server.get("/things/1")
+        await server.get("/things/2")
+        await server.get("/random-scanner-path")
+    assert count("/things/<thing_id:str>", 200) == things + 2
+    assert count("unknown", 404) == unknown + 1
+
+
+def test_outbound_stage():
+    """
+    Should track the messages in the stage, and time the stage until it's stopped
+    """
+
+    def in_flight():
+        return REGISTRY.get_sample_value(
+            "whatsapp_outbound_stage_in_flight", {"stage": "test"}
+        )
+
+    def count():
+        return (
+            REGISTRY.get_sample_value(
+                "whatsapp_outbound_stage_latency_sec_count",
+                {"stage": "test", "kind": "text"},
+            )
+            or 0
+        )
+
+    before = count()
+    with outbound_stage("test", "text") as stage:
+        assert in_flight() == 1
+        stage.stop()
+        assert in_flight() == 0
+    assert in_flight() == 0
+    assert count() == before + 1
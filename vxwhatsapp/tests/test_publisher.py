@@ -50,8 +50,7 @@ async def get_amqp_message(queue: Queue) -> AMQPMessage:
 async def test_session_timeout_check(amqp: Connection, redis: Redis):
     queue = await setup_amqp_queue(amqp)
     publisher = Publisher(amqp, redis)
-    await publisher.setup()
-    publisher.periodic_task.cancel()
+    await publisher.setup(periodic=False)
     await redis.zadd("claims", {"27820001001": int(time.time() - 6 * 60)})
     await publisher._check_for_session_timeouts()
     msg = await get_amqp_message(queue)
@@ -0,0 +1,125 @@
+import time
+from typing import AsyncGenerator
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+import pytest_asyncio
+from redis.asyncio import Redis, from_url
+
+from vxwhatsapp import config
+from vxwhatsapp.ratelimit import RateLimiter, TokenBucket
+from vxwhatsapp.tests.utils import cleanup_redis
+
+
+@pytest_asyncio.fixture
+async def redis() -> AsyncGenerator[Redis, None]:
+    conn = from_url(
+        config.REDIS_URL or "redis://", encoding="utf8", decode_responses=True
+    )
+    yield conn
+    await conn.close()
+    await cleanup_redis()
+
+
+@pytest.fixture
+def rate_limit_config():
+    rate, burst, lease = (
+        config.RATE_LIMIT,
+        config.RATE_LIMIT_BURST,
+        config.RATE_LIMIT_LEASE,
+    )
+    config.RATE_LIMIT = 100
+    config.RATE_LIMIT_BURST = 5
+    config.RATE_LIMIT_LEASE = 2
+    yield
+    config.RATE_LIMIT = rate
+    config.RATE_LIMIT_BURST = burst
+    config.RATE_LIMIT_LEASE = lease
+
+
+def test_token_bucket():
+    """
+    Should allow a burst, and then return how long to wait for the next token
+    """
+    bucket = TokenBucket(rate=10, burst=2)
+    assert bucket.take() == 0
+    assert bucket.take() == 0
+    assert 0 < bucket.take() <= 0.1
+
+
+@pytest.mark.asyncio
+async def test_disabled():
+    """
+    If there's no rate limit configured, acquire should return immediately
+    """
+    limiter = RateLimiter(None, "ratelimit:test")
+    assert limiter.enabled is False
+    await limiter.acquire()
+
+
+@pytest.mark.asyncio
+async def test_local_rate_limit(rate_limit_config):
+    """
+    Without redis, should limit using a local token bucket
+    """
+    limiter = RateLimiter(None, "ratelimit:test")
+    start = time.monotonic()
+    for _ in range(10):
+        await limiter.acquire()
+    # 5 tokens of burst, and then 5 more at 100/s
+    assert time.monotonic() - start >= 0.04
+
+
+@pytest.mark.asyncio
+async def test_redis_unavailable(rate_limit_config):
+    """
+    If redis is unavailable, should fall back to the local rate limit
+    """
+    redis = MagicMock()
+    redis.register_script.return_value = AsyncMock(side_effect=ConnectionError())
+    limiter = RateLimiter(redis, "ratelimit:test")
+    await limiter.acquire()
+    assert limiter._fallback.tokens == 4
+    await limiter.acquire()
+    # We shouldn't retry redis straight away
+    redis.register_script.return_value.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_redis_lease(rate_limit_config, redis):
+    """
+    Should lease tokens from redis in batches
+    """
+    limiter = RateLimiter(redis, "ratelimit:test")
+    await limiter.acquire()
+    assert limiter.leased == 1
+    assert float(await redis.hget("ratelimit:test", "tokens")) <= 3
+    await limiter.acquire()
+    assert limiter.leased == 0
+
+
+@pytest.mark.asyncio
+async def test_fallback_share(rate_limit_config, monkeypatch):
+    """
+    The fallback limit should be this process's share of the limit
+    """
+    monkeypatch.setattr(config, "RATE_LIMIT_PROCESSES", 4)
+    limiter = RateLimiter(None, "ratelimit:test")
+    assert limiter._fallback.rate == 25
+
+    monkeypatch.setattr(config, "RATE_LIMIT_FALLBACK", 10)
+    limiter = RateLimiter(None, "ratelimit:test")
+    assert limiter._fallback.rate == 10
+
+
+@pytest.mark.asyncio
+async def test_redis_fallback_share(rate_limit_config, redis):
+    """
+    The fallback limit should be shared between the processes leasing from redis
+    """
+    limiter1 = RateLimiter(redis, "ratelimit:test")
+    limiter2 = RateLimiter(redis, "ratelimit:test")
+    limiter2.member_id = "other"
+    await limiter1.acquire()
+    await limiter2.acquire()
+    assert limiter2._fallback.rate == 50
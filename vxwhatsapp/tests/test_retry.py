@@ -0,0 +1,113 @@
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from vxwhatsapp import config
+from vxwhatsapp.retry import (
+    RETRY_COUNT_HEADER,
+    RetryQueues,
+    retry_delay,
+    retry_delays,
+    retry_queue_names,
+    retry_tiers,
+)
+
+
+@pytest.fixture
+def retry_config():
+    base, maximum, attempts = (
+        config.RETRY_BASE_DELAY,
+        config.RETRY_MAX_DELAY,
+        config.RETRY_MAX_ATTEMPTS,
+    )
+    config.RETRY_BASE_DELAY = 1
+    config.RETRY_MAX_DELAY = 10
+    config.RETRY_MAX_ATTEMPTS = 3
+    yield
+    config.RETRY_BASE_DELAY = base
+    config.RETRY_MAX_DELAY = maximum
+    config.RETRY_MAX_ATTEMPTS = attempts
+
+
+def test_retry_tiers(retry_config):
+    """
+    Tiers should double until they reach the maximum delay
+    """
+    assert retry_tiers() == [1, 2, 4, 8, 10]
+    assert retry_delays(4) == pytest.approx([2, 2 + 2 / 3, 3 + 1 / 3, 4])
+    names = retry_queue_names("whatsapp.outbound")
+    assert names[:6] == [
+        "whatsapp.outbound.retry.500",
+        "whatsapp.outbound.retry.666",
+        "whatsapp.outbound.retry.833",
+        "whatsapp.outbound.retry.1000",
+        "whatsapp.outbound.retry.1333",
+        "whatsapp.outbound.retry.1666",
+    ]
+    assert names[-1] == "whatsapp.outbound.retry.10000"
+    assert len(names) == len(set(names))
+
+
+def test_retry_tiers_invalid_base_delay(retry_config):
+    """
+    A base delay that can't double up to the maximum should be a clear error
+    """
+    config.RETRY_BASE_DELAY = 0
+    with pytest.raises(ValueError, match="RETRY_BASE_DELAY"):
+        retry_tiers()
+
+
+def test_retry_delay():
+    """
+    The delay should be one of the tier's queue delays
+    """
+    for _ in range(100):
+        assert retry_delay(4) in retry_delays(4)
+
+
+@pytest.mark.asyncio
+async def test_retry(retry_config):
+    """
+    Each retry should go into the next tier, with the attempt count in the headers
+    """
+    channel = MagicMock()
+    channel.default_exchange.publish = AsyncMock()
+    retries = RetryQueues(channel, "whatsapp.outbound")
+    message = MagicMock(
+        headers={
+            RETRY_COUNT_HEADER: 1,
+            "traceparent": "test",
+            "x-death": [{"count": 1}],
+            "x-first-death-queue": "whatsapp.outbound.retry.1000",
+        },
+        body=b"test",
+    )
+
+    assert await retries.retry(message) is True
+
+    [amqp_message] = channel.default_exchange.publish.call_args.args
+    assert amqp_message.body == b"test"
+    # The broker's dead letter headers shouldn't be copied
+    assert amqp_message.headers == {RETRY_COUNT_HEADER: 2, "traceparent": "test"}
+    assert amqp_message.expiration is None
+    kwargs = channel.default_exchange.publish.call_args.kwargs
+    assert kwargs["routing_key"] in [
+        "whatsapp.outbound.retry.1000",
+        "whatsapp.outbound.retry.1333",
+        "whatsapp.outbound.retry.1666",
+        "whatsapp.outbound.retry.2000",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_retry_max_attempts(retry_config):
+    """
+    Once the maximum attempts are reached, the message shouldn't be retried
+    """
+    channel = MagicMock()
+    channel.default_exchange.publish = AsyncMock()
+    retries = RetryQueues(channel, "whatsapp.outbound")
+    message = MagicMock(headers={RETRY_COUNT_HEADER: 3}, body=b"test")
+
+    assert await retries.retry(message) is False
+    channel.default_exchange.publish.assert_not_called()
@@ -0,0 +1,118 @@
+from collections import Counter
+from typing import AsyncGenerator
+from unittest.mock import AsyncMock
+
+import pytest
+import pytest_asyncio
+from redis.asyncio import Redis, from_url
+
+from vxwhatsapp import config
+from vxwhatsapp.sharding import (
+    ShardCoordinator,
+    ShardRouter,
+    declare_shard_queues,
+    jump_hash,
+    shard_owner,
+)
+from vxwhatsapp.tests.utils import cleanup_redis
+
+
+@pytest_asyncio.fixture
+async def redis() -> AsyncGenerator[Redis, None]:
+    conn = from_url(
+        config.REDIS_URL or "redis://", encoding="utf8", decode_responses=True
+    )
+    yield conn
+    await conn.close()
+    await cleanup_redis()
+
+
+def test_jump_hash():
+    """
+    Should spread keys across the buckets, and only move keys to the new bucket when
+    a bucket is added
+    """
+    keys = [f"2782000{i:04}" for i in range(1000)]
+    shards = {key: jump_hash(key, 8) for key in keys}
+    assert set(shards.values()) == set(range(8))
+    assert max(Counter(shards.values()).values()) < 200
+
+    for key in keys:
+        new_shard = jump_hash(key, 9)
+        assert new_shard == shards[key] or new_shard == 8
+
+
+def test_shard_owner():
+    """
+    When a member leaves, only its shards should move
+    """
+    members = ["a", "b", "c"]
+    owners = {shard: shard_owner(shard, members) for shard in range(32)}
+    assert set(owners.values()) == set(members)
+    for shard, owner in owners.items():
+        if owner != "c":
+            assert shard_owner(shard, ["a", "b"]) == owner
+
+
+def test_recipient():
+    """
+    Should get the recipient from the message body, even if the body is invalid
+    """
+    assert ShardRouter.recipient(b'{"to_addr": "27820001001"}') == "27820001001"
+    assert ShardRouter.recipient(b"invalid") == ""
+    assert ShardRouter.recipient(b"{}") == ""
+
+
+@pytest.mark.asyncio
+async def test_coordinator_no_redis():
+    """
+    Without redis, we should claim all the shards
+    """
+    changes = []
+
+    async def on_change(owned):
+        changes.append(owned)
+
+    coordinator = ShardCoordinator(None, "shards:test", 4, on_change)
+    await coordinator.setup()
+    await coordinator.teardown()
+    assert changes == [{0, 1, 2, 3}]
+
+
+@pytest.mark.asyncio
+async def test_coordinator_rebalance(redis):
+    """
+    Shards should be divided between the live members
+    """
+    changes = []
+
+    async def on_change(owned):
+        changes.append(owned)
+
+    coordinator = ShardCoordinator(redis, "shards:test", 16, on_change)
+    await redis.zadd("shards:test", {"other": 1e12, "dead": 1})
+    await coordinator._rebalance()
+    [owned] = changes
+    assert owned == {
+        s
+        for s in range(16)
+        if shard_owner(s, ["other", coordinator.member_id]) == coordinator.member_id
+    }
+    assert await redis.zscore("shards:test", "dead") is None
+    await redis.delete("shards:test")
+
+
+@pytest.mark.asyncio
+async def test_declare_shard_queues():
+    """
+    Should declare a single active consumer queue for each shard
+    """
+    channel = AsyncMock()
+    queues = await declare_shard_queues(channel, "whatsapp.outbound", 2)
+    assert list(queues) == [0, 1]
+    channel.declare_queue.assert_any_await(
+        "whatsapp.outbound.shard.1",
+        durable=True,
+        auto_delete=False,
+        arguments={"x-single-active-consumer": True},
+    )
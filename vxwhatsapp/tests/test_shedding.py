@@ -0,0 +1,75 @@
+from datetime import datetime, timedelta, timezone
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from vxwhatsapp import config
+from vxwhatsapp.models import Message
+from vxwhatsapp.shedding import SHED_LANE_HEADER, LoadShedder, message_age
+
+
+def make_message(age: float) -> Message:
+    return Message(
+        to_addr="27820001001",
+        from_addr="27820001002",
+        transport_name="whatsapp",
+        transport_type=Message.TRANSPORT_TYPE.HTTP_API,
+        timestamp=datetime.now(tz=timezone.utc) - timedelta(seconds=age),
+    )
+
+
+def test_message_age():
+    """
+    Should return the seconds since the message timestamp
+    """
+    message = make_message(30)
+    assert message_age(message, message.timestamp + timedelta(seconds=30)) == 30
+
+
+def test_is_stale():
+    """
+    Messages older than the lane's maximum age are stale. A maximum age of 0 disables
+    shedding for that lane
+    """
+    shedder = LoadShedder(MagicMock(), "whatsapp.outbound")
+    shedder.max_ages = {"interactive": 60, "bulk": 0}
+    assert shedder.is_stale(make_message(120), "interactive") is True
+    assert shedder.is_stale(make_message(30), "interactive") is False
+    assert shedder.is_stale(make_message(120), "bulk") is False
+
+
+@pytest.mark.asyncio
+async def test_shed_to_stale_queue():
+    """
+    If enabled, shed messages should be published to the stale queue
+    """
+    channel = MagicMock()
+    channel.default_exchange.publish = AsyncMock()
+    channel.declare_queue = AsyncMock()
+    shedder = LoadShedder(channel, "whatsapp.outbound")
+    message = MagicMock(body=b"{}", headers={})
+
+    config.STALE_QUEUE = True
+    try:
+        await shedder.setup()
+        await shedder.shed(message, "bulk")
+    finally:
+        config.STALE_QUEUE = False
+
+    channel.declare_queue.assert_awaited_once()
+    [amqp_message], kwargs = channel.default_exchange.publish.call_args
+    assert kwargs["routing_key"] == "whatsapp.outbound.stale"
+    assert amqp_message.body == b"{}"
+    assert amqp_message.headers[SHED_LANE_HEADER] == "bulk"
+
+
+@pytest.mark.asyncio
+async def test_shed_drop():
+    """
+    If the stale queue isn't enabled, shed messages should just be dropped
+    """
+    channel = MagicMock()
+    channel.default_exchange.publish = AsyncMock()
+    shedder = LoadShedder(channel, "whatsapp.outbound")
+    await shedder.shed(MagicMock(body=b"{}", headers={}), "interactive")
+    channel.default_exchange.publish.assert_not_called()
@@ -0,0 +1,56 @@
+import os
+import sys
+
+from vxwhatsapp import supervisor
+
+
+def test_parse_args_defaults():
+    """
+    Ingress and consumer processes should default to the number of CPUs, with a single
+    scheduler
+    """
+    args = supervisor.parse_args([])
+    assert args.ingress == os.cpu_count()
+    assert args.consumer == os.cpu_count()
+    assert args.scheduler == 1
+    assert (args.ingress_port, args.consumer_port, args.scheduler_port) == (
+        8000,
+        8001,
+        8002,
+    )
+
+
+def test_role_command():
+    """
+    Each role should be run as a sanic server with its own port and workers, limited to
+    that role
+    """
+    command, env = supervisor.role_command("consumer", 3, "127.0.0.1", 8001)
+    assert command[1:] == [
+        "-m",
+        "sanic",
+        "vxwhatsapp.main.app",
+        "--host",
+        "127.0.0.1",
+        "--port",
+        "8001",
+        "--workers",
+        "3",
+    ]
+    assert env["ROLES"] == "consumer"
+
+
+def test_main_stops_all_roles(monkeypatch):
+    """
+    If any role exits, the others should be stopped, and its exit code returned
+    """
+
+    def role_command(role, workers, host, port):
+        if role == "scheduler":
+            code = "import sys; sys.exit(3)"
+        else:
+            code = "import time; time.sleep(60)"
+        return [sys.executable, "-c", code], dict(os.environ)
+
+    monkeypatch.setattr(supervisor, "role_command", role_command)
+    assert supervisor.main(["--ingress", "1", "--consumer", "1"]) == 3
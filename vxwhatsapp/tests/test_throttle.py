@@ -0,0 +1,37 @@
+import time
+from email.utils import formatdate
+
+import pytest
+
+from vxwhatsapp.throttle import Throttle, parse_retry_after
+
+
+def test_parse_retry_after():
+    """
+    Should parse both seconds and HTTP dates, within the limits
+    """
+    assert parse_retry_after("5", default=1, maximum=60) == 5
+    assert parse_retry_after(None, default=1, maximum=60) == 1
+    assert parse_retry_after("invalid", default=1, maximum=60) == 1
+    assert parse_retry_after("120", default=1, maximum=60) == 60
+    assert parse_retry_after("-5", default=1, maximum=60) == 0
+    retry_at = formatdate(time.time() + 30, usegmt=True)
+    assert 25 < parse_retry_after(retry_at, default=1, maximum=60) <= 30
+
+
+@pytest.mark.asyncio
+async def test_throttle():
+    """
+    Should wait until the pause is over, and only extend pauses
+    """
+    throttle = Throttle()
+    assert throttle.paused is False
+    await throttle.wait()
+
+    throttle.pause(0.05)
+    throttle.pause(0.01)
+    assert throttle.paused is True
+    start = time.monotonic()
+    await throttle.wait()
+    assert time.monotonic() - start >= 0.04
+    assert throttle.paused is False
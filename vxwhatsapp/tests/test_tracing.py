@@ -0,0 +1,53 @@
+import sentry_sdk
+
+from vxwhatsapp import config
+from vxwhatsapp.tracing import continue_trace, trace_headers, traces_sampler
+
+TRACE_ID = "4bf92f3577b34da6a3ce929d0e0e4736"
+SPAN_ID = "00f067aa0ba902b7"
+
+
+def test_trace_headers():
+    """
+    Should return the W3C trace context for the current span
+    """
+    with sentry_sdk.start_transaction(name="test") as transaction:
+        headers = trace_headers()
+    flags = "01" if transaction.sampled else "00"
+    assert headers["traceparent"] == (
+        f"00-{transaction.trace_id}-{transaction.span_id}-{flags}"
+    )
+
+
+def test_continue_trace():
+    """
+    Should continue the trace in the W3C trace context headers
+    """
+    transaction = continue_trace(
+        {"traceparent": f"00-{TRACE_ID}-{SPAN_ID}-01"}, name="test", op="test"
+    )
+    assert transaction.trace_id == TRACE_ID
+    assert transaction.parent_span_id == SPAN_ID
+    assert transaction.parent_sampled is True
+
+    transaction = continue_trace({"traceparent": "invalid"}, name="test", op="test")
+    assert transaction.trace_id != TRACE_ID
+    assert transaction.parent_sampled is None
+
+
+def test_traces_sampler(monkeypatch):
+    """
+    Should keep the upstream decision, otherwise use the rate for the transaction name
+    """
+    monkeypatch.setattr(config, "TRACES_SAMPLE_RATES", {"/v1/webhook": 0.5})
+    monkeypatch.setattr(config, "SENTRY_TRACES_SAMPLE_RATE", 0.1)
+
+    def context(name, parent_sampled=None):
+        return {
+            "transaction_context": {"name": name},
+            "parent_sampled": parent_sampled,
+        }
+
+    assert traces_sampler(context("/v1/webhook", parent_sampled=False)) is False
+    assert traces_sampler(context("/v1/webhook")) == 0.5
+    assert traces_sampler(context("/")) == 0.1
@@ -8,6 +8,7 @@ import pytest_asyncio
 import ujson
 from aio_pika import Connection, Queue
 from aio_pika.exceptions import QueueEmpty
+from prometheus_client import REGISTRY
 
 from vxwhatsapp.main import app
 from vxwhatsapp.models import Event, Message
@@ -449,6 +450,60 @@ async def test_valid_event(app_server):
     assert event.helper_metadata == {"recipient_id": "27820001001", "status": "read"}
 
 
+@pytest.mark.asyncio
+async def test_throughput_metrics(app_server):
+    """
+    Should count inbound messages by type and statuses by status, and record the size
+    of the published payloads
+    """
+
+    def sample(name, labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    texts = sample("whatsapp_inbound_messages_total", {"type": "text"})
+    reads = sample("whatsapp_inbound_statuses_total", {"status": "read"})
+    sizes = sample(
+        "whatsapp_payload_size_bytes_count", {"direction": "published", "type": "text"}
+    )
+    data = ujson.dumps(
+        {
+            "messages": [
+                {
+                    "from": "27820001001",
+                    "id": "abc135",
+                    "timestamp": "123456789",
+                    "type": "text",
+                    "text": {"body": "test message"},
+                }
+            ],
+            "statuses": [
+                {
+                    "id": "abc136",
+                    "recipient_id": "27820001001",
+                    "status": "read",
+                    "timestamp": "123456789",
+                }
+            ],
+        }
+    )
+    response = await app_server.post(
+        app.url_for("whatsapp.whatsapp_webhook"),
+        headers={"X-Turn-Hook-Signature": generate_hmac_signature(data, "testsecret")},
+        content=data,
+    )
+    assert response.status_code == 200
+
+    assert sample("whatsapp_inbound_messages_total", {"type": "text"}) == texts + 1
+    assert sample("whatsapp_inbound_statuses_total", {"status": "read"}) == reads + 1
+    assert (
+        sample(
+            "whatsapp_payload_size_bytes_count",
+            {"direction": "published", "type": "text"},
+        )
+        == sizes + 1
+    )
+
+
 @pytest.mark.asyncio
 async def test_duplicate_message(app_server):
     queue = await setup_amqp_queue(app_server.app.ctx.amqp_connection)
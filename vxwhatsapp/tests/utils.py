@@ -5,11 +5,14 @@ from dataclasses import dataclass
 import httpx
 import redis.asyncio as aioredis
 from aio_pika import connect_robust
+from aio_pika.exceptions import ChannelNotFoundEntity
 from sanic import Sanic
 from sanic.server import AsyncioServer
 from sentry_sdk.integrations import sanic as si_sanic
 
 from vxwhatsapp import config
+from vxwhatsapp.retry import retry_queue_names
+from vxwhatsapp.shedding import stale_queue_name
 
 
 async def cleanup_redis():
@@ -21,6 +24,12 @@ async def cleanup_redis():
         await redis.delete(key)
     for key in await redis.keys("msgseen:*"):
         await redis.delete(key)
+    for key in await redis.keys("ratelimit:*"):
+        await redis.delete(key)
+    for key in await redis.keys("contact:*"):
+        await redis.delete(key)
+    for key in await redis.keys("msgsent:*"):
+        await redis.delete(key)
     await redis.close()
 
 
@@ -31,6 +40,7 @@ async def cleanup_amqp():
         for routing_key in [
             f"{config.TRANSPORT_NAME}.inbound",
             f"{config.TRANSPORT_NAME}.outbound",
+            f"{config.TRANSPORT_NAME}.outbound.bulk",
             f"{config.TRANSPORT_NAME}.event",
             f"{config.TRANSPORT_NAME}.answer",
         ]:
@@ -42,6 +52,18 @@ async def cleanup_amqp():
                 if message is None:
                     break
                 message.ack()
+        for queue_name in [
+            *retry_queue_names(f"{config.TRANSPORT_NAME}.outbound"),
+            *retry_queue_names(f"{config.TRANSPORT_NAME}.outbound.bulk"),
+            stale_queue_name(f"{config.TRANSPORT_NAME}.outbound"),
+        ]:
+            # Passive declares close the channel if the queue doesn't exist
+            channel = await connection.channel()
+            try:
+                queue = await channel.declare_queue(queue_name, passive=True)
+            except ChannelNotFoundEntity:
+                continue
+            await queue.purge()
     await connection.close()
 
 
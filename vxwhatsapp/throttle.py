@@ -0,0 +1,75 @@
+import asyncio
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+from prometheus_client import Counter
+from sanic.log import logger
+
+THROTTLED_SECONDS = Counter(
+    "whatsapp_throttled_seconds_total",
+    "Time that outbound sends were paused because of WhatsApp API throttling",
+)
+THROTTLE_DEFERRED = Counter(
+    "whatsapp_throttle_deferred_total",
+    "Outbound messages deferred because of WhatsApp API throttling",
+)
+
+
+def parse_retry_after(value: Optional[str], default: float, maximum: float) -> float:
+    """
+    Parses a Retry-After header, which is either a number of seconds, or an HTTP date,
+    into the number of seconds to wait
+    """
+    if not value:
+        return default
+    try:
+        delay = float(value)
+    except ValueError:
+        try:
+            retry_at = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return default
+        if retry_at.tzinfo is None:
+            retry_at = retry_at.replace(tzinfo=timezone.utc)
+        delay = (retry_at - datetime.now(tz=timezone.utc)).total_seconds()
+    return min(max(delay, 0), maximum)
+
+
+class Throttle:
+    """
+    A process wide pause on outbound sends, for when the upstream API asks us to back
+    off
+    """
+
+    def __init__(self):
+        self._resume_at = 0.0
+
+    @property
+    def paused(self) -> bool:
+        return self._resume_at > time.monotonic()
+
+    def pause(self, seconds: float) -> None:
+        """
+        Pauses sends for `seconds`. If we're already paused for longer, this does
+        nothing.
+        """
+        now = time.monotonic()
+        resume_at = now + seconds
+        if resume_at <= self._resume_at:
+            return
+        if not self.paused:
+            logger.warning("WhatsApp API throttled, pausing sends for %ss", seconds)
+        THROTTLED_SECONDS.inc(resume_at - max(self._resume_at, now))
+        self._resume_at = resume_at
+
+    async def wait(self) -> None:
+        """
+        Waits until sends are no longer paused
+        """
+        while True:
+            remaining = self._resume_at - time.monotonic()
+            if remaining <= 0:
+                return
+            await asyncio.sleep(remaining)
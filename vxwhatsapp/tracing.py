@@ -0,0 +1,68 @@
+import re
+from typing import Any, Dict, Mapping, Optional, Union
+
+import sentry_sdk
+from sentry_sdk.tracing import Transaction
+
+from vxwhatsapp import config
+
+TRACEPARENT_HEADER = "traceparent"
+BAGGAGE_HEADER = "baggage"
+SENTRY_TRACE_HEADER = "sentry-trace"
+
+# W3C trace context: version-trace_id-parent_id-flags
+TRACEPARENT_RE = re.compile(
+    r"^[0-9a-f]{2}-(?P<trace_id>[0-9a-f]{32})-(?P<span_id>[0-9a-f]{16})-"
+    r"(?P<flags>[0-9a-f]{2})$"
+)
+
+
+def trace_headers() -> Dict[str, str]:
+    """
+    Returns the W3C trace context headers for the current span, to add to AMQP
+    messages, so that the consumer of the message can continue the trace
+    """
+    span = sentry_sdk.get_current_span()
+    if span is None:
+        return {}
+    headers = {
+        TRACEPARENT_HEADER: (
+            f"00-{span.trace_id}-{span.span_id}-{'01' if span.sampled else '00'}"
+        )
+    }
+    if baggage := sentry_sdk.get_baggage():
+        headers[BAGGAGE_HEADER] = baggage
+    return headers
+
+
+def continue_trace(
+    headers: Optional[Mapping[str, Any]], name: str, op: str
+) -> Transaction:
+    """
+    Returns a transaction that continues the trace in the W3C trace context headers,
+    or starts a new trace if there aren't any
+    """
+    sentry_headers = {}
+    if headers:
+        match = TRACEPARENT_RE.match(str(headers.get(TRACEPARENT_HEADER, "")))
+        if match:
+            sampled = "1" if int(match["flags"], 16) & 1 else "0"
+            sentry_headers[SENTRY_TRACE_HEADER] = (
+                f"{match['trace_id']}-{match['span_id']}-{sampled}"
+            )
+            if baggage := headers.get(BAGGAGE_HEADER):
+                sentry_headers[BAGGAGE_HEADER] = str(baggage)
+    return sentry_sdk.continue_trace(sentry_headers, op=op, name=name)
+
+
+def traces_sampler(sampling_context: Dict[str, Any]) -> Union[float, bool]:
+    """
+    Head based sampling. Traces that were started upstream keep the upstream decision,
+    so that they're complete, otherwise the transaction name (the path, for requests)
+    decides the rate, falling back to SENTRY_TRACES_SAMPLE_RATE.
+    """
+    parent_sampled = sampling_context.get("parent_sampled")
+    if parent_sampled is not None:
+        return parent_sampled
+    name = sampling_context.get("transaction_context", {}).get("name")
+    return config.TRACES_SAMPLE_RATES.get(name, config.SENTRY_TRACES_SAMPLE_RATE)
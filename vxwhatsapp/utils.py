@@ -2,6 +2,8 @@ import ipaddress
 import re
 from urllib.parse import urlsplit, urlunsplit
 
+from aio_pika import Channel, Exchange
+
 
 # https://github.com/django/django/blob/main/django/utils/ipv6.py#L38
 def is_valid_ipv6_address(ip_str):
@@ -102,3 +104,13 @@ class URLValidator:
 
 
 valid_url = URLValidator()
+
+
+def default_exchange(channel: Channel) -> Exchange:
+    """
+    Returns the channel's default exchange, which is only set once the channel is open
+    """
+    exchange = channel.default_exchange
+    if exchange is None:
+        raise RuntimeError("AMQP channel is not open")
+    return exchange
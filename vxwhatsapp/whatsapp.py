@@ -1,6 +1,7 @@
 from asyncio import gather
 from datetime import datetime, timezone
 
+import sentry_sdk
 from sanic import Blueprint
 from sanic.request import Request
 from sanic.response import HTTPResponse, json
@@ -8,14 +9,19 @@ from sanic.response import HTTPResponse, json
 from vxwhatsapp import config
 from vxwhatsapp.auth import validate_hmac
 from vxwhatsapp.claims import store_conversation_claim
+from vxwhatsapp.lag import observe_inbound_lag
+from vxwhatsapp.metrics import INBOUND_MESSAGES, INBOUND_STATUSES, WEBHOOK_STAGE_LATENCY
 from vxwhatsapp.models import Event, Message
 from vxwhatsapp.schema import validate_schema, whatsapp_webhook_schema
 
 bp = Blueprint("whatsapp", version=1)
 
+webhook_translate = WEBHOOK_STAGE_LATENCY.labels("translate")
+webhook_publish = WEBHOOK_STAGE_LATENCY.labels("publish")
+
 
 async def publish_message(request, message):
-    return await gather(
+    result = await gather(
         request.app.ctx.publisher.publish_message(message),
         store_conversation_claim(
             request.app.ctx.redis,
@@ -23,6 +29,13 @@ async def publish_message(request, message):
             message.from_addr,
         ),
     )
+    observe_inbound_lag("message", message.timestamp)
+    return result
+
+
+async def publish_event(request, event):
+    await request.app.ctx.publisher.publish_event(event)
+    observe_inbound_lag("event", event.timestamp)
 
 
 async def dedupe_and_publish_message(request, message):
@@ -34,92 +47,106 @@ async def dedupe_and_publish_message(request, message):
         lock_key, timeout=config.LOCK_TIMEOUT, blocking_timeout=config.LOCK_TIMEOUT * 2
     )
     async with lock:
-        if await request.app.ctx.redis.get(seen_key) is not None:
+        with sentry_sdk.start_span(op="dedupe", description=message.message_id):
+            seen = await request.app.ctx.redis.get(seen_key) is not None
+        if seen:
             return
         await publish_message(request, message)
         await request.app.ctx.redis.setex(seen_key, config.DEDUPLICATION_WINDOW, "")
 
 
+def translate_message(request: Request, msg: dict) -> Message:
+    timestamp = datetime.fromtimestamp(float(msg.pop("timestamp")), tz=timezone.utc)
+
+    content = None
+    if msg["type"] == "text":
+        content = msg.pop("text")["body"]
+    elif msg["type"] == "location":
+        content = msg["location"].pop("name", None)
+    elif msg["type"] == "button":
+        content = msg["button"].pop("text")
+    elif msg["type"] == "interactive":
+        if msg["interactive"]["type"] == "list_reply":
+            content = msg["interactive"]["list_reply"].pop("title")
+        else:
+            content = msg["interactive"]["button_reply"].pop("title")
+    elif msg["type"] in ("unknown", "contacts"):
+        content = None
+    else:
+        content = msg[msg["type"]].pop("caption", None)
+
+    return Message(
+        to_addr=config.WHATSAPP_NUMBER,
+        from_addr=msg.pop("from"),
+        content=content,
+        in_reply_to=msg.get("context", {}).pop("id", None),
+        transport_name=config.TRANSPORT_NAME,
+        transport_type=Message.TRANSPORT_TYPE.HTTP_API,
+        timestamp=timestamp,
+        message_id=msg.pop("id"),
+        to_addr_type=Message.ADDRESS_TYPE.MSISDN,
+        from_addr_type=Message.ADDRESS_TYPE.MSISDN,
+        transport_metadata={
+            "contacts": request.json.get("contacts"),
+            "message": msg,
+            "claim": request.headers.get("X-Turn-Claim"),
+        },
+    )
+
+
+def translate_status(ev: dict) -> Event:
+    message_id = ev.pop("id")
+    status = ev["status"]
+    event_type, delivery_status = {
+        "read": (
+            Event.EVENT_TYPE.DELIVERY_REPORT,
+            Event.DELIVERY_STATUS.DELIVERED,
+        ),
+        "delivered": (
+            Event.EVENT_TYPE.DELIVERY_REPORT,
+            Event.DELIVERY_STATUS.DELIVERED,
+        ),
+        "sent": (Event.EVENT_TYPE.ACK, None),
+        "failed": (
+            Event.EVENT_TYPE.DELIVERY_REPORT,
+            Event.DELIVERY_STATUS.FAILED,
+        ),
+        "deleted": (
+            Event.EVENT_TYPE.DELIVERY_REPORT,
+            Event.DELIVERY_STATUS.DELIVERED,
+        ),
+    }[status]
+    timestamp = datetime.fromtimestamp(float(ev.pop("timestamp")), tz=timezone.utc)
+    return Event(
+        user_message_id=message_id,
+        event_type=event_type,
+        timestamp=timestamp,
+        sent_message_id=message_id,
+        delivery_status=delivery_status,
+        helper_metadata=ev,
+    )
+
+
 @bp.route("/webhook", methods=["POST"])
 @validate_hmac("X-Turn-Hook-Signature", lambda: config.HMAC_SECRET)
 @validate_schema(whatsapp_webhook_schema)
 async def whatsapp_webhook(request: Request) -> HTTPResponse:
-    tasks = []
-    for msg in request.json.get("messages", []):
-        if msg["type"] == "system":
+    with webhook_translate.time():
+        for msg in request.json.get("messages", []):
+            INBOUND_MESSAGES.labels(msg["type"]).inc()
+        for ev in request.json.get("statuses", []):
+            INBOUND_STATUSES.labels(ev["status"]).inc()
+        messages = [
+            translate_message(request, msg)
+            for msg in request.json.get("messages", [])
             # Ignore system messages
-            continue
+            if msg["type"] != "system"
+        ]
+        events = [translate_status(ev) for ev in request.json.get("statuses", [])]
 
-        timestamp = datetime.fromtimestamp(float(msg.pop("timestamp")), tz=timezone.utc)
-
-        content = None
-        if msg["type"] == "text":
-            content = msg.pop("text")["body"]
-        elif msg["type"] == "location":
-            content = msg["location"].pop("name", None)
-        elif msg["type"] == "button":
-            content = msg["button"].pop("text")
-        elif msg["type"] == "interactive":
-            if msg["interactive"]["type"] == "list_reply":
-                content = msg["interactive"]["list_reply"].pop("title")
-            else:
-                content = msg["interactive"]["button_reply"].pop("title")
-        elif msg["type"] in ("unknown", "contacts"):
-            content = None
-        else:
-            content = msg[msg["type"]].pop("caption", None)
-
-        message = Message(
-            to_addr=config.WHATSAPP_NUMBER,
-            from_addr=msg.pop("from"),
-            content=content,
-            in_reply_to=msg.get("context", {}).pop("id", None),
-            transport_name=config.TRANSPORT_NAME,
-            transport_type=Message.TRANSPORT_TYPE.HTTP_API,
-            timestamp=timestamp,
-            message_id=msg.pop("id"),
-            to_addr_type=Message.ADDRESS_TYPE.MSISDN,
-            from_addr_type=Message.ADDRESS_TYPE.MSISDN,
-            transport_metadata={
-                "contacts": request.json.get("contacts"),
-                "message": msg,
-                "claim": request.headers.get("X-Turn-Claim"),
-            },
+    with webhook_publish.time():
+        await gather(
+            *(dedupe_and_publish_message(request, message) for message in messages),
+            *(publish_event(request, event) for event in events),
         )
-        tasks.append(dedupe_and_publish_message(request, message))
-
-    for ev in request.json.get("statuses", []):
-        message_id = ev.pop("id")
-        status = ev["status"]
-        event_type, delivery_status = {
-            "read": (
-                Event.EVENT_TYPE.DELIVERY_REPORT,
-                Event.DELIVERY_STATUS.DELIVERED,
-            ),
-            "delivered": (
-                Event.EVENT_TYPE.DELIVERY_REPORT,
-                Event.DELIVERY_STATUS.DELIVERED,
-            ),
-            "sent": (Event.EVENT_TYPE.ACK, None),
-            "failed": (
-                Event.EVENT_TYPE.DELIVERY_REPORT,
-                Event.DELIVERY_STATUS.FAILED,
-            ),
-            "deleted": (
-                Event.EVENT_TYPE.DELIVERY_REPORT,
-                Event.DELIVERY_STATUS.DELIVERED,
-            ),
-        }[status]
-        timestamp = datetime.fromtimestamp(float(ev.pop("timestamp")), tz=timezone.utc)
-        event = Event(
-            user_message_id=message_id,
-            event_type=event_type,
-            timestamp=timestamp,
-            sent_message_id=message_id,
-            delivery_status=delivery_status,
-            helper_metadata=ev,
-        )
-        tasks.append(request.app.ctx.publisher.publish_event(event))  # type: ignore
-
-    await gather(*tasks)
     return json({})